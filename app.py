@@ -1,43 +1,66 @@
 # app.py - LeadRank / Qualificador de Leads IA (Render + Postgres)
 # Unified build (merge of "v9 1098" + "saas migration" branch):
-# - Auto-migrations robustas (leads + clients) para bancos antigos
-# - Planos + uso mensal (reset automático por usage_month)
+# - Migrações versionadas (migrations.py, schema_version + advisory lock)
+# - Planos + uso mensal (cota em contadores por shard: quota_usage, mês a mês)
 # - Auth por X-API-KEY (quando api_key existe)
 # - Endpoints de dashboard/insights/treino (LogReg opcional)
 # - Export CSV server-side
 #
-# Requisitos: psycopg[binary], flask, flask-cors
+# Requisitos: psycopg[binary,pool], flask, flask-cors
 # (Opcional): numpy + scikit-learn para /recalc_pending e /auto_threshold
+#   (importados sob demanda; APP_PROFILE=ingest nunca carrega o stack de ML)
 
 import os
+import io
+import csv
+import base64
+import zlib
 import json
+import pickle
 import time
+import re
+_BOOT_T0 = time.perf_counter()
+import sys
+import importlib.util
 import random
 import string
 import secrets
+import hmac
+import functools
 import hashlib
 import logging
+import threading
 import traceback
+import bisect
+import cProfile
+import pstats
+import tracemalloc
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timezone, timedelta
 from typing import Any, Dict, List, Optional, Tuple
 
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, g, has_request_context
 from flask_cors import CORS
 from werkzeug.exceptions import HTTPException
 
 import psycopg
-from psycopg.rows import dict_row
-# optional ML deps (se não existirem, rotas de treino respondem com erro amigável)
+from psycopg.rows import dict_row, tuple_row
+import migrations
+# pool de conexões (opcional: psycopg[pool]); sem ele, cai no connect direto
 try:
-    import numpy as np
-    from sklearn.linear_model import LogisticRegression
-    from sklearn.preprocessing import StandardScaler
-    from sklearn.pipeline import Pipeline
-    _HAS_ML = True
+    from psycopg_pool import ConnectionPool
+    _HAS_POOL = True
 except Exception:
-    _HAS_ML = False
+    _HAS_POOL = False
+# optional ML deps: numpy/scikit-learn só são importados em _load_ml(), no primeiro
+# treino/inferência (se não existirem, rotas de treino respondem com erro amigável)
+np = None
+sklearn = None
+LogisticRegression = SGDClassifier = StandardScaler = Pipeline = None
 
 
 # =========================
@@ -46,6 +69,25 @@ except Exception:
 DATABASE_URL = os.environ.get("DATABASE_URL", "").strip()
 DEMO_KEY = os.environ.get("DEMO_KEY", "").strip()
 
+# Pool de conexões (por processo/worker do gunicorn).
+# Dimensione DB_POOL_MAX * nº de workers abaixo do max_connections do Postgres.
+DB_POOL_ENABLED = (os.environ.get("DB_POOL_ENABLED") or "1").strip().lower() in ("1", "true", "yes")
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "5"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))            # espera máx. por conexão (s)
+DB_POOL_MAX_LIFETIME = float(os.environ.get("DB_POOL_MAX_LIFETIME", "1800"))  # recicla conexões antigas (s)
+DB_POOL_MAX_IDLE = float(os.environ.get("DB_POOL_MAX_IDLE", "300"))          # fecha excedentes ociosas (s)
+
+# Perfil do processo: "full" (padrão) ou "ingest" (só ingest/leitura; nunca importa
+# numpy/sklearn: /prever usa a heurística, rotas de treino respondem 501, sem job workers)
+APP_PROFILE = (os.environ.get("APP_PROFILE") or "full").strip().lower()
+ML_ENABLED = APP_PROFILE != "ingest"
+
+# Migrações (migrations.py): na subida cada worker só confere schema_version.
+# AUTO_MIGRATE=0 -> não migra sozinho (rode "python migrations.py" no deploy).
+# Migrações que pedem janela (m008 com leads já populada) nunca rodam na subida.
+AUTO_MIGRATE = (os.environ.get("AUTO_MIGRATE") or "1").strip().lower() in ("1", "true", "yes")
+
 # Billing / Premium (opcional)
 STRIPE_SECRET_KEY = os.environ.get("STRIPE_SECRET_KEY", "").strip()
 STRIPE_PRICE_IDS_JSON = os.environ.get("STRIPE_PRICE_IDS_JSON", "").strip()
@@ -82,19 +124,61 @@ PLAN_CATALOG = {
 }
 
 DEFAULT_LIMIT = 200
+PREVER_BATCH_MAX = int(os.environ.get("PREVER_BATCH_MAX", "5000"))
+LABEL_BATCH_MAX = int(os.environ.get("LABEL_BATCH_MAX", "10000"))
+INSIGHTS_MAX_DAYS = int(os.environ.get("INSIGHTS_MAX_DAYS", "730"))
+EXPORT_FETCH_SIZE = int(os.environ.get("EXPORT_FETCH_SIZE", "2000"))  # rows por fetch do cursor server-side
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+# cache (por processo) do contexto do workspace: plan/status/uso/threshold/hash da api_key
+WS_CACHE_TTL = float(os.environ.get("WS_CACHE_TTL", "15"))   # segundos; 0 desliga
+WS_CACHE_MAX = int(os.environ.get("WS_CACHE_MAX", "2048"))
+
+# modelos treinados por workspace (persistidos em "models", cache LRU por processo)
+MODEL_CACHE_TTL = float(os.environ.get("MODEL_CACHE_TTL", "300"))  # segundos; outros workers pegam versão nova
+MODEL_CACHE_MAX = int(os.environ.get("MODEL_CACHE_MAX", "256"))
+MODEL_KEEP_VERSIONS = int(os.environ.get("MODEL_KEEP_VERSIONS", "3"))
+
+# aprendizado online: modelo SGD (log_loss) atualizado com partial_fit a cada rótulo;
+# refit completo a cada ONLINE_REFIT_EVERY rótulos ou ONLINE_REFIT_MAX_HOURS (drift)
+ONLINE_LEARNING = (os.environ.get("ONLINE_LEARNING") or "").strip().lower() in ("1", "true", "yes")
+ONLINE_REFIT_EVERY = int(os.environ.get("ONLINE_REFIT_EVERY", "500"))
+ONLINE_REFIT_MAX_HOURS = float(os.environ.get("ONLINE_REFIT_MAX_HOURS", "24"))
+
+# jobs em background (/jobs, ?async=1): fila em Postgres. O app web só enfileira; quem
+# executa é o processo dedicado `flask --app app run-jobs` (JOB_RUNNER_THREADS threads).
+# JOB_WORKERS > 0 liga o modo in-process (dev / instância única): cada worker do gunicorn
+# sobe JOB_WORKERS threads (total = workers x JOB_WORKERS) e os fits disputam o GIL com as requests.
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "0"))
+JOB_RUNNER_THREADS = int(os.environ.get("JOB_RUNNER_THREADS", "2"))
+JOB_POLL_SECONDS = float(os.environ.get("JOB_POLL_SECONDS", "2"))
+JOB_STALE_SECONDS = int(os.environ.get("JOB_STALE_SECONDS", "300"))  # sem heartbeat -> reenfileira
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+
+# leads particionada por mês (migrations.py): cada processo confere as partições futuras
+# no máx. 1x por PARTITION_CHECK_SECONDS (LEADS_PARTITION_MONTHS_AHEAD meses à frente)
+PARTITION_CHECK_SECONDS = float(os.environ.get("PARTITION_CHECK_SECONDS", "3600"))
+
+# rollup: o trigger de leads só acrescenta deltas; cada processo compacta (thread própria)
+# no máx. 1x por STATS_COMPACT_SECONDS, em lotes de STATS_COMPACT_BATCH deltas
+STATS_COMPACT_SECONDS = float(os.environ.get("STATS_COMPACT_SECONDS", "5"))  # 0 desliga neste processo
+STATS_COMPACT_BATCH = int(os.environ.get("STATS_COMPACT_BATCH", "50000"))
 DEFAULT_THRESHOLD = 0.35
 MIN_LABELED_TO_TRAIN = 4
 
-# rate-limit simples de demo pública (por IP/mês)
-_DEMO_RL: Dict[str, int] = {}
-_DEMO_RL_MAX = 5
+# rate-limit da demo pública (por IP): token bucket em Postgres, compartilhado entre workers.
+# Capacidade DEMO_RL_MAX, recarga contínua de DEMO_RL_MAX tokens por DEMO_RL_WINDOW_SECONDS.
+_DEMO_RL_MAX = int(os.environ.get("DEMO_RL_MAX", "5"))
+DEMO_RL_WINDOW_SECONDS = float(os.environ.get("DEMO_RL_WINDOW_SECONDS", str(30 * 86400)))
+RL_DENY_CACHE_TTL = float(os.environ.get("RL_DENY_CACHE_TTL", "60"))  # negações cacheadas por processo (s)
+RL_GC_PROBABILITY = 0.01  # fração das chamadas que faz limpeza de buckets cheios
 
 
 # =========================
 # App
 # =========================
 app = Flask(__name__)
-CORS(app, resources={r"/*": {"origins": ALLOWED_ORIGINS}})
+CORS(app, resources={r"/*": {"origins": ALLOWED_ORIGINS}}, expose_headers=["X-Profile-Id", "X-Profile-Status"])
 logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 
 
@@ -121,6 +205,60 @@ def _month_key(dt: Optional[datetime] = None) -> str:
     dt = dt or _now_utc()
     return dt.strftime("%Y-%m")
 
+
+class _TTLCache:
+    """LRU com TTL opcional (ttl<=0 = sem expiração), thread-safe, por processo."""
+
+    def __init__(self, maxsize: int, ttl: float = 0.0):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = float(ttl)
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Any) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            stored_at, value = item
+            if self.ttl > 0 and time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Any, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Any) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            }
+
 from zoneinfo import ZoneInfo
 
 _SP_TZ = ZoneInfo("America/Sao_Paulo")
@@ -132,62 +270,73 @@ def _sp_today_bounds_utc() -> tuple[datetime, datetime]:
     end_sp = start_sp.replace(hour=23, minute=59, second=59, microsecond=999999)
     return start_sp.astimezone(timezone.utc), end_sp.astimezone(timezone.utc)
 
-def _top_origens(client_id: str, days: int = 30, limit: int = 6):
-    """Top origens (últimos N dias) por quantidade de leads."""
-    conn = _db()
-    try:
-        with conn:
-            with conn.cursor(row_factory=dict_row) as cur:
-                cur.execute(
-                    """
-                    SELECT COALESCE(NULLIF(TRIM(origem), ''), 'desconhecida') AS origem,
-                           COUNT(*)::int AS total
-                    FROM leads
-                    WHERE client_id=%s
-                      AND created_at >= (NOW() - (%s || ' days')::interval)
-                    GROUP BY 1
-                    ORDER BY total DESC, origem ASC
-                    LIMIT %s
-                    """,
-                    (client_id, int(days), int(limit)),
-                )
-                return cur.fetchall()
-    finally:
-        conn.close()
+def _sp_today():
+    """Data de hoje em America/Sao_Paulo (mesmo calendário do rollup leads_daily_stats)."""
+    return datetime.now(_SP_TZ).date()
+
+def _top_origens_query(client_id: str, days: int = 30, limit: int = 6) -> Tuple[str, tuple]:
+    return (
+        """
+        SELECT origem, SUM(n)::int AS total
+        FROM leads_daily_stats_live
+        WHERE client_id=%s AND day >= %s
+        GROUP BY origem
+        HAVING SUM(n) > 0
+        ORDER BY total DESC, origem ASC
+        LIMIT %s
+        """,
+        (client_id, _sp_today() - timedelta(days=int(days) - 1), int(limit)),
+    )
 
-def _hot_leads_today(client_id: str, limit: int = 20):
-    """Leads quentes de hoje (probabilidade>=0.70 ou score>=70)."""
+def _hot_leads_today_query(client_id: str, limit: int = 20) -> Tuple[str, tuple]:
     start_utc, end_utc = _sp_today_bounds_utc()
+    return (
+        """
+        SELECT id, nome, telefone, email_lead, origem,
+               probabilidade, score, created_at, virou_cliente
+        FROM leads
+        WHERE client_id=%s
+          AND created_at >= %s AND created_at <= %s
+          AND (probabilidade >= 0.70 OR score >= 70)  -- = predicado de idx_leads_client_hot_created
+        ORDER BY COALESCE(probabilidade, score/100.0) DESC NULLS LAST,
+                 created_at DESC
+        LIMIT %s
+        """,
+        (client_id, start_utc, end_utc, int(limit)),
+    )
+
+def _norm_created_at(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    for r in rows:
+        r["created_at"] = _iso(r.get("created_at"))
+    return rows
+
+def _run_queries(queries: List[Tuple[str, tuple]]) -> List[List[Dict[str, Any]]]:
+    """
+    Executa várias consultas de leitura numa única conexão. Com pipeline mode (libpq >= 14)
+    os statements são enviados juntos e os resultados lidos depois: 1 round-trip de rede.
+    """
     conn = _db()
     try:
         with conn:
-            with conn.cursor(row_factory=dict_row) as cur:
-                cur.execute(
-                    """
-                    SELECT id, nome, telefone, email_lead, origem,
-                           probabilidade, score, created_at, virou_cliente
-                    FROM leads
-                    WHERE client_id=%s
-                      AND created_at >= %s AND created_at <= %s
-                      AND (
-                            (probabilidade IS NOT NULL AND probabilidade >= 0.70)
-                            OR (score IS NOT NULL AND score >= 70)
-                          )
-                    ORDER BY COALESCE(probabilidade, score/100.0) DESC NULLS LAST,
-                             created_at DESC
-                    LIMIT %s
-                    """,
-                    (client_id, start_utc, end_utc, int(limit)),
-                )
-                rows = cur.fetchall()
-                for r in rows:
-                    r["created_at"] = _iso(r.get("created_at"))
-                return rows
+            cursors = [conn.cursor(row_factory=dict_row) for _ in queries]
+            try:
+                if len(queries) > 1 and psycopg.Pipeline.is_supported():
+                    with conn.pipeline():
+                        for cur, (sql, params) in zip(cursors, queries):
+                            cur.execute(sql, params)
+                else:
+                    for cur, (sql, params) in zip(cursors, queries):
+                        cur.execute(sql, params)
+                return [[dict(r) for r in (cur.fetchall() or [])] for cur in cursors]
+            finally:
+                for cur in cursors:
+                    cur.close()
     finally:
         conn.close()
 
 def _resp(payload: Dict[str, Any], code: int = 200):
-    return jsonify(payload), code
+    with _phase("serialize"):
+        return jsonify(payload), code
 
 def _json_ok(payload: Dict[str, Any], code: int = 200):
     payload.setdefault("ok", True)
@@ -233,11 +382,449 @@ def _require_env_db():
     if not DATABASE_URL:
         raise RuntimeError("DATABASE_URL não configurada (Render Environment)")
 
+# =========================
+# Métricas (formato Prometheus, por processo)
+# =========================
+# Cada worker do gunicorn expõe os próprios números (o Prometheus soma por instância).
+# Contadores/histogramas ficam em memória; o que vem do banco (fila de jobs, estimativas
+# de leads) é lido do catálogo/índices parciais e cacheado por METRICS_DB_TTL segundos.
+METRICS_DB_TTL = float(os.environ.get("METRICS_DB_TTL", "15"))
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_METRICS_LOCK = threading.Lock()
+_COUNTERS: Dict[Tuple[str, tuple], float] = {}
+_HISTOGRAMS: Dict[Tuple[str, tuple], List[Any]] = {}  # [contagem por bucket (+Inf no fim), soma, total]
+
+_METRIC_HELP = {
+    "leadrank_http_requests_total": ("counter", "Requests HTTP por rota, método e status."),
+    "leadrank_http_request_duration_seconds": ("histogram", "Latência das requests HTTP por rota."),
+    "leadrank_db_queries_total": ("counter", "Statements enviados ao Postgres por rota."),
+    "leadrank_db_query_seconds_total": ("counter", "Tempo gasto em statements no Postgres por rota."),
+    "leadrank_ml_seconds": ("histogram", "Tempo de fit/partial_fit/predict do modelo."),
+}
+
+
+def _metric_inc(name: str, labels: tuple, value: float = 1.0) -> None:
+    key = (name, labels)
+    with _METRICS_LOCK:
+        _COUNTERS[key] = _COUNTERS.get(key, 0.0) + value
+
+
+def _metric_observe(name: str, labels: tuple, seconds: float) -> None:
+    key = (name, labels)
+    i = bisect.bisect_left(_LATENCY_BUCKETS, seconds)
+    with _METRICS_LOCK:
+        h = _HISTOGRAMS.get(key)
+        if h is None:
+            h = _HISTOGRAMS[key] = [[0] * (len(_LATENCY_BUCKETS) + 1), 0.0, 0]
+        h[0][i] += 1
+        h[1] += seconds
+        h[2] += 1
+
+
+def _metric_route() -> str:
+    """Regra do Flask (não o path, para não explodir cardinalidade); fora de request: background."""
+    if not has_request_context():
+        return "background"
+    rule = request.url_rule
+    return rule.rule if rule is not None else "unmatched"
+
+
+# estatística por statement (pg_stat_statements do lado do app, por processo)
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "200"))  # loga statements acima disso; 0 desliga
+STMT_STATS_MAX = int(os.environ.get("STMT_STATS_MAX", "500"))   # statements distintos guardados; o resto vai para "<outros>"
+_STMT_STATS: Dict[str, Dict[str, Any]] = {}
+_STMT_LOCK = threading.Lock()
+_STMT_OTHER = "<outros>"
+_SQL_COMMENT_RE = re.compile(r"--[^\n]*")
+_SQL_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%\((\w+)\)s|%s")
+_SQL_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+
+@functools.lru_cache(maxsize=2048)
+def _normalize_sql(text: str) -> str:
+    """Texto canônico: sem comentários, espaços colapsados, literais e placeholders viram ?."""
+    text = _SQL_COMMENT_RE.sub(" ", text)
+    text = _SQL_LITERAL_RE.sub("?", text)
+    text = _SQL_LIST_RE.sub("(?, ...)", text)
+    return " ".join(text.split())
+
+
+def _sql_text(query: Any, cur) -> str:
+    if isinstance(query, str):
+        return query
+    if isinstance(query, bytes):
+        return query.decode("utf-8", "replace")
+    try:
+        return query.as_string(cur.connection)  # psycopg.sql.Composable
+    except Exception:
+        return f"<{type(query).__name__}>"
+
+
+def _record_db_query(seconds: float, query: Any = None, cur=None) -> None:
+    route = _metric_route()
+    labels = (("route", route),)
+    with _METRICS_LOCK:
+        for name, v in (("leadrank_db_queries_total", 1.0), ("leadrank_db_query_seconds_total", seconds)):
+            _COUNTERS[(name, labels)] = _COUNTERS.get((name, labels), 0.0) + v
+    if has_request_context():
+        g.db_queries = getattr(g, "db_queries", 0) + 1
+        g.db_seconds = getattr(g, "db_seconds", 0.0) + seconds
+    if query is None:
+        return
+
+    norm = _normalize_sql(_sql_text(query, cur))
+    try:
+        rows = max(0, int(cur.rowcount)) if cur is not None else 0  # -1 em pipeline/sem resultado
+    except Exception:
+        rows = 0
+    with _STMT_LOCK:
+        st = _STMT_STATS.get(norm)
+        if st is None:
+            if len(_STMT_STATS) >= STMT_STATS_MAX:
+                norm = _STMT_OTHER
+                st = _STMT_STATS.get(norm)
+            if st is None:
+                st = _STMT_STATS[norm] = {"calls": 0, "total_s": 0.0, "max_s": 0.0, "rows": 0, "routes": {}}
+        st["calls"] += 1
+        st["total_s"] += seconds
+        st["max_s"] = max(st["max_s"], seconds)
+        st["rows"] += rows
+        st["routes"][route] = st["routes"].get(route, 0) + 1
+
+    if SLOW_QUERY_MS > 0 and seconds * 1000.0 >= SLOW_QUERY_MS:
+        logging.warning("slow query %.1fms route=%s rows=%s: %s", seconds * 1000.0, route, rows, norm[:1000])
+
+
+def _stmt_stats_top(n: int = 20, order: str = "total") -> List[Dict[str, Any]]:
+    with _STMT_LOCK:
+        items = [(q, dict(st, routes=dict(st["routes"]))) for q, st in _STMT_STATS.items()]
+    keys = {
+        "total": lambda it: it[1]["total_s"],
+        "mean": lambda it: it[1]["total_s"] / max(1, it[1]["calls"]),
+        "max": lambda it: it[1]["max_s"],
+        "calls": lambda it: it[1]["calls"],
+    }
+    items.sort(key=keys.get(order, keys["total"]), reverse=True)
+    out = []
+    for q, st in items[:max(1, n)]:
+        out.append({
+            "query": q,
+            "calls": st["calls"],
+            "total_ms": round(st["total_s"] * 1000.0, 3),
+            "mean_ms": round(st["total_s"] * 1000.0 / max(1, st["calls"]), 3),
+            "max_ms": round(st["max_s"] * 1000.0, 3),
+            "rows": st["rows"],
+            "rows_per_call": round(st["rows"] / max(1, st["calls"]), 2),
+            "routes": dict(sorted(st["routes"].items(), key=lambda kv: -kv[1])[:10]),
+        })
+    return out
+
+
+class _TimedCursor(psycopg.Cursor):
+    """
+    Cursor padrão das conexões do app: conta statements (execute, executemany, copy) e
+    tempo no banco por rota e agrega por statement normalizado (_STMT_STATS; lentos vão para o log).
+    Em pipeline mode o execute só enfileira (o tempo real cai no sync/fetch).
+    """
+
+    def execute(self, query, params=None, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(query, params, **kwargs)
+        finally:
+            _record_db_query(time.perf_counter() - t0, query, self)
+
+    def executemany(self, query, params_seq, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(query, params_seq, **kwargs)
+        finally:
+            _record_db_query(time.perf_counter() - t0, query, self)
+
+    @contextmanager
+    def copy(self, statement, params=None, **kwargs):
+        # COPY (ingest do /prever_batch, seed da demo): o tempo é o bloco inteiro,
+        # já que as linhas vão ao servidor dentro do with
+        t0 = time.perf_counter()
+        try:
+            with super().copy(statement, params, **kwargs) as cp:
+                yield cp
+        finally:
+            _record_db_query(time.perf_counter() - t0, statement, self)
+
+
+@contextmanager
+def _ml_timer(op: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _metric_observe("leadrank_ml_seconds", (("op", op),), time.perf_counter() - t0)
+
+
+@app.before_request
+def _metrics_start():
+    g.t0 = time.perf_counter()
+    g.db_queries = 0
+    g.db_seconds = 0.0
+    g.db_connect_seconds = 0.0
+    g.phases = {}
+
+
+@app.after_request
+def _metrics_finish(resp):
+    t0 = getattr(g, "t0", None)
+    if t0 is not None:
+        route = _metric_route()
+        elapsed = time.perf_counter() - t0
+        _metric_inc("leadrank_http_requests_total",
+                    (("route", route), ("method", request.method), ("status", str(resp.status_code))))
+        _metric_observe("leadrank_http_request_duration_seconds", (("route", route), ("method", request.method)), elapsed)
+    return resp
+
+
+# =========================
+# Server-Timing / profiling por request
+# =========================
+# Toda resposta sai com Server-Timing: db_connect, auth, sql, serialize (medidos) e
+# compute (o resto: Python da rota). auth/serialize descontam o banco feito dentro deles.
+# Admin (DEMO_KEY) + header "X-Profile: cpu|mem|all" -> cProfile e/ou tracemalloc só
+# daquela request; o relatório fica em memória (GET /admin/profiles/<id>, id no
+# header X-Profile-Id).
+PROFILE_TOP_N = int(os.environ.get("PROFILE_TOP_N", "40"))
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "50"))
+PROFILE_TTL = float(os.environ.get("PROFILE_TTL", "3600"))
+_PROFILE_LOCK = threading.Lock()  # cProfile/tracemalloc: um request perfilado por vez no processo
+_PROFILES = _TTLCache(PROFILE_KEEP, PROFILE_TTL)
+
+
+def _db_elapsed() -> float:
+    return getattr(g, "db_seconds", 0.0) + getattr(g, "db_connect_seconds", 0.0)
+
+
+@contextmanager
+def _phase(name: str):
+    """Acumula em g.phases[name] o tempo do bloco, sem o tempo de banco feito dentro dele."""
+    if not has_request_context():
+        yield
+        return
+    t0, db0 = time.perf_counter(), _db_elapsed()
+    try:
+        yield
+    finally:
+        own = (time.perf_counter() - t0) - (_db_elapsed() - db0)
+        phases = g.setdefault("phases", {})
+        phases[name] = phases.get(name, 0.0) + max(0.0, own)
+
+
+def _request_phases() -> Dict[str, float]:
+    """Fases em ms; compute = total - (db_connect + sql + auth + serialize)."""
+    total = time.perf_counter() - getattr(g, "t0", time.perf_counter())
+    phases = getattr(g, "phases", {}) or {}
+    out = {
+        "db_connect": getattr(g, "db_connect_seconds", 0.0),
+        "auth": phases.get("auth", 0.0),
+        "sql": getattr(g, "db_seconds", 0.0),
+        "serialize": phases.get("serialize", 0.0),
+    }
+    out["compute"] = max(0.0, total - sum(out.values()))
+    out["total"] = total
+    return {k: round(v * 1000.0, 3) for k, v in out.items()}
+
+
+@app.before_request
+def _profile_start():
+    mode = (request.headers.get("X-Profile") or "").strip().lower()
+    if not mode or mode in ("0", "false", "no"):
+        return
+    if not _admin_required():
+        return
+    if not _PROFILE_LOCK.acquire(blocking=False):
+        g.profile_status = "busy"
+        return
+    prof = {"mode": mode, "cpu": None, "mem": False}
+    g.profile = prof
+    if mode in ("mem", "all", "1", "true", "yes"):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            prof["mem"] = "started"
+        else:
+            prof["mem"] = "running"
+        tracemalloc.reset_peak()
+        prof["mem_before"] = tracemalloc.take_snapshot()
+    if mode in ("cpu", "all", "1", "true", "yes"):
+        prof["cpu"] = cProfile.Profile()
+        try:
+            prof["cpu"].enable()
+        except ValueError:  # outro profiler ativo no processo (ex.: py-spy/sys.monitoring)
+            prof["cpu"] = None
+
+
+def _profile_finish(resp) -> Optional[str]:
+    prof = getattr(g, "profile", None)
+    if prof is None:
+        return None
+    g.profile = None
+    try:
+        report: Dict[str, Any] = {
+            "method": request.method,
+            "path": request.path,
+            "route": _metric_route(),
+            "status": resp.status_code if resp is not None else None,
+            "mode": prof["mode"],
+            "created_at": _iso(_now_utc()),
+        }
+        if prof["cpu"] is not None:
+            prof["cpu"].disable()
+            buf = io.StringIO()
+            pstats.Stats(prof["cpu"], stream=buf).sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+            report["cpu"] = buf.getvalue()
+        if prof["mem"]:
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            diff = after.compare_to(prof["mem_before"], "lineno")
+            report["mem"] = {
+                "peak_kb": round(peak / 1024.0, 1),
+                "current_kb": round(current / 1024.0, 1),
+                # tracemalloc é global: alocações de requests concorrentes também aparecem
+                "top": [str(st) for st in diff[:PROFILE_TOP_N]],
+            }
+            if prof["mem"] == "started":
+                tracemalloc.stop()
+        pid = uuid.uuid4().hex[:16]
+        report["id"] = pid
+        report["timing_ms"] = _request_phases()
+        _PROFILES.set(pid, report)
+        return pid
+    finally:
+        _PROFILE_LOCK.release()
+
+
+@app.after_request
+def _server_timing(resp):
+    pid = _profile_finish(resp)
+    if getattr(g, "t0", None) is not None:
+        ph = _request_phases()
+        resp.headers["Server-Timing"] = ", ".join(
+            f'sql;dur={v};desc="{getattr(g, "db_queries", 0)} queries"' if k == "sql" else f"{k};dur={v}"
+            for k, v in ph.items()
+        )
+        origin = request.headers.get("Origin")
+        if origin and origin in ALLOWED_ORIGINS:
+            resp.headers["Timing-Allow-Origin"] = origin  # Server-Timing visível no devtools/JS do dashboard
+    if pid:
+        resp.headers["X-Profile-Id"] = pid
+    elif getattr(g, "profile_status", None):
+        resp.headers["X-Profile-Status"] = g.profile_status
+    return resp
+
+
+@app.teardown_request
+def _profile_cleanup(exc):
+    # resposta que não passou pelo after_request: não deixa o profiler/lock presos
+    prof = getattr(g, "profile", None)
+    if prof is not None:
+        g.profile = None
+        if prof["cpu"] is not None:
+            prof["cpu"].disable()
+        if prof["mem"] == "started":
+            tracemalloc.stop()
+        _PROFILE_LOCK.release()
+
+
+_POOL = None
+_POOL_PID = 0
+_POOL_LOCK = threading.Lock()
+
+
+class _PooledConn:
+    """
+    Conexão emprestada do pool, com a mesma interface usada nas rotas:
+      conn = _db()
+      try:
+          with conn: ...      # commit/rollback e devolve ao pool
+      finally:
+          conn.close()        # devolve ao pool (idempotente)
+    """
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = pool.getconn()
+
+    def __getattr__(self, name):
+        conn = self.__dict__.get("_conn")
+        if conn is None:
+            raise psycopg.OperationalError("the connection is closed")
+        return getattr(conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        conn = self._conn
+        if conn is None:
+            return
+        try:
+            if exc_type is None:
+                conn.commit()
+            else:
+                conn.rollback()
+        finally:
+            self.close()
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool.putconn(conn)
+
+
+def _get_pool():
+    """Pool lazy por processo (recriado após fork dos workers do gunicorn)."""
+    global _POOL, _POOL_PID
+    pid = os.getpid()
+    if _POOL is not None and _POOL_PID == pid:
+        return _POOL
+    with _POOL_LOCK:
+        if _POOL is not None and _POOL_PID == pid:
+            return _POOL
+        _POOL = ConnectionPool(
+            DATABASE_URL,
+            min_size=max(0, DB_POOL_MIN),
+            max_size=max(1, DB_POOL_MAX, DB_POOL_MIN),
+            kwargs={"row_factory": dict_row, "cursor_factory": _TimedCursor},
+            timeout=DB_POOL_TIMEOUT,
+            max_lifetime=DB_POOL_MAX_LIFETIME,
+            max_idle=DB_POOL_MAX_IDLE,
+            check=ConnectionPool.check_connection,  # health check no empréstimo
+            name="leadrank",
+            open=True,
+        )
+        _POOL_PID = pid
+        return _POOL
+
+def _pool_stats() -> Dict[str, Any]:
+    """Métricas do pool (tamanho, disponíveis, espera acumulada em ms etc.)."""
+    if not (_HAS_POOL and DB_POOL_ENABLED) or _POOL is None or _POOL_PID != os.getpid():
+        return {"enabled": bool(_HAS_POOL and DB_POOL_ENABLED), "open": False}
+    stats = dict(_POOL.get_stats())
+    n = int(stats.get("requests_num") or 0)
+    wait_ms = int(stats.get("requests_wait_ms") or 0)
+    stats["requests_wait_avg_ms"] = round(wait_ms / n, 3) if n else 0.0
+    stats.update({"enabled": True, "open": True, "min_size": _POOL.min_size, "max_size": _POOL.max_size})
+    return stats
+
 def _db():
     _require_env_db()
-    # psycopg v3 (compatível com Python 3.13 no Render)
-    # row_factory=dict_row faz fetchone/fetchall retornarem dicts (similar ao dict_row)
-    return psycopg.connect(DATABASE_URL, row_factory=dict_row)
+    t0 = time.perf_counter()
+    try:
+        if _HAS_POOL and DB_POOL_ENABLED:
+            return _PooledConn(_get_pool())
+        # psycopg v3 (compatível com Python 3.13 no Render)
+        # row_factory=dict_row faz fetchone/fetchall retornarem dicts (similar ao dict_row)
+        return psycopg.connect(DATABASE_URL, row_factory=dict_row, cursor_factory=_TimedCursor)
+    finally:
+        if has_request_context():
+            g.db_connect_seconds = getattr(g, "db_connect_seconds", 0.0) + (time.perf_counter() - t0)
 
 def _sha256(s: str) -> str:
     return hashlib.sha256(s.encode("utf-8")).hexdigest()
@@ -294,9 +881,92 @@ def _check_demo_key() -> bool:
     return ok
 
 
+# =========================
+# ML (import lazy) / relatório de boot
+# =========================
+_ML_STATE: Dict[str, Any] = {"loaded": False, "failed": False, "available": None, "error": "", "import_ms": None}
+_ML_LOCK = threading.Lock()
+
+
+def _ml_available() -> bool:
+    """ML habilitado neste processo e instalado (sem importar nada: find_spec)."""
+    if _ML_STATE["loaded"]:
+        return True
+    if not ML_ENABLED or _ML_STATE["failed"]:
+        return False
+    if _ML_STATE["available"] is None:
+        _ML_STATE["available"] = all(importlib.util.find_spec(m) is not None for m in ("numpy", "sklearn"))
+    return bool(_ML_STATE["available"])
+
+
+def _load_ml() -> bool:
+    """Importa numpy/sklearn uma vez por processo (thread-safe). False se desligado/ausente."""
+    global np, sklearn, LogisticRegression, SGDClassifier, StandardScaler, Pipeline
+    if _ML_STATE["loaded"]:
+        return True
+    if not ML_ENABLED or _ML_STATE["failed"]:
+        return False
+    with _ML_LOCK:
+        if _ML_STATE["loaded"]:
+            return True
+        if _ML_STATE["failed"]:
+            return False
+        t0 = time.perf_counter()
+        try:
+            import numpy as np
+            import sklearn
+            from sklearn.linear_model import LogisticRegression, SGDClassifier
+            from sklearn.preprocessing import StandardScaler
+            from sklearn.pipeline import Pipeline
+        except Exception as e:
+            _ML_STATE.update(failed=True, error=repr(e))
+            logging.warning("ML indisponível: %r", e)
+            return False
+        _ML_STATE.update(loaded=True, import_ms=round((time.perf_counter() - t0) * 1000, 1))
+        logging.info("ML carregado em %.1f ms", _ML_STATE["import_ms"])
+        return True
+
+
+def _require_ml() -> None:
+    if not _load_ml():
+        raise RuntimeError("ML indisponível neste processo: " + (_ML_STATE["error"] or f"APP_PROFILE={APP_PROFILE}"))
+
+
+def _ml_unavailable():
+    if not ML_ENABLED:
+        return _json_err("ML desativado neste processo (APP_PROFILE=ingest).", 501, code="ml_disabled")
+    return _json_err("Dependências ML ausentes (numpy/scikit-learn).", 501, code="ml_missing")
+
+
+def _rss_kb() -> Optional[int]:
+    try:
+        import resource
+        return int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)  # KB no Linux
+    except Exception:
+        return None
+
+
+_BOOT: Dict[str, Any] = {}
+
+
+def _boot_report() -> Dict[str, Any]:
+    """Tempo de import do app (medido na subida), perfil, estado do ML e pico de RSS do processo."""
+    return {
+        "profile": APP_PROFILE,
+        "app_import_ms": _BOOT.get("app_import_ms"),
+        "ml_loaded": _ML_STATE["loaded"],
+        "ml_import_ms": _ML_STATE["import_ms"],
+        "ml_error": _ML_STATE["error"] or None,
+        "max_rss_kb": _rss_kb(),
+        "modules_loaded": len(sys.modules),
+        "pid": os.getpid(),
+    }
+
+
 # =========================
 # Schema / Migrations (auto)
 # =========================
+
 _SCHEMA_READY = False
 _SCHEMA_LOCK = None  # lazy lock
 
@@ -306,7 +976,6 @@ def _ensure_schema_once() -> Tuple[bool, str]:
     if _SCHEMA_READY:
         return True, ""
     if _SCHEMA_LOCK is None:
-        import threading
         _SCHEMA_LOCK = threading.Lock()
     with _SCHEMA_LOCK:
         if _SCHEMA_READY:
@@ -319,170 +988,16 @@ def _ensure_schema_once() -> Tuple[bool, str]:
             return False, repr(e)
 
 
-def _ensure_schema():
+def _ensure_schema() -> int:
     """
-    Cria/migra tabelas para ser compatível com:
-    - versões antigas com leads em colunas "nome/email/telefone/..."
-    - versões novas com payload JSONB, score/label/updated_at
-    - clients antigos com api_key NOT NULL (corrigimos)
+    Confere schema_version (um SELECT) e, se o banco estiver atrás, aplica as
+    migrações de migrations.py sob advisory lock (só um worker migra; os outros
+    esperam e reconferem). Conexão dedicada em autocommit, fora do pool.
     """
-    conn = _db()
+    _require_env_db()
+    conn = migrations.connect(DATABASE_URL)
     try:
-        with conn:
-            with conn.cursor() as cur:
-                # -------------------------
-                # LEADS
-                # -------------------------
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS leads (
-                        id BIGSERIAL PRIMARY KEY,
-                        client_id TEXT NOT NULL,
-                        -- colunas "clássicas" (dashboard atual)
-                        nome TEXT,
-                        email_lead TEXT,
-                        telefone TEXT,
-                        origem TEXT,
-                        tempo_site INTEGER,
-                        paginas_visitadas INTEGER,
-                        clicou_preco INTEGER,
-                        probabilidade DOUBLE PRECISION,
-                        virou_cliente DOUBLE PRECISION,
-                        -- colunas "SaaS" (futuro)
-                        payload JSONB NOT NULL DEFAULT '{}'::jsonb,
-                        score INTEGER,
-                        label INTEGER,
-                        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-                        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-                    );
-                """)
-                cur.execute("CREATE INDEX IF NOT EXISTS idx_leads_client_created ON leads(client_id, created_at DESC);")
-                cur.execute("CREATE INDEX IF NOT EXISTS idx_leads_client_label ON leads(client_id, virou_cliente);")
-
-                # migrações (se leads já existia)
-                cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS client_id TEXT;")
-                cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS nome TEXT;")
-                cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS email_lead TEXT;")
-                cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS telefone TEXT;")
-                cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS origem TEXT;")
-                cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS tempo_site INTEGER;")
-                cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS paginas_visitadas INTEGER;")
-                cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS clicou_preco INTEGER;")
-                cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS probabilidade DOUBLE PRECISION;")
-                cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS virou_cliente DOUBLE PRECISION;")
-                cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS payload JSONB NOT NULL DEFAULT '{}'::jsonb;")
-                cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS score INTEGER;")
-                cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS label INTEGER;")
-                cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT NOW();")
-                cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW();")
-
-                # -------------------------
-                # CLIENTS
-                # -------------------------
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS clients (
-                        client_id TEXT PRIMARY KEY,
-                        -- perfil (opcional, usado no /signup)
-                        nome TEXT,
-                        email TEXT,
-                        empresa TEXT,
-                        telefone TEXT,
-                        valid_until TIMESTAMPTZ,
-                        password_hash TEXT,
-                        last_login_at TIMESTAMPTZ,
-                        -- auth / plan
-                        api_key TEXT,
-                        plan TEXT NOT NULL DEFAULT 'trial',
-                        status TEXT NOT NULL DEFAULT 'active',
-                        -- uso mensal
-                        usage_month TEXT NOT NULL DEFAULT '',
-                        leads_used_month INTEGER NOT NULL DEFAULT 0,
-                        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-                        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-                    );
-                """)
-
-                cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS api_key TEXT;")
-                cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS nome TEXT;")
-                cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS email TEXT;")
-                cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS empresa TEXT;")
-                cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS telefone TEXT;")
-                cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS valid_until TIMESTAMPTZ;")
-                cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS password_hash TEXT;")
-                cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS last_login_at TIMESTAMPTZ;")
-
-                # bancos antigos podem ter api_key NOT NULL -> drop
-                try:
-                    cur.execute("ALTER TABLE clients ALTER COLUMN api_key DROP NOT NULL;")
-                except Exception:
-                    pass
-
-                cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS plan TEXT NOT NULL DEFAULT 'trial';")
-                cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS status TEXT NOT NULL DEFAULT 'active';")
-                cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS usage_month TEXT;")
-                cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS leads_used_month INTEGER NOT NULL DEFAULT 0;")
-                cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT NOW();")
-                cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW();")
-
-                mk = _month_key()
-                # normaliza NULLs antigos
-                cur.execute("UPDATE clients SET usage_month=%s WHERE usage_month IS NULL OR usage_month='';", (mk,))
-                cur.execute("UPDATE clients SET api_key='' WHERE api_key IS NULL;")
-                cur.execute("UPDATE clients SET updated_at=NOW() WHERE updated_at IS NULL;")
-
-                cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_clients_api_key ON clients(api_key) WHERE api_key <> '';")
-                try:
-                    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_clients_email_unique ON clients(email) WHERE email IS NOT NULL AND email<>'';")
-                except Exception:
-                    pass
-                cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_clients_email ON clients(email) WHERE email IS NOT NULL AND email <> '';")
-
-                # -------------------------
-                # THRESHOLDS / MODEL_META (para insights/treino)
-                # -------------------------
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS thresholds (
-                        client_id TEXT PRIMARY KEY,
-                        threshold DOUBLE PRECISION NOT NULL,
-                        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-                    );
-                """)
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS model_meta (
-                        client_id TEXT PRIMARY KEY,
-                        can_train BOOLEAN NOT NULL DEFAULT FALSE,
-                        labeled_count INTEGER NOT NULL DEFAULT 0,
-                        classes_rotuladas TEXT NOT NULL DEFAULT '[]',
-                        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-                    );
-                """)
-                # -------------------------
-                # SUBSCRIPTIONS / BILLING EVENTS (Premium/Billing)
-                # -------------------------
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS subscriptions (
-                        client_id TEXT PRIMARY KEY,
-                        provider TEXT NOT NULL DEFAULT 'manual',
-                        status TEXT NOT NULL DEFAULT 'inactive',
-                        plan TEXT NOT NULL DEFAULT 'trial',
-                        current_period_start TIMESTAMPTZ,
-                        current_period_end TIMESTAMPTZ,
-                        cancel_at_period_end BOOLEAN NOT NULL DEFAULT FALSE,
-                        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-                    );
-                """)
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS billing_events (
-                        id BIGSERIAL PRIMARY KEY,
-                        provider TEXT NOT NULL DEFAULT 'manual',
-                        event_type TEXT NOT NULL,
-                        client_id TEXT,
-                        payload JSONB NOT NULL DEFAULT '{}'::jsonb,
-                        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-                    );
-                """)
-                cur.execute("CREATE INDEX IF NOT EXISTS idx_billing_events_client_created ON billing_events(client_id, created_at DESC);")
-
-
+        return migrations.ensure_schema(conn, auto_migrate=AUTO_MIGRATE)
     finally:
         conn.close()
 
@@ -541,61 +1056,456 @@ def _ensure_client_row(client_id: str, plan: str = "trial") -> Dict[str, Any]:
         conn.close()
 
 
-def _require_client_auth(client_id: str) -> Tuple[bool, Dict[str, Any], str]:
+# -------------------------
+# Workspace context cache
+# -------------------------
+_WS_CACHE = _TTLCache(WS_CACHE_MAX, WS_CACHE_TTL)
+
+def _ws_ctx_from_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Recorte do row de clients que vale cachear (sem api_key/senha em claro)."""
+    api_key = (row.get("api_key") or "").strip()
+    return {
+        "client_id": row.get("client_id"),
+        "plan": (row.get("plan") or "trial"),
+        "status": (row.get("status") or "active"),
+        "usage_month": (row.get("usage_month") or ""),
+        "api_key_hash": _sha256(api_key) if api_key else "",
+    }
+
+def _read_workspace_row(client_id: str) -> Optional[Dict[str, Any]]:
+    """Leitura sem lock de clients + threshold (caminho de rotas read-only)."""
+    _ensure_schema_once()
+    conn = _db()
+    try:
+        with conn:
+            with conn.cursor(row_factory=dict_row) as cur:
+                cur.execute(
+                    """
+                    SELECT c.client_id, c.api_key, c.plan, c.status, c.usage_month, c.leads_used_month,
+                           t.threshold
+                    FROM clients c
+                    LEFT JOIN thresholds t ON t.client_id = c.client_id
+                    WHERE c.client_id=%s
+                    """,
+                    (client_id,),
+                )
+                row = cur.fetchone()
+                return dict(row) if row else None
+    finally:
+        conn.close()
+
+def _workspace_ctx(client_id: str, fresh: bool = False) -> Dict[str, Any]:
+    """
+    Contexto do workspace (plan, status, uso do mês, hash da api_key, threshold).
+    - fresh=False: cache -> SELECT sem lock; só cai no _ensure_client_row (INSERT + FOR UPDATE)
+      se o client não existe ou o mês virou.
+    - fresh=True: sempre via _ensure_client_row (relê com lock; a cota em si fica em quota_usage).
+    """
+    mk = _month_key()
+    if not fresh:
+        ctx = _WS_CACHE.get(client_id)
+        if ctx is not None and ctx["usage_month"] == mk:
+            return ctx
+        row = _read_workspace_row(client_id)
+        if row is not None and (row.get("usage_month") or "").strip() == mk and row.get("api_key") is not None:
+            ctx = _ws_ctx_from_row(row)
+            ctx["threshold"] = float(row["threshold"]) if row.get("threshold") is not None else DEFAULT_THRESHOLD
+            _WS_CACHE.set(client_id, ctx)
+            return ctx
+
+    prev = _WS_CACHE.get(client_id)
+    ctx = _ws_ctx_from_row(_ensure_client_row(client_id, plan="trial"))
+    if prev is not None and "threshold" in prev:
+        ctx["threshold"] = prev["threshold"]
+    _WS_CACHE.set(client_id, ctx)
+    return ctx
+
+def _invalidate_workspace(client_id: Optional[str] = None) -> None:
+    """Descarta o contexto cacheado (None = todos). Local ao processo; os demais expiram pelo TTL."""
+    if client_id is None:
+        _WS_CACHE.clear()
+    else:
+        _WS_CACHE.pop(client_id)
+
+
+def _require_client_auth(client_id: str, fresh: bool = False) -> Tuple[bool, Dict[str, Any], str]:
     """
     Regra:
     - se o client não tem api_key (vazio), aceita sem header (compatibilidade)
     - se tem api_key, exige X-API-KEY ou Authorization: Bearer
+    Usa o contexto cacheado do workspace; fresh=True relê com lock.
     """
-    row = _ensure_client_row(client_id, plan="trial")
-    expected = (row.get("api_key") or "").strip()
-    if not expected:
+    with _phase("auth"):
+        row = dict(_workspace_ctx(client_id, fresh=fresh))
+        expected_hash = row.pop("api_key_hash", "")
+        if not expected_hash:
+            return True, row, ""
+
+        got = _get_api_key_from_headers()
+        if not got:
+            data = request.get_json(silent=True) or {}
+            got = (data.get("api_key") or "").strip()
+
+        if not got or not hmac.compare_digest(_sha256(got), expected_hash):
+            return False, row, "api_key inválida ou ausente."
         return True, row, ""
 
-    got = _get_api_key_from_headers()
-    if not got:
-        data = request.get_json(silent=True) or {}
-        got = (data.get("api_key") or "").strip()
 
-    if got != expected:
-        return False, row, "api_key inválida ou ausente."
-    return True, row, ""
+# -------------------------
+# Cota mensal (contadores por shard em quota_usage, ver migrations._m010_quota_usage)
+# -------------------------
+# Cada (client_id, mês) tem QUOTA_SHARDS linhas; a soma dos caps é o limite do plano.
+# A reserva pega uma shard com folga que ninguém está usando (SKIP LOCKED), então
+# ingest concorrente do mesmo workspace não fila numa row só, e nenhuma shard passa
+# do cap: o limite do PLAN_CATALOG vale exato. A reserva roda na transação do INSERT
+# (rollback devolve a cota). clients.leads_used_month fica só como espelho legado.
+QUOTA_SHARDS = max(1, int(os.environ.get("QUOTA_SHARDS", "8")))
+
+# limite por plano como jsonb: a reserva lê o plano atual de clients no mesmo statement
+_PLAN_LIMITS_JSON = json.dumps({p: int(m.get("lead_limit_month") or 0) for p, m in PLAN_CATALOG.items()})
+
+_QUOTA_TAKE_SQL = """
+    WITH lim AS (
+        SELECT COALESCE((%(limits)s::jsonb ->> lower(COALESCE(NULLIF(trim(c.plan), ''), 'trial')))::int,
+                        %(default_limit)s) AS total
+        FROM clients c
+        WHERE c.client_id = %(client_id)s
+    ),
+    pick AS (
+        SELECT q.shard, q.used, q.cap
+        FROM quota_usage q
+        JOIN lim ON lim.total = q.limit_total
+        WHERE q.client_id = %(client_id)s AND q.month = %(month)s
+          AND (q.cap IS NULL OR q.used < q.cap)
+          {pick}
+    )
+    UPDATE quota_usage q
+    SET used = pick.used + LEAST(%(n)s, COALESCE(pick.cap - pick.used, %(n)s)), updated_at = NOW()
+    FROM pick
+    WHERE q.client_id = %(client_id)s AND q.month = %(month)s AND q.shard = pick.shard
+    RETURNING q.shard, q.used - pick.used AS taken
+"""
+# caminho normal: shard livre a partir de um ponto aleatório, sem esperar ninguém
+_QUOTA_TAKE_SKIP_SQL = _QUOTA_TAKE_SQL.format(
+    pick="ORDER BY (q.shard + %(start)s) %% %(shards)s LIMIT 1 FOR UPDATE OF q SKIP LOCKED"
+)
+# sobra cota só em shards ocupadas: espera, mas só em shard acima das que já segura
+# (locks sempre em ordem crescente de shard -> reservas concorrentes não entram em deadlock)
+_QUOTA_TAKE_WAIT_SQL = _QUOTA_TAKE_SQL.format(
+    pick="AND q.shard > %(after)s ORDER BY q.shard LIMIT 1 FOR UPDATE OF q"
+)
+
+# usado no mês (fallback: contador legado de clients antes da primeira reserva)
+_QUOTA_USED_SQL = """
+    SELECT COALESCE(
+        (SELECT SUM(used) FROM quota_usage WHERE client_id=%s AND month=%s),
+        (SELECT leads_used_month FROM clients WHERE client_id=%s AND usage_month=%s),
+        0
+    )::bigint AS used
+"""
+
+
+class _QuotaExceeded(Exception):
+    """Reserva parcial numa operação tudo-ou-nada: sai do `with conn:` e o rollback devolve."""
+
+    def __init__(self, info: Dict[str, Any]):
+        super().__init__("plan_limit")
+        self.info = info
+
+
+def _plan_limit(plan: Optional[str]) -> int:
+    plan = (plan or "trial").strip().lower()
+    return int(PLAN_CATALOG.get(plan, PLAN_CATALOG["trial"]).get("lead_limit_month") or 0)
+
+
+def _quota_caps(used: List[int], limit: int) -> List[Optional[int]]:
+    """Distribui a folga (limit - usado) entre as shards; soma dos caps = limit (ou = usado, se já passou)."""
+    if limit <= 0:
+        return [None] * len(used)
+    free = max(0, limit - sum(used))
+    k = len(used)
+    return [u + free // k + (1 if i < free % k else 0) for i, u in enumerate(used)]
+
+
+def _quota_write(cur, client_id: str, month: str, used: List[int], limit: int) -> None:
+    caps = _quota_caps(used, limit)
+    cur.execute(
+        """
+        INSERT INTO quota_usage (client_id, month, shard, used, cap, limit_total)
+        SELECT %s, %s, s.shard, s.used, s.cap, %s
+        FROM unnest(%s::int[], %s::int[], %s::int[]) AS s(shard, used, cap)
+        ON CONFLICT (client_id, month, shard)
+        DO UPDATE SET used = EXCLUDED.used, cap = EXCLUDED.cap, limit_total = EXCLUDED.limit_total, updated_at = NOW()
+        """,
+        (client_id, month, limit, list(range(len(used))), used, caps),
+    )
+
 
+def _quota_sync(cur, client_id: str, month: str, may_lock: bool = True) -> Dict[str, Any]:
+    """
+    Caminho lento da reserva: cria as shards do mês (herdando o contador legado) ou
+    redistribui os caps se o plano mudou. Retorna plano/limite/usado/folga.
+    may_lock=False (transação já segura alguma shard): não redistribui, só lê.
+    """
+    cur.execute("SELECT plan, usage_month, leads_used_month FROM clients WHERE client_id=%s", (client_id,))
+    client = cur.fetchone() or {}
+    plan = (client.get("plan") or "trial").strip().lower()
+    limit = _plan_limit(plan)
+
+    cur.execute(
+        "SELECT shard, used, limit_total FROM quota_usage WHERE client_id=%s AND month=%s ORDER BY shard",
+        (client_id, month),
+    )
+    rows = cur.fetchall()
+    changed = False
+    if not rows:
+        legacy = int(client.get("leads_used_month") or 0) if (client.get("usage_month") or "") == month else 0
+        caps = _quota_caps([legacy] + [0] * (QUOTA_SHARDS - 1), limit)
+        cur.execute(
+            """
+            INSERT INTO quota_usage (client_id, month, shard, used, cap, limit_total)
+            SELECT %s, %s, s.shard, s.used, s.cap, %s
+            FROM unnest(%s::int[], %s::int[], %s::int[]) AS s(shard, used, cap)
+            ON CONFLICT (client_id, month, shard) DO NOTHING
+            """,
+            (client_id, month, limit, list(range(QUOTA_SHARDS)), [legacy] + [0] * (QUOTA_SHARDS - 1), caps),
+        )
+        used, changed = legacy, True
+    elif may_lock and any(int(r["limit_total"]) != limit for r in rows):
+        # plano mudou: trava as shards do mês e redistribui a folga do novo limite
+        cur.execute(
+            "SELECT shard, used FROM quota_usage WHERE client_id=%s AND month=%s ORDER BY shard FOR UPDATE",
+            (client_id, month),
+        )
+        locked = cur.fetchall()
+        _quota_write(cur, client_id, month, [int(r["used"]) for r in locked], limit)
+        used, changed = sum(int(r["used"]) for r in locked), True
+    else:
+        used = sum(int(r["used"]) for r in rows)
+    return {
+        "plan": plan,
+        "limit": limit,
+        "used": used,
+        "free": None if limit <= 0 else max(0, limit - used),
+        "changed": changed,
+    }
 
-def _check_quota_and_bump(client_id: str, client_row: Dict[str, Any]) -> Tuple[bool, str, Dict[str, Any]]:
-    """Valida limite do plan e incrementa leads_used_month (chamar após inserir lead)."""
-    plan = (client_row.get("plan") or "trial").strip().lower()
-    meta = PLAN_CATALOG.get(plan, PLAN_CATALOG["trial"])
-    used = int(client_row.get("leads_used_month") or 0)
-    limit = int(meta.get("lead_limit_month") or 0)
 
-    if limit > 0 and used >= limit:
-        return False, "Limite mensal atingido. Faça upgrade para continuar.", {
-            "code": "plan_limit",
-            "plan": plan,
-            "used": used,
-            "limit": limit,
-            "price_brl_month": meta.get("price_brl_month"),
-            "setup_fee_brl": meta.get("setup_fee_brl", 0),
-        }
+def _quota_take(cur, client_id: str, n: int = 1) -> Tuple[int, Dict[str, Any]]:
+    """
+    Reserva até n leads da cota do mês na transação de `cur` (commit confirma,
+    rollback devolve). Retorna (concedido, info); info tem plan/limit/used quando a
+    reserva não coube inteira (para a resposta 402).
+    """
+    month = _month_key()
+    params = {
+        "limits": _PLAN_LIMITS_JSON,
+        "default_limit": _plan_limit("trial"),
+        "client_id": client_id,
+        "month": month,
+        "shards": QUOTA_SHARDS,
+    }
+    granted = 0
+    held = -1  # maior shard travada por esta transação
+    state: Dict[str, Any] = {}
+    for _ in range(2 * QUOTA_SHARDS + 4):
+        if granted >= n:
+            break
+        params.update(n=n - granted, start=random.randrange(QUOTA_SHARDS), after=held)
+        cur.execute(_QUOTA_TAKE_SKIP_SQL, params)
+        row = cur.fetchone()
+        if row is None:
+            state = _quota_sync(cur, client_id, month, may_lock=held < 0)
+            if state["changed"]:
+                continue
+            if state["free"] is not None and state["free"] <= 0:
+                break
+            cur.execute(_QUOTA_TAKE_WAIT_SQL, params)
+            row = cur.fetchone()
+            if row is None:
+                continue
+        granted += int(row["taken"])
+        held = max(held, int(row["shard"]))
+    if granted < n and not state:
+        state = _quota_sync(cur, client_id, month, may_lock=False)
+    if state:
+        state["used"] = _quota_used(client_id, cur=cur)
+    return granted, state
+
+
+def _quota_used(client_id: str, cur=None) -> int:
+    mk = _month_key()
+    params = (client_id, mk, client_id, mk)
+    if cur is not None:
+        cur.execute(_QUOTA_USED_SQL, params)
+        return int((cur.fetchone() or {}).get("used") or 0)
+    conn = _db()
+    try:
+        with conn:
+            with conn.cursor(row_factory=dict_row) as c:
+                c.execute(_QUOTA_USED_SQL, params)
+                return int((c.fetchone() or {}).get("used") or 0)
+    finally:
+        conn.close()
+
+
+def _plan_limit_error(plan: str, used: int, limit: int):
+    cat = PLAN_CATALOG.get(plan, PLAN_CATALOG["trial"])
+    return _json_err("Limite mensal atingido. Faça upgrade para continuar.", 402,
+                     code="plan_limit", plan=plan, used=used, limit=limit,
+                     price_brl_month=cat.get("price_brl_month"), setup_fee_brl=cat.get("setup_fee_brl", 0))
+
+
+def _month_bounds_utc(month: str) -> Tuple[datetime, datetime]:
+    start = datetime.strptime(month, "%Y-%m").replace(tzinfo=timezone.utc)
+    end = (start + timedelta(days=32)).replace(day=1)
+    return start, end
+
 
+def _quota_reconcile(client_id: str, month: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Recalcula o uso do mês a partir de leads (COUNT no intervalo do mês, poda de
+    partição) e reescreve as shards. As shards ficam travadas durante a contagem:
+    reservas em andamento terminam antes e as novas esperam, então o número bate.
+    """
+    month = month or _month_key()
+    start, end = _month_bounds_utc(month)
+    _ensure_schema_once()
     conn = _db()
     try:
         with conn:
-            with conn.cursor() as cur:
+            with conn.cursor(row_factory=dict_row) as cur:
+                cur.execute("SELECT plan FROM clients WHERE client_id=%s", (client_id,))
+                plan = ((cur.fetchone() or {}).get("plan") or "trial").strip().lower()
+                limit = _plan_limit(plan)
                 cur.execute(
-                    "UPDATE clients SET leads_used_month = leads_used_month + 1, updated_at=NOW() WHERE client_id=%s",
-                    (client_id,),
+                    "SELECT shard, used FROM quota_usage WHERE client_id=%s AND month=%s ORDER BY shard FOR UPDATE",
+                    (client_id, month),
+                )
+                before = sum(int(r["used"]) for r in cur.fetchall())
+                cur.execute(
+                    "SELECT COUNT(*)::bigint AS n FROM leads WHERE client_id=%s AND created_at >= %s AND created_at < %s",
+                    (client_id, start, end),
+                )
+                actual = int(cur.fetchone()["n"])
+                cur.execute("DELETE FROM quota_usage WHERE client_id=%s AND month=%s", (client_id, month))
+                _quota_write(cur, client_id, month, [actual] + [0] * (QUOTA_SHARDS - 1), limit)
+                if month == _month_key():
+                    cur.execute(
+                        "UPDATE clients SET usage_month=%s, leads_used_month=%s, updated_at=NOW() WHERE client_id=%s",
+                        (month, actual, client_id),
+                    )
+        _invalidate_workspace(client_id)
+        return {"client_id": client_id, "month": month, "plan": plan, "limit": limit,
+                "before": before, "after": actual, "drift": actual - before}
+    finally:
+        conn.close()
+
+
+def _quota_reconcile_all(month: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Reconcilia todo workspace com shards no mês (um por transação)."""
+    month = month or _month_key()
+    conn = _db()
+    try:
+        with conn:
+            with conn.cursor(row_factory=dict_row) as cur:
+                cur.execute(
+                    """
+                    SELECT client_id FROM quota_usage WHERE month=%s
+                    UNION
+                    SELECT client_id FROM clients WHERE usage_month=%s AND leads_used_month > 0
+                    ORDER BY client_id
+                    """,
+                    (month, month),
+                )
+                ids = [r["client_id"] for r in cur.fetchall()]
+    finally:
+        conn.close()
+    return [_quota_reconcile(cid, month) for cid in ids]
+
+
+# -------------------------
+# Versão do workspace / ETag (conditional GET)
+# -------------------------
+def _bump_workspace_version(cur, client_id: str) -> None:
+    """Incrementa a versão do workspace (mudanças fora de leads: threshold, plan, status)."""
+    cur.execute(
+        """
+        INSERT INTO workspace_versions (client_id, version, updated_at)
+        VALUES (%s, 1, NOW())
+        ON CONFLICT (client_id)
+        DO UPDATE SET version = workspace_versions.version + 1, updated_at = NOW()
+        """,
+        (client_id,),
+    )
+
+def _workspace_version(client_id: str) -> str:
+    """
+    Versão consolidada + deltas do rollup ainda não compactados, num snapshot só. Entre
+    compactações a contagem de deltas só cresce; a compactação apaga deltas e sobe a
+    versão na mesma transação. Qualquer escrita em leads muda o par.
+    """
+    conn = _db()
+    try:
+        with conn:
+            with conn.cursor(row_factory=dict_row) as cur:
+                cur.execute(
+                    """
+                    SELECT COALESCE((SELECT version FROM workspace_versions WHERE client_id=%s), 0) AS version,
+                           (SELECT COUNT(*) FROM leads_daily_stats_delta WHERE client_id=%s) AS pending
+                    """,
+                    (client_id, client_id),
                 )
-        return True, "", {}
+                row = cur.fetchone()
+                return f"{int(row['version'])}.{int(row['pending'])}"
     finally:
         conn.close()
 
+def _etag_cached(view):
+    """
+    Conditional GET para rotas de leitura por workspace. O ETag combina a versão do
+    workspace (deltas de insert de lead, rótulo, probabilidade; threshold, plan),
+    a rota + query string e o dia/mês corrente em America/Sao_Paulo. If-None-Match
+    igual -> 304 sem rodar as consultas. Só responde 304 depois da auth.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        client_id = (request.args.get("client_id") or "").strip()
+        if not client_id:
+            return view(*args, **kwargs)
+        ok_auth, _, _ = _require_client_auth(client_id)
+        if not ok_auth:
+            return view(*args, **kwargs)
+        try:
+            version = _workspace_version(client_id)
+        except Exception:
+            _log_exception("falha ao ler workspace_versions; seguindo sem ETag")
+            return view(*args, **kwargs)
+
+        raw = f"{client_id}|{version}|{request.full_path}|{_sp_today().isoformat()}"
+        etag = _sha256(raw)[:32]
+        cache_headers = {"Cache-Control": "private, no-cache"}
+        if request.if_none_match.contains_weak(etag):
+            resp = Response(status=304, headers=cache_headers)
+            resp.set_etag(etag, weak=True)
+            return resp
+
+        # o contexto carregado na auth acima serve à view (quem muda plan/threshold já invalida)
+        resp = app.make_response(view(*args, **kwargs))
+        if resp.status_code == 200:
+            resp.set_etag(etag, weak=True)
+            resp.headers.update(cache_headers)
+        return resp
+    return wrapper
+
 
 # =========================
 # Threshold helpers
 # =========================
 def _get_threshold(client_id: str) -> float:
+    ctx = _WS_CACHE.get(client_id)
+    if ctx is not None and ctx.get("threshold") is not None:
+        return float(ctx["threshold"])
     _ensure_schema_once()
     conn = _db()
     try:
@@ -603,9 +1513,10 @@ def _get_threshold(client_id: str) -> float:
             with conn.cursor(row_factory=dict_row) as cur:
                 cur.execute("SELECT threshold FROM thresholds WHERE client_id=%s", (client_id,))
                 row = cur.fetchone()
-                if row and row.get("threshold") is not None:
-                    return float(row["threshold"])
-        return DEFAULT_THRESHOLD
+                threshold = float(row["threshold"]) if row and row.get("threshold") is not None else DEFAULT_THRESHOLD
+        if ctx is not None:
+            ctx["threshold"] = threshold
+        return threshold
     finally:
         conn.close()
 
@@ -624,6 +1535,8 @@ def _set_threshold(client_id: str, threshold: float):
                     """,
                     (client_id, float(threshold)),
                 )
+                _bump_workspace_version(cur, client_id)
+        _invalidate_workspace(client_id)
     finally:
         conn.close()
 
@@ -631,26 +1544,59 @@ def _set_threshold(client_id: str, threshold: float):
 # =========================
 # Lead fetch / ML helpers
 # =========================
-def _fetch_recent_leads(client_id: str, limit: int = DEFAULT_LIMIT) -> List[Dict[str, Any]]:
-    _ensure_schema_once()
-    conn = _db()
+def _recent_leads_query(client_id: str, limit: int = DEFAULT_LIMIT,
+                        filters: Optional[Dict[str, Any]] = None,
+                        after: Optional[Tuple[datetime, int]] = None) -> Tuple[str, tuple]:
+    """
+    Leads mais recentes em ordem (created_at, id) DESC.
+    filters: origem, min_prob, max_prob, status (ver _STATUS_FILTERS), since, until.
+    after: chave (created_at, id) do último item da página anterior (keyset).
+    """
+    filters = filters or {}
+    where = ["client_id=%s"]
+    params: List[Any] = [client_id]
+    origem = filters.get("origem")
+    if origem:
+        if origem == "desconhecida":
+            where.append("(origem IS NULL OR TRIM(origem) = '' OR origem = 'desconhecida')")
+        else:
+            where.append("origem = %s"); params.append(origem)
+    if filters.get("min_prob") is not None:
+        where.append("probabilidade >= %s"); params.append(float(filters["min_prob"]))
+    if filters.get("max_prob") is not None:
+        where.append("probabilidade <= %s"); params.append(float(filters["max_prob"]))
+    if filters.get("status"):
+        where.append(_STATUS_FILTERS[filters["status"]])
+    if filters.get("since"):
+        where.append("created_at >= %s"); params.append(filters["since"])
+    if filters.get("until"):
+        where.append("created_at < %s"); params.append(filters["until"])
+    if after:
+        where.append("(created_at, id) < (%s, %s)"); params.extend([after[0], int(after[1])])
+    params.append(int(limit))
+    return (
+        f"""
+        SELECT id, client_id, nome, email_lead, telefone, tempo_site, paginas_visitadas, clicou_preco,
+               probabilidade, virou_cliente, created_at
+        FROM leads
+        WHERE {' AND '.join(where)}
+        ORDER BY created_at DESC, id DESC
+        LIMIT %s
+        """,
+        tuple(params),
+    )
+
+def _encode_cursor(created_at: datetime, lead_id: int) -> str:
+    raw = f"{created_at.isoformat()}|{int(lead_id)}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def _decode_cursor(cursor: str) -> Tuple[datetime, int]:
     try:
-        with conn:
-            with conn.cursor(row_factory=dict_row) as cur:
-                cur.execute(
-                    """
-                    SELECT id, client_id, nome, email_lead, telefone, tempo_site, paginas_visitadas, clicou_preco,
-                           probabilidade, virou_cliente, created_at
-                    FROM leads
-                    WHERE client_id=%s
-                    ORDER BY created_at DESC
-                    LIMIT %s
-                    """,
-                    (client_id, int(limit)),
-                )
-                return [dict(r) for r in (cur.fetchall() or [])]
-    finally:
-        conn.close()
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        ts, lead_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(ts), int(lead_id)
+    except Exception:
+        raise ValueError("cursor inválido")
 
 def _count_status(rows: List[Dict[str, Any]]) -> Tuple[int, int, int]:
     convertidos = sum(1 for r in rows if r.get("virou_cliente") in (1, 1.0))
@@ -667,24 +1613,32 @@ def _features_from_row(r: Dict[str, Any]):
 
 def _train_pipeline(X, y):
     pipe = Pipeline(steps=[("scaler", StandardScaler()), ("lr", LogisticRegression(max_iter=200, solver="lbfgs"))])
-    pipe.fit(X, y)
+    with _ml_timer("fit"):
+        pipe.fit(X, y)
     return pipe
 
+# index-only em idx_leads_labeled_cover / idx_leads_pending_cover (migrations.py)
+_LABELED_ROWS_SQL = """
+    SELECT id, tempo_site, paginas_visitadas, clicou_preco, probabilidade, virou_cliente
+    FROM leads
+    WHERE client_id=%s AND virou_cliente IS NOT NULL
+    ORDER BY created_at DESC
+"""
+_PENDING_FEATURES_SQL = """
+    SELECT id, tempo_site, paginas_visitadas, clicou_preco
+    FROM leads
+    WHERE client_id=%s AND virou_cliente IS NULL
+    ORDER BY created_at DESC
+    LIMIT %s
+"""
+
 def _get_labeled_rows(client_id: str) -> List[Dict[str, Any]]:
     _ensure_schema_once()
     conn = _db()
     try:
         with conn:
             with conn.cursor(row_factory=dict_row) as cur:
-                cur.execute(
-                    """
-                    SELECT id, tempo_site, paginas_visitadas, clicou_preco, probabilidade, virou_cliente
-                    FROM leads
-                    WHERE client_id=%s AND virou_cliente IS NOT NULL
-                    ORDER BY created_at DESC
-                    """,
-                    (client_id,),
-                )
+                cur.execute(_LABELED_ROWS_SQL, (client_id,))
                 return [dict(r) for r in (cur.fetchall() or [])]
     finally:
         conn.close()
@@ -698,62 +1652,432 @@ def _can_train(labeled_rows: List[Dict[str, Any]]) -> Tuple[bool, str, List[floa
         return False, "Precisa de exemplos das duas classes (convertido e negado) para treinar.", classes
     return True, "", classes
 
+def _train_online(X, y):
+    """Modelo online: scaler congelado entre refits + SGD log_loss (aceita partial_fit)."""
+    clf = SGDClassifier(loss="log_loss", alpha=1e-4, max_iter=1000, tol=1e-3, random_state=0)
+    with _ml_timer("fit"):
+        scaler = StandardScaler().fit(X)
+        clf.fit(scaler.transform(X), y)
+    # dict (e não classe própria) para o pickle só referenciar classes do sklearn
+    return {"kind": "online", "scaler": scaler, "clf": clf}
+
 def _predict_for_rows(pipe, rows: List[Dict[str, Any]]) -> List[float]:
     if not rows:
         return []
     X = np.vstack([_features_from_row(r) for r in rows])
-    probs = pipe.predict_proba(X)[:, 1]
+    with _ml_timer("predict"):
+        if isinstance(pipe, dict):
+            probs = pipe["clf"].predict_proba(pipe["scaler"].transform(X))[:, 1]
+        else:
+            probs = pipe.predict_proba(X)[:, 1]
     return probs.tolist()
 
+def _labeled_fingerprint(labeled_rows: List[Dict[str, Any]]) -> str:
+    """Hash estável do conjunto rotulado (id + label + features) para reaproveitar modelos."""
+    h = hashlib.sha256()
+    for r in sorted(labeled_rows, key=lambda r: int(r["id"])):
+        h.update(
+            (
+                f"{int(r['id'])}:{1 if float(r['virou_cliente']) == 1.0 else 0}:"
+                f"{_safe_int(r.get('tempo_site'), 0)}:{_safe_int(r.get('paginas_visitadas'), 0)}:"
+                f"{_safe_int(r.get('clicou_preco'), 0)};"
+            ).encode("utf-8")
+        )
+    return h.hexdigest()
+
+
+# -------------------------
+# Model store (persistido em "models", versionado em model_meta)
+# -------------------------
+_MODEL_CACHE = _TTLCache(MODEL_CACHE_MAX, MODEL_CACHE_TTL)
+
+def _load_latest_model(client_id: str) -> Optional[Dict[str, Any]]:
+    """Carrega a versão mais recente do modelo do workspace (None se não há / incompatível)."""
+    _ensure_schema_once()
+    conn = _db()
+    try:
+        with conn:
+            with conn.cursor(row_factory=dict_row) as cur:
+                cur.execute(
+                    """
+                    SELECT version, fingerprint, labeled_count, sklearn_version, model,
+                           kind, online_updates, created_at
+                    FROM models
+                    WHERE client_id=%s
+                    ORDER BY version DESC
+                    LIMIT 1
+                    """,
+                    (client_id,),
+                )
+                row = cur.fetchone()
+    finally:
+        conn.close()
+    if not row or not _load_ml():
+        return None
+    if (row.get("sklearn_version") or "") != sklearn.__version__:
+        # pickle de outra versão do sklearn: ignora e deixa o próximo treino substituir
+        logging.warning("model %s v%s ignorado (sklearn %s != %s)", client_id, row["version"],
+                        row.get("sklearn_version"), sklearn.__version__)
+        return None
+    try:
+        pipe = pickle.loads(bytes(row["model"]))
+    except Exception:
+        _log_exception(f"falha ao desserializar modelo {client_id} v{row['version']}")
+        return None
+    return {
+        "version": int(row["version"]),
+        "fingerprint": row["fingerprint"],
+        "labeled_count": int(row.get("labeled_count") or 0),
+        "kind": row.get("kind") or "batch",
+        "online_updates": int(row.get("online_updates") or 0),
+        "created_at": row.get("created_at"),
+        "pipe": pipe,
+    }
+
+def _online_refit_due(model: Dict[str, Any]) -> bool:
+    """Modelo online precisa de refit completo? (muitos partial_fit ou muito antigo)."""
+    if int(model.get("online_updates") or 0) >= ONLINE_REFIT_EVERY:
+        return True
+    created = model.get("created_at")
+    return bool(created and _now_utc() - created > timedelta(hours=ONLINE_REFIT_MAX_HOURS))
+
+def _save_model(client_id: str, pipe, fingerprint: str, labeled_rows: List[Dict[str, Any]],
+                classes: List[float]) -> int:
+    """Persiste nova versão do modelo + model_meta; mantém só as últimas MODEL_KEEP_VERSIONS."""
+    blob = pickle.dumps(pipe, protocol=pickle.HIGHEST_PROTOCOL)
+    conn = _db()
+    try:
+        with conn:
+            with conn.cursor(row_factory=dict_row) as cur:
+                cur.execute(
+                    """
+                    INSERT INTO model_meta (client_id, can_train, labeled_count, classes_rotuladas,
+                                            model_version, fingerprint, trained_at, updated_at)
+                    VALUES (%s, TRUE, %s, %s, 1, %s, NOW(), NOW())
+                    ON CONFLICT (client_id) DO UPDATE SET
+                      can_train=TRUE,
+                      labeled_count=EXCLUDED.labeled_count,
+                      classes_rotuladas=EXCLUDED.classes_rotuladas,
+                      model_version=model_meta.model_version + 1,
+                      fingerprint=EXCLUDED.fingerprint,
+                      trained_at=NOW(),
+                      updated_at=NOW()
+                    RETURNING model_version
+                    """,
+                    (client_id, len(labeled_rows), json.dumps(classes), fingerprint),
+                )
+                version = int(cur.fetchone()["model_version"])
+                cur.execute(
+                    """
+                    INSERT INTO models (client_id, version, fingerprint, labeled_count, sklearn_version, model, kind)
+                    VALUES (%s,%s,%s,%s,%s,%s,%s)
+                    ON CONFLICT (client_id, version) DO UPDATE SET
+                      fingerprint=EXCLUDED.fingerprint,
+                      labeled_count=EXCLUDED.labeled_count,
+                      sklearn_version=EXCLUDED.sklearn_version,
+                      model=EXCLUDED.model,
+                      kind=EXCLUDED.kind,
+                      online_updates=0,
+                      created_at=NOW(),
+                      updated_at=NULL
+                    """,
+                    (client_id, version, fingerprint, len(labeled_rows), sklearn.__version__, blob,
+                     "online" if isinstance(pipe, dict) else "batch"),
+                )
+                cur.execute(
+                    "DELETE FROM models WHERE client_id=%s AND version <= %s",
+                    (client_id, version - max(1, MODEL_KEEP_VERSIONS)),
+                )
+        return version
+    finally:
+        conn.close()
+
+def _fit_or_load_model(client_id: str, labeled_rows: List[Dict[str, Any]],
+                       classes: List[float]) -> Tuple[Any, Dict[str, Any]]:
+    """
+    Modelo para o conjunto rotulado atual: reaproveita (cache -> banco) quando o
+    fingerprint bate; senão treina, persiste nova versão e atualiza o cache.
+    Com ONLINE_LEARNING, o modelo online vigente é reaproveitado (já incorporou os
+    rótulos via partial_fit) até o refit periódico ficar devido.
+    """
+    _require_ml()
+    fp = _labeled_fingerprint(labeled_rows)
+    cached = _MODEL_CACHE.get(client_id)
+    if cached and cached.get("pipe") is not None and cached.get("fingerprint") == fp:
+        return cached["pipe"], {"model_version": cached["version"], "fingerprint": fp, "refit": False}
+
+    stored = _load_latest_model(client_id)
+    if stored and (stored["fingerprint"] == fp or (
+            ONLINE_LEARNING and stored["kind"] == "online" and not _online_refit_due(stored))):
+        _MODEL_CACHE.set(client_id, stored)
+        return stored["pipe"], {"model_version": stored["version"], "fingerprint": stored["fingerprint"], "refit": False}
+
+    X = np.vstack([_features_from_row(r) for r in labeled_rows])
+    y = np.array([1 if float(r["virou_cliente"]) == 1.0 else 0 for r in labeled_rows], dtype=int)
+    pipe = _train_online(X, y) if ONLINE_LEARNING else _train_pipeline(X, y)
+    version = _save_model(client_id, pipe, fp, labeled_rows, classes)
+    _MODEL_CACHE.set(client_id, {
+        "version": version, "fingerprint": fp, "labeled_count": len(labeled_rows),
+        "kind": "online" if ONLINE_LEARNING else "batch", "online_updates": 0,
+        "created_at": _now_utc(), "pipe": pipe,
+    })
+    return pipe, {"model_version": version, "fingerprint": fp, "refit": True}
+
+def _online_learn(client_id: str, rows: List[Dict[str, Any]], labels: List[int]) -> Optional[int]:
+    """
+    partial_fit do modelo online vigente com os rótulos novos (um lote por chamada).
+    Trava a row do modelo para não perder updates concorrentes entre workers.
+    Retorna a versão atualizada (None se não há modelo online). Se o refit ficou
+    devido, enfileira um job "recalc" (refit completo).
+    """
+    if not ONLINE_LEARNING or not rows or not _load_ml():
+        return None
+    try:
+        conn = _db()
+        try:
+            with conn:
+                with conn.cursor(row_factory=dict_row) as cur:
+                    cur.execute(
+                        """
+                        SELECT version, fingerprint, labeled_count, sklearn_version, model,
+                               kind, online_updates, created_at
+                        FROM models
+                        WHERE client_id=%s
+                        ORDER BY version DESC
+                        LIMIT 1
+                        FOR UPDATE
+                        """,
+                        (client_id,),
+                    )
+                    row = cur.fetchone()
+                    if not row or row.get("kind") != "online" or row.get("sklearn_version") != sklearn.__version__:
+                        return None
+                    model = pickle.loads(bytes(row["model"]))
+                    X = np.vstack([_features_from_row(r) for r in rows])
+                    with _ml_timer("partial_fit"):
+                        model["clf"].partial_fit(model["scaler"].transform(X), np.array(labels, dtype=int))
+                    cur.execute(
+                        """
+                        UPDATE models
+                        SET model=%s, online_updates=online_updates + %s, updated_at=NOW()
+                        WHERE client_id=%s AND version=%s
+                        RETURNING online_updates
+                        """,
+                        (pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL), len(rows), client_id, row["version"]),
+                    )
+                    updates = int(cur.fetchone()["online_updates"])
+        finally:
+            conn.close()
+    except Exception:
+        _log_exception(f"falha no update online do modelo de {client_id}")
+        return None
+
+    entry = {
+        "version": int(row["version"]), "fingerprint": row["fingerprint"],
+        "labeled_count": int(row.get("labeled_count") or 0), "kind": "online",
+        "online_updates": updates, "created_at": row.get("created_at"), "pipe": model,
+    }
+    _MODEL_CACHE.set(client_id, entry)
+    if _online_refit_due(entry):
+        try:
+            _enqueue_job(client_id, "recalc", {"limit": 5000})
+        except Exception:
+            _log_exception(f"falha ao enfileirar refit de {client_id}")
+    return entry["version"]
+
+def _current_model(client_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Modelo vigente do workspace para ingest (sem treinar). Cacheia inclusive a ausência.
+    Workspaces sem modelo salvo não importam o stack de ML.
+    """
+    if not ML_ENABLED:
+        return None
+    cached = _MODEL_CACHE.get(client_id)
+    if cached is not None:
+        return cached if cached.get("pipe") is not None else None
+    try:
+        stored = _load_latest_model(client_id)
+    except Exception:
+        _log_exception(f"falha ao carregar modelo de {client_id}")
+        return None
+    _MODEL_CACHE.set(client_id, stored or {"pipe": None, "version": None, "fingerprint": None})
+    return stored
+
+
 def _update_probabilities(client_id: str, ids: List[int], probs: List[float]) -> int:
+    """
+    Grava as probabilidades num único UPDATE ... FROM unnest(ids, probs).
+    Rows cuja probabilidade não mudou são puladas; retorna quantas mudaram.
+    """
     if not ids:
         return 0
     conn = _db()
     try:
         with conn:
             with conn.cursor() as cur:
-                for lead_id, p in zip(ids, probs):
-                    cur.execute(
-                        "UPDATE leads SET probabilidade=%s, updated_at=NOW() WHERE client_id=%s AND id=%s",
-                        (float(p), client_id, int(lead_id)),
-                    )
-        return len(ids)
+                cur.execute(
+                    """
+                    UPDATE leads AS l
+                    SET probabilidade = v.p, updated_at = NOW()
+                    FROM unnest(%s::bigint[], %s::double precision[]) AS v(id, p)
+                    WHERE l.client_id = %s
+                      AND l.id = v.id
+                      AND l.probabilidade IS DISTINCT FROM v.p
+                    """,
+                    ([int(i) for i in ids], [float(p) for p in probs], client_id),
+                )
+                return max(0, cur.rowcount)
     finally:
         conn.close()
 
-def _compute_precision_recall(rows: List[Dict[str, Any]], threshold: float) -> Dict[str, float]:
-    y_true = []
-    y_pred = []
-    for r in rows:
-        y = r.get("virou_cliente")
-        p = r.get("probabilidade")
-        if y is None or p is None:
-            continue
-        y_true.append(1 if float(y) == 1.0 else 0)
-        y_pred.append(1 if float(p) >= threshold else 0)
+THRESHOLD_OBJECTIVES = ("f1", "fbeta", "precision_at_k", "min_recall")
+
+def _threshold_curve(rows: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Curva precision/recall exata sobre todas as probabilidades distintas (O(n log n)):
+    ordena uma vez por probabilidade desc e acumula TP; o ponto i corresponde a
+    "positivo se probabilidade >= thresholds[i]".
+    """
+    pairs = [(r["probabilidade"], r["virou_cliente"]) for r in rows
+             if r.get("probabilidade") is not None and r.get("virou_cliente") is not None]
+    if not pairs:
+        return None
+    p = np.fromiter((float(a) for a, _ in pairs), dtype=float, count=len(pairs))
+    y = np.fromiter((1 if float(b) == 1.0 else 0 for _, b in pairs), dtype=np.int64, count=len(pairs))
+
+    order = np.argsort(-p, kind="mergesort")
+    p_sorted = p[order]
+    tp_all = np.cumsum(y[order])
+    # último índice de cada valor distinto
+    last = np.r_[np.nonzero(np.diff(p_sorted))[0], len(p_sorted) - 1]
+
+    positives = int(y.sum())
+    tp = tp_all[last]
+    predicted = last + 1
+    precision = tp / predicted
+    recall = tp / positives if positives else np.zeros(len(last), dtype=float)
+    return {
+        "thresholds": p_sorted[last],
+        "precision": precision,
+        "recall": recall,
+        "predicted": predicted,
+        "positives": positives,
+        "n": len(pairs),
+    }
+
+def _optimize_threshold(rows: List[Dict[str, Any]], objective: str = "f1", beta: float = 1.0,
+                        k: Optional[int] = None, min_recall: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Escolhe o threshold ótimo na curva exata.
+    - f1 / fbeta: maximiza F-beta
+    - precision_at_k: threshold que seleciona os k leads mais prováveis
+    - min_recall: maior precision com recall >= min_recall
+    """
+    curve = _threshold_curve(rows)
+    if curve is None:
+        return {"threshold": DEFAULT_THRESHOLD, "precision": 0.0, "recall": 0.0, "f1": 0.0,
+                "objective": objective, "objective_value": 0.0, "curve": None}
+
+    P, R, thr = curve["precision"], curve["recall"], curve["thresholds"]
+    if objective == "precision_at_k":
+        i = min(int(np.searchsorted(curve["predicted"], max(1, int(k or 1)))), len(thr) - 1)
+        value = float(P[i])
+    elif objective == "min_recall":
+        feasible = R >= float(min_recall or 0.0)
+        i = int(np.argmax(np.where(feasible, P, -1.0))) if feasible.any() else int(np.argmax(R))
+        value = float(P[i])
+    else:
+        b2 = float(beta) ** 2 if objective == "fbeta" else 1.0
+        denom = b2 * P + R
+        fb = np.divide((1 + b2) * P * R, denom, out=np.zeros_like(denom), where=denom > 0)
+        i = int(np.argmax(fb))
+        value = float(fb[i])
+
+    p_i, r_i = float(P[i]), float(R[i])
+    f1 = (2 * p_i * r_i) / (p_i + r_i) if (p_i + r_i) else 0.0
+    return {
+        "threshold": float(thr[i]),
+        "precision": p_i,
+        "recall": r_i,
+        "f1": float(f1),
+        "objective": objective,
+        "objective_value": value,
+        "curve": curve,
+    }
+
+# =========================
+# Ingest helpers (/prever e /prever_batch)
+# =========================
+def _parse_lead_input(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Normaliza um lead nos dois formatos aceitos (legado no topo ou "SaaS" em data["lead"])."""
+    lead = data.get("lead") or {}
+    if not isinstance(lead, dict):
+        lead = {}
+    nome = str(data.get("nome") or lead.get("nome") or "").strip()
+    email = str(data.get("email_lead") or data.get("email") or lead.get("email_lead") or lead.get("email") or "").strip()
+    telefone = str(data.get("telefone") or lead.get("telefone") or "").strip()
+
+    origem = str(data.get("origem") or lead.get("origem") or lead.get("source") or "").strip()
+
+    tempo_site = _safe_int(data.get("tempo_site") if "tempo_site" in data else lead.get("tempo_site"), 0)
+    paginas_visitadas = _safe_int(data.get("paginas_visitadas") if "paginas_visitadas" in data else lead.get("paginas_visitadas"), 0)
+    clicou_preco = _safe_int(data.get("clicou_preco") if "clicou_preco" in data else lead.get("clicou_preco"), 0)
+
+    payload = lead
+    # também salva o formato legado dentro do payload para auditoria/CRM
+    payload.setdefault("nome", nome)
+    payload.setdefault("email", email)
+    payload.setdefault("email_lead", email)
+    payload.setdefault("telefone", telefone)
+    if origem:
+        payload.setdefault("origem", origem)
+    payload.setdefault("tempo_site", tempo_site)
+    payload.setdefault("paginas_visitadas", paginas_visitadas)
+    payload.setdefault("clicou_preco", clicou_preco)
 
-    if not y_true:
-        return {"precision": 0.0, "recall": 0.0, "f1": 0.0}
+    return {
+        "nome": nome,
+        "email_lead": email,
+        "telefone": telefone,
+        "origem": origem,
+        "tempo_site": tempo_site,
+        "paginas_visitadas": paginas_visitadas,
+        "clicou_preco": clicou_preco,
+        "payload": payload,
+    }
 
-    tp = sum(1 for yt, yp in zip(y_true, y_pred) if yt == 1 and yp == 1)
-    fp = sum(1 for yt, yp in zip(y_true, y_pred) if yt == 0 and yp == 1)
-    fn = sum(1 for yt, yp in zip(y_true, y_pred) if yt == 1 and yp == 0)
+def _heuristic_score(tempo_site: int, paginas_visitadas: int, clicou_preco: int,
+                     nome: str, telefone: str) -> Tuple[float, int, Optional[int]]:
+    """Heurística inicial (estável e barata). Retorna (probabilidade, score, label)."""
+    base = 0.10
+    base += min(tempo_site / 400, 0.25)
+    base += min(paginas_visitadas / 10, 0.25)
+    base += 0.20 if clicou_preco else 0.0
+    # upgrades sutis (melhora "qualidade percebida" sem inventar dados)
+    if telefone and len(telefone) >= 10:
+        base += 0.06
+    if nome and len(nome) >= 4:
+        base += 0.04
 
-    precision = tp / (tp + fp) if (tp + fp) else 0.0
-    recall = tp / (tp + fn) if (tp + fn) else 0.0
-    f1 = (2 * precision * recall) / (precision + recall) if (precision + recall) else 0.0
-    return {"precision": float(precision), "recall": float(recall), "f1": float(f1)}
+    prob = max(0.02, min(0.98, base))
+    score, label = _score_label(prob)
+    return prob, score, label
 
-def _best_threshold(rows: List[Dict[str, Any]]) -> float:
-    candidates = [i / 100 for i in range(5, 96, 5)]
-    best_t = DEFAULT_THRESHOLD
-    best_f1 = -1.0
-    for t in candidates:
-        m = _compute_precision_recall(rows, t)
-        if m["f1"] > best_f1:
-            best_f1 = m["f1"]
-            best_t = t
-    return float(best_t)
+def _score_label(prob: float) -> Tuple[int, Optional[int]]:
+    score = int(round(prob * 100))
+    label = 1 if prob >= 0.70 else (0 if prob < 0.35 else None)
+    return score, label
+
+def _model_scores(client_id: str, fields: List[Dict[str, Any]]) -> Tuple[Optional[List[float]], Optional[int]]:
+    """Probabilidades pelo modelo vigente do workspace (uma predição vetorizada), ou (None, None)."""
+    model = _current_model(client_id) if fields else None
+    if not model:
+        return None, None
+    try:
+        return _predict_for_rows(model["pipe"], fields), model["version"]
+    except Exception:
+        _log_exception(f"falha ao pontuar com modelo de {client_id}; usando heurística")
+        return None, None
 
 
 # =========================
@@ -772,7 +2096,7 @@ def health_db():
     if not DATABASE_URL:
         return jsonify({"ok": True, "db": False, "error": "DATABASE_URL missing", "ts": _iso(_now_utc())})
     ok, err = _ensure_schema_once()
-    return jsonify({"ok": ok, "db": ok, "error": err, "ts": _iso(_now_utc())})
+    return jsonify({"ok": ok, "db": ok, "error": err, "pool": _pool_stats(), "boot": _boot_report(), "ts": _iso(_now_utc())})
 
 @app.get("/pricing")
 def pricing():
@@ -808,7 +2132,7 @@ def signup():
     try:
         with conn:
             with conn.cursor(row_factory=dict_row) as cur:
-                cur.execute("SELECT client_id FROM clients WHERE email=%s", (email,))
+                cur.execute("SELECT client_id FROM clients WHERE email=%s AND email <> ''", (email,))
                 row = cur.fetchone()
                 if row:
                     return jsonify({
@@ -858,6 +2182,14 @@ def signup():
         conn.close()
 
 
+# "email <> ''" repete o predicado de idx_clients_email_unique: sem ele o plano
+# genérico (statement preparado) não prova que o índice parcial serve e varre clients
+_LOGIN_SQL = (
+    "SELECT client_id, api_key, password_hash, plan, status, valid_until "
+    "FROM clients WHERE email=%s AND email <> ''"
+)
+
+
 @app.route('/login', methods=['POST'])
 def login():
     """Login com email+senha. Retorna client_id + api_key."""
@@ -875,7 +2207,7 @@ def login():
     try:
         with conn:
             with conn.cursor(row_factory=dict_row) as cur:
-                cur.execute("SELECT client_id, api_key, password_hash, plan, status, valid_until FROM clients WHERE email=%s", (email,))
+                cur.execute(_LOGIN_SQL, (email,))
                 row = cur.fetchone()
                 if not row:
                     return jsonify({"ok": False, "success": False, "error": "Conta não encontrada"}), 404
@@ -894,6 +2226,8 @@ def login():
 
                 cur.execute("UPDATE clients SET last_login_at=NOW(), updated_at=NOW() WHERE client_id=%s", (row['client_id'],))
 
+        _invalidate_workspace(row["client_id"])
+
         return jsonify({
             "ok": True,
             "success": True,
@@ -942,8 +2276,10 @@ def criar_cliente():
                         "UPDATE clients SET api_key=%s, plan=%s, updated_at=NOW() WHERE client_id=%s",
                         (api_key, plan, client_id),
                     )
+                    _bump_workspace_version(cur, client_id)
                     cur.execute("SELECT * FROM clients WHERE client_id=%s", (client_id,))
                     row = cur.fetchone() or row
+            _invalidate_workspace(client_id)
         finally:
             conn.close()
 
@@ -958,6 +2294,7 @@ def criar_cliente():
     })
 
 @app.get("/client_meta")
+@_etag_cached
 def client_meta():
     client_id = (request.args.get("client_id") or "").strip()
     if not client_id:
@@ -977,7 +2314,7 @@ def client_meta():
         "price_brl_month": cat["price_brl_month"],
         "setup_fee_brl": cat.get("setup_fee_brl", 0),
         "lead_limit_month": cat["lead_limit_month"],
-        "leads_used_this_month": int(row.get("leads_used_month") or 0),
+        "leads_used_this_month": _quota_used(client_id),
         "usage_month": row.get("usage_month") or _month_key(),
         "ts": _iso(_now_utc()),
     })
@@ -1017,8 +2354,10 @@ def set_plan():
                 q = f"UPDATE clients SET {', '.join(sets)} WHERE client_id=%s"
                 vals.append(client_id)
                 cur.execute(q, tuple(vals))
+                _bump_workspace_version(cur, client_id)
                 cur.execute("SELECT * FROM clients WHERE client_id=%s", (client_id,))
                 row = cur.fetchone() or {}
+        _invalidate_workspace(client_id)
         return _json_ok({"client_id": client_id, "plan": row.get("plan"), "status": row.get("status")})
     finally:
         conn.close()
@@ -1044,6 +2383,7 @@ def prever():
     if not client_id:
         return _json_err("client_id obrigatório", 400)
 
+    # contexto cacheado: a cota é reservada no INSERT (quota_usage), sem travar clients
     ok_auth, client_row, msg = _require_client_auth(client_id)
     if not ok_auth:
         return _json_err(msg, 403, code="auth_required")
@@ -1052,57 +2392,26 @@ def prever():
         return _json_err("Workspace inativo. Fale com o suporte para reativar.", 403, code="inactive")
 
     plan = (client_row.get("plan") or "trial").lower()
-    cat = PLAN_CATALOG.get(plan, PLAN_CATALOG["trial"])
-    used = int(client_row.get("leads_used_month") or 0)
-    limit = int(cat.get("lead_limit_month") or 0)
-    if limit > 0 and used >= limit:
-        return _json_err("Limite mensal atingido. Faça upgrade para continuar.", 402,
-                         code="plan_limit", plan=plan, used=used, limit=limit,
-                         price_brl_month=cat.get("price_brl_month"), setup_fee_brl=cat.get("setup_fee_brl", 0))
 
-    # aceita ambos formatos
-    lead = data.get("lead") or {}
-    nome = (data.get("nome") or lead.get("nome") or "").strip()
-    email = (data.get("email_lead") or data.get("email") or lead.get("email_lead") or lead.get("email") or "").strip()
-    telefone = (data.get("telefone") or lead.get("telefone") or "").strip()
+    f = _parse_lead_input(data)
+    nome, email, telefone, origem = f["nome"], f["email_lead"], f["telefone"], f["origem"]
+    tempo_site, paginas_visitadas, clicou_preco = f["tempo_site"], f["paginas_visitadas"], f["clicou_preco"]
+    payload = f["payload"]
 
-    origem = (data.get("origem") or lead.get("origem") or lead.get("source") or "").strip()
-
-    tempo_site = _safe_int(data.get("tempo_site") if "tempo_site" in data else lead.get("tempo_site"), 0)
-    paginas_visitadas = _safe_int(data.get("paginas_visitadas") if "paginas_visitadas" in data else lead.get("paginas_visitadas"), 0)
-    clicou_preco = _safe_int(data.get("clicou_preco") if "clicou_preco" in data else lead.get("clicou_preco"), 0)
-
-    # heurística inicial (estável e barata)
-    base = 0.10
-    base += min(tempo_site / 400, 0.25)
-    base += min(paginas_visitadas / 10, 0.25)
-    base += 0.20 if clicou_preco else 0.0
-    # upgrades sutis (melhora "qualidade percebida" sem inventar dados)
-    if telefone and len(telefone) >= 10:
-        base += 0.06
-    if nome and len(nome) >= 4:
-        base += 0.04
-
-    prob = max(0.02, min(0.98, base))
-    score = int(round(prob * 100))
-    label = 1 if prob >= 0.70 else (0 if prob < 0.35 else None)
-
-    payload = lead if isinstance(lead, dict) else {}
-    # também salva o formato legado dentro do payload para auditoria/CRM
-    payload.setdefault("nome", nome)
-    payload.setdefault("email", email)
-    payload.setdefault("email_lead", email)
-    payload.setdefault("telefone", telefone)
-    if origem:
-        payload.setdefault("origem", origem)
-    payload.setdefault("tempo_site", tempo_site)
-    payload.setdefault("paginas_visitadas", paginas_visitadas)
-    payload.setdefault("clicou_preco", clicou_preco)
+    prob, score, label = _heuristic_score(tempo_site, paginas_visitadas, clicou_preco, nome, telefone)
+    model_probs, model_version = _model_scores(client_id, [f])
+    if model_probs:
+        prob = float(model_probs[0])
+        score, label = _score_label(prob)
 
     conn = _db()
     try:
         with conn:
             with conn.cursor(row_factory=dict_row) as cur:
+                # reserva antes do INSERT, na mesma transação: nunca admite além do plano
+                granted, quota = _quota_take(cur, client_id, 1)
+                if not granted:
+                    return _plan_limit_error(quota.get("plan") or plan, quota.get("used", 0), quota.get("limit", 0))
                 cur.execute(
                     """
                     INSERT INTO leads
@@ -1116,11 +2425,6 @@ def prever():
                      json.dumps(payload), float(prob), int(score), label),
                 )
                 row = cur.fetchone() or {}
-                ok, err, extra = _check_quota_and_bump(client_id, client_row)
-                if not ok:
-                    # se estourou limite exatamente aqui, mantemos a inserção (você decide se quer rollback).
-                    # Para comportamento estrito, dá para lançar exceção e reverter.
-                    return _json_err(err, 402, **extra)
 
         return _json_ok({
             "client_id": client_id,
@@ -1129,17 +2433,140 @@ def prever():
             "score": int(score),
             "label": label,
             "plan": plan,
+            "scored_by": "model" if model_version else "heuristic",
+            "model_version": model_version,
             "created_at": _iso(row.get("created_at")),
         })
     except (psycopg.errors.UndefinedColumn, psycopg.errors.NotNullViolation):
-        # segurança extra: se banco estiver em versão antiga, migra e tenta de novo
+        # segurança extra: se banco estiver em versão antiga, migra e tenta de novo (uma vez)
+        if g.get("schema_retry"):
+            raise
+        g.schema_retry = True
         _ensure_schema()
         return prever()
     finally:
         conn.close()
 
 
+@app.post("/prever_batch")
+def prever_batch():
+    """
+    POST /prever_batch
+    Body:
+      {
+        "client_id": "workspace",
+        "leads": [ {...}, {...} ]   # cada item no mesmo formato do body de /prever
+      }
+    Pontua todos com a mesma heurística, grava via COPY numa única transação e
+    reserva a cota mensal uma vez para o lote inteiro. Itens além do limite do
+    plano voltam com code="plan_limit".
+    """
+    data = request.get_json(silent=True) or {}
+    client_id = (data.get("client_id") or "").strip()
+    if not client_id:
+        return _json_err("client_id obrigatório", 400)
+
+    items = data.get("leads")
+    if not isinstance(items, list) or not items:
+        return _json_err("leads deve ser uma lista não vazia", 400)
+    if len(items) > PREVER_BATCH_MAX:
+        return _json_err(f"Lote muito grande (máx. {PREVER_BATCH_MAX} leads).", 413, max_batch=PREVER_BATCH_MAX)
+
+    ok_auth, client_row, msg = _require_client_auth(client_id)
+    if not ok_auth:
+        return _json_err(msg, 403, code="auth_required")
+
+    if (client_row.get("status") or "active") != "active":
+        return _json_err("Workspace inativo. Fale com o suporte para reativar.", 403, code="inactive")
+
+    plan = (client_row.get("plan") or "trial").lower()
+    cat = PLAN_CATALOG.get(plan, PLAN_CATALOG["trial"])
+    limit = int(cat.get("lead_limit_month") or 0)
+
+    # parse + score numa passada; erros ficam por índice
+    results: List[Dict[str, Any]] = [{} for _ in items]
+    valid: List[Tuple[int, Dict[str, Any], float, int, Optional[int]]] = []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[i] = {"index": i, "ok": False, "error": "lead inválido (esperado objeto)", "code": "invalid"}
+            continue
+        f = _parse_lead_input(item)
+        prob, score, label = _heuristic_score(f["tempo_site"], f["paginas_visitadas"], f["clicou_preco"], f["nome"], f["telefone"])
+        valid.append((i, f, prob, score, label))
+
+    # com modelo treinado, pontua o lote inteiro numa predição só
+    model_probs, model_version = _model_scores(client_id, [v[1] for v in valid])
+    if model_probs:
+        valid = [(i, f, float(p), *_score_label(float(p))) for (i, f, *_), p in zip(valid, model_probs)]
+
+    conn = _db()
+    try:
+        with conn:
+            with conn.cursor(row_factory=dict_row) as cur:
+                # reserva de cota nas shards (quota_usage): admite só o que cabe no plano
+                admit, _ = _quota_take(cur, client_id, len(valid)) if valid else (0, {})
+                accepted, refused = valid[:admit], valid[admit:]
+                used = _quota_used(client_id, cur=cur)
+
+                created_at = None
+                if accepted:
+                    cur.execute(
+                        "SELECT nextval(pg_get_serial_sequence('leads', 'id')) AS id FROM generate_series(1, %s)",
+                        (len(accepted),),
+                    )
+                    ids = [int(r["id"]) for r in cur.fetchall()]
+                    cur.execute("SELECT NOW() AS now")
+                    created_at = cur.fetchone()["now"]
+
+                    with cur.copy(
+                        "COPY leads (id, client_id, nome, email_lead, telefone, origem, tempo_site, "
+                        "paginas_visitadas, clicou_preco, payload, probabilidade, score, label) FROM STDIN"
+                    ) as cp:
+                        for lead_id, (_, f, prob, score, label) in zip(ids, accepted):
+                            cp.write_row((
+                                lead_id, client_id, f["nome"], f["email_lead"], f["telefone"], f["origem"],
+                                f["tempo_site"], f["paginas_visitadas"], f["clicou_preco"],
+                                json.dumps(f["payload"]), float(prob), int(score), label,
+                            ))
+
+                    for lead_id, (i, _, prob, score, label) in zip(ids, accepted):
+                        results[i] = {
+                            "index": i,
+                            "ok": True,
+                            "lead_id": lead_id,
+                            "probabilidade": float(prob),
+                            "score": int(score),
+                            "label": label,
+                        }
+
+                for i, *_ in refused:
+                    results[i] = {
+                        "index": i,
+                        "ok": False,
+                        "error": "Limite mensal atingido. Faça upgrade para continuar.",
+                        "code": "plan_limit",
+                    }
+    finally:
+        conn.close()
+
+    inserted = len(accepted)
+    return _json_ok({
+        "client_id": client_id,
+        "plan": plan,
+        "received": len(items),
+        "inserted": inserted,
+        "rejected": len(items) - inserted,
+        "used": used,
+        "limit": limit,
+        "scored_by": "model" if model_version else "heuristic",
+        "model_version": model_version,
+        "created_at": _iso(created_at),
+        "results": results,
+    })
+
+
 @app.get("/dashboard_data")
+@_etag_cached
 def dashboard_data():
     client_id = (request.args.get("client_id") or "").strip()
     limit = _safe_int(request.args.get("limit"), DEFAULT_LIMIT)
@@ -1148,17 +2575,42 @@ def dashboard_data():
     if not client_id:
         return _json_err("client_id obrigatório", 400)
 
+    # filtros + paginação keyset (cursor opaco devolvido em next_cursor)
+    status = (request.args.get("status") or "").strip().lower()
+    if status and status not in _STATUS_FILTERS:
+        return _json_err("status inválido", 400, allowed=list(_STATUS_FILTERS.keys()))
+    try:
+        filters = {
+            "origem": (request.args.get("origem") or "").strip() or None,
+            "min_prob": _safe_float(request.args.get("min_prob"), None),
+            "max_prob": _safe_float(request.args.get("max_prob"), None),
+            "status": status or None,
+            "since": _parse_date_param(request.args.get("since") or ""),
+            "until": _parse_date_param(request.args.get("until") or "", end=True),
+        }
+        cursor = (request.args.get("cursor") or "").strip()
+        after = _decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return _json_err(str(e), 400)
+
     ok_auth, _, msg = _require_client_auth(client_id)
     if not ok_auth:
         return _json_err(msg, 403, code="auth_required")
 
-    rows = _fetch_recent_leads(client_id, limit=limit)
+    # recentes + Premium (C1): Top origens (30d) + Hot leads de hoje (America/Sao_Paulo),
+    # tudo numa conexão só e em pipeline
+    _ensure_schema_once()
+    rows, top_origens, hot_leads_today = _run_queries([
+        _recent_leads_query(client_id, limit + 1, filters=filters, after=after),
+        _top_origens_query(client_id, days=30, limit=6),
+        _hot_leads_today_query(client_id, limit=20),
+    ])
+    _norm_created_at(hot_leads_today)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = _encode_cursor(rows[-1]["created_at"], rows[-1]["id"]) if has_more and rows else None
     convertidos, negados, pendentes = _count_status(rows)
 
-    # Premium (C1): Top origens (30d) + Hot leads de hoje (America/Sao_Paulo)
-    top_origens = _top_origens(client_id, days=30, limit=6)
-    hot_leads_today = _hot_leads_today(client_id, limit=20)
-
     def norm(r: Dict[str, Any]) -> Dict[str, Any]:
         rr = dict(r)
         rr["created_at"] = _iso(rr.get("created_at"))
@@ -1174,36 +2626,32 @@ def dashboard_data():
         "hot_leads_today_tz": "America/Sao_Paulo",
         "dados": [norm(r) for r in rows],
         "total_recentes_considerados": len(rows),
+        "next_cursor": next_cursor,
+        "has_more": has_more,
     })
 
 
-@app.post("/confirmar_venda")
-def confirmar_venda():
-    data = request.get_json(silent=True) or {}
-    client_id = (data.get("client_id") or "").strip()
-    lead_id = _safe_int(data.get("lead_id"), 0)
-    if not client_id or not lead_id:
-        return _json_err("client_id e lead_id obrigatórios", 400)
-
-    ok_auth, _, msg = _require_client_auth(client_id)
-    if not ok_auth:
-        return _json_err(msg, 403, code="auth_required")
-
+def _apply_label(client_id: str, lead_id: int, value: int) -> Optional[Dict[str, Any]]:
+    """Grava o rótulo; retorna as features do lead se o rótulo mudou (None se igual/inexistente)."""
     conn = _db()
     try:
         with conn:
-            with conn.cursor() as cur:
+            with conn.cursor(row_factory=dict_row) as cur:
                 cur.execute(
-                    "UPDATE leads SET virou_cliente=1, updated_at=NOW() WHERE client_id=%s AND id=%s",
-                    (client_id, lead_id),
+                    """
+                    UPDATE leads SET virou_cliente=%s, updated_at=NOW()
+                    WHERE client_id=%s AND id=%s AND virou_cliente IS DISTINCT FROM %s
+                    RETURNING id, tempo_site, paginas_visitadas, clicou_preco
+                    """,
+                    (value, client_id, lead_id, value),
                 )
-        return _json_ok({"client_id": client_id, "lead_id": lead_id, "virou_cliente": 1})
+                row = cur.fetchone()
+                return dict(row) if row else None
     finally:
         conn.close()
 
 
-@app.post("/negar_venda")
-def negar_venda():
+def _label_route(value: int):
     data = request.get_json(silent=True) or {}
     client_id = (data.get("client_id") or "").strip()
     lead_id = _safe_int(data.get("lead_id"), 0)
@@ -1214,81 +2662,323 @@ def negar_venda():
     if not ok_auth:
         return _json_err(msg, 403, code="auth_required")
 
-    conn = _db()
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    "UPDATE leads SET virou_cliente=0, updated_at=NOW() WHERE client_id=%s AND id=%s",
-                    (client_id, lead_id),
-                )
-        return _json_ok({"client_id": client_id, "lead_id": lead_id, "virou_cliente": 0})
-    finally:
-        conn.close()
+    changed = _apply_label(client_id, lead_id, value)
+    model_version = _online_learn(client_id, [changed], [value]) if changed else None
+    out = {"client_id": client_id, "lead_id": lead_id, "virou_cliente": value}
+    if model_version is not None:
+        out["model_version"] = model_version
+        out["online_update"] = True
+    return _json_ok(out)
 
 
-@app.get("/metrics")
-def metrics():
-    """Métricas simples (debug/monitoramento)."""
-    if not DATABASE_URL:
-        return _json_ok({"db": False, "reason": "DATABASE_URL ausente", "ts": _iso(_now_utc())})
+@app.post("/confirmar_venda")
+def confirmar_venda():
+    return _label_route(1)
 
-    _ensure_schema_once()
+
+@app.post("/negar_venda")
+def negar_venda():
+    return _label_route(0)
+
+
+def _parse_label_value(v: Any) -> Optional[int]:
+    s = str(v if v is not None else "").strip().lower()
+    if s in ("1", "true", "sim", "yes", "s"):
+        return 1
+    if s in ("0", "false", "nao", "não", "no", "n"):
+        return 0
+    return None
+
+
+def _read_label_items() -> Tuple[str, List[Dict[str, Any]]]:
+    """client_id + itens {lead_id, virou_cliente} do body JSON ou CSV (text/csv)."""
+    if request.mimetype in ("text/csv", "application/csv"):
+        client_id = (request.args.get("client_id") or "").strip()
+        text = request.get_data(as_text=True) or ""
+        items = [dict(r) for r in csv.DictReader(io.StringIO(text))]
+        return client_id, items
+    data = request.get_json(silent=True) or {}
+    items = data.get("labels")
+    return (data.get("client_id") or "").strip(), items if isinstance(items, list) else []
+
+
+def _apply_labels(client_id: str, ids: List[int], values: List[int]) -> Dict[int, Dict[str, Any]]:
+    """
+    Aplica os rótulos num único UPDATE ... FROM unnest(ids, valores); os triggers
+    de estatística rodam uma vez para o lote. Retorna por id: rótulo anterior e,
+    se mudou, as features do lead. Ids ausentes do retorno não existem no workspace.
+    """
     conn = _db()
     try:
         with conn:
             with conn.cursor(row_factory=dict_row) as cur:
-                cur.execute("SELECT COUNT(*) AS total FROM leads;")
-                total = int(cur.fetchone()["total"])
-                cur.execute("SELECT COUNT(*) AS labeled FROM leads WHERE virou_cliente IS NOT NULL;")
-                labeled = int(cur.fetchone()["labeled"])
-                cur.execute("SELECT COUNT(*) AS pending FROM leads WHERE virou_cliente IS NULL;")
-                pending = int(cur.fetchone()["pending"])
-        return _json_ok({"db": True, "total_leads": total, "labeled": labeled, "pending": pending, "ts": _iso(_now_utc())})
+                cur.execute(
+                    """
+                    WITH v AS (
+                        SELECT * FROM unnest(%s::bigint[], %s::int[]) AS v(id, val)
+                    ),
+                    upd AS (
+                        UPDATE leads AS l
+                        SET virou_cliente = v.val, updated_at = NOW()
+                        FROM v
+                        WHERE l.client_id = %s AND l.id = v.id
+                          AND l.virou_cliente IS DISTINCT FROM v.val
+                        RETURNING l.id, l.tempo_site, l.paginas_visitadas, l.clicou_preco
+                    )
+                    SELECT o.id, o.virou_cliente AS previous, (u.id IS NOT NULL) AS changed,
+                           u.tempo_site, u.paginas_visitadas, u.clicou_preco
+                    FROM leads o
+                    JOIN v ON v.id = o.id
+                    LEFT JOIN upd u ON u.id = o.id
+                    WHERE o.client_id = %s
+                    """,
+                    (ids, values, client_id, client_id),
+                )
+                return {int(r["id"]): dict(r) for r in cur.fetchall()}
     finally:
         conn.close()
 
 
-@app.get("/recalc_pending")
-def recalc_pending():
-    """Recalcula probabilidade para pendentes com base nos rotulados (requer numpy/sklearn)."""
-    if not _HAS_ML:
-        return _json_err("Dependências ML ausentes (numpy/scikit-learn).", 501, code="ml_missing")
-
-    client_id = (request.args.get("client_id") or "").strip()
-    limit = _safe_int(request.args.get("limit"), 500)
-    limit = max(10, min(limit, 5000))
+@app.post("/rotular_batch")
+def rotular_batch():
+    """
+    POST /rotular_batch
+    Body JSON:
+      { "client_id": "workspace", "labels": [ {"lead_id": 1, "virou_cliente": 1}, ... ] }
+    ou CSV (Content-Type: text/csv, ?client_id=...) com colunas lead_id,virou_cliente.
+    Aplica tudo num único UPDATE e devolve o resultado por item:
+      updated | unchanged (já tinha esse rótulo) | not_found | invalid | duplicate
+    O modelo online recebe um único partial_fit com os rótulos que mudaram.
+    """
+    client_id, items = _read_label_items()
     if not client_id:
         return _json_err("client_id obrigatório", 400)
+    if not items:
+        return _json_err("labels deve ser uma lista não vazia", 400)
+    if len(items) > LABEL_BATCH_MAX:
+        return _json_err(f"Lote muito grande (máx. {LABEL_BATCH_MAX} rótulos).", 413, max_batch=LABEL_BATCH_MAX)
 
     ok_auth, _, msg = _require_client_auth(client_id)
     if not ok_auth:
         return _json_err(msg, 403, code="auth_required")
 
+    # parse; o último rótulo de um id repetido vence
+    results: List[Dict[str, Any]] = [{} for _ in items]
+    last: Dict[int, int] = {}
+    for i, item in enumerate(items):
+        lead_id = _safe_int(item.get("lead_id"), 0) if isinstance(item, dict) else 0
+        value = _parse_label_value(item.get("virou_cliente")) if isinstance(item, dict) else None
+        if lead_id <= 0 or value is None:
+            results[i] = {"index": i, "lead_id": lead_id or None, "status": "invalid"}
+            continue
+        if lead_id in last:
+            prev = last[lead_id]
+            results[prev] = {"index": prev, "lead_id": lead_id, "status": "duplicate"}
+        last[lead_id] = i
+        results[i] = {"index": i, "lead_id": lead_id, "virou_cliente": value}
+
+    ids = list(last.keys())
+    values = [results[last[i]]["virou_cliente"] for i in ids]
+    applied = _apply_labels(client_id, ids, values) if ids else {}
+
+    changed_rows: List[Dict[str, Any]] = []
+    changed_labels: List[int] = []
+    counts = {"updated": 0, "unchanged": 0, "not_found": 0, "invalid": 0, "duplicate": 0}
+    for lead_id, idx in last.items():
+        r = applied.get(lead_id)
+        res = results[idx]
+        if r is None:
+            res["status"] = "not_found"
+        elif r["changed"]:
+            res["status"] = "updated"
+            res["previous"] = r["previous"]
+            changed_rows.append(r)
+            changed_labels.append(res["virou_cliente"])
+        else:
+            res["status"] = "unchanged"
+    for res in results:
+        counts[res["status"]] += 1
+
+    out = {"client_id": client_id, "total": len(items), "counts": counts, "results": results}
+    model_version = _online_learn(client_id, changed_rows, changed_labels) if changed_rows else None
+    if model_version is not None:
+        out["model_version"] = model_version
+        out["online_update"] = True
+    return _json_ok(out)
+
+
+# estimativas baratas: reltuples das partições de leads e dos índices parciais
+# (pendentes / rotulados); nunca COUNT(*) na tabela grande a cada scrape
+_REL_ESTIMATE_SQL = """
+    SELECT COALESCE(SUM(GREATEST(c.reltuples, 0)), 0)::bigint
+    FROM pg_class c
+    WHERE c.relkind NOT IN ('p', 'I')
+      AND (c.oid = to_regclass(%(rel)s)
+           OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = to_regclass(%(rel)s)))
+"""
+_METRICS_DB: Dict[str, Any] = {"at": 0.0, "data": None}
+_METRICS_DB_LOCK = threading.Lock()
+
+
+def _metrics_db_snapshot() -> Optional[Dict[str, Any]]:
+    """Fila de jobs + estimativas de leads, cacheadas por METRICS_DB_TTL (um scrape não vira carga)."""
+    if not DATABASE_URL:
+        return None
+    with _METRICS_DB_LOCK:
+        if _METRICS_DB["data"] is not None and time.monotonic() - _METRICS_DB["at"] < METRICS_DB_TTL:
+            return _METRICS_DB["data"]
+        try:
+            _ensure_schema_once()
+            conn = _db()
+            try:
+                with conn:
+                    with conn.cursor(row_factory=tuple_row) as cur:
+                        est = {}
+                        for key, rel in (("total", "leads"), ("pending", "idx_leads_pending_cover"),
+                                         ("labeled", "idx_leads_labeled_cover")):
+                            cur.execute(_REL_ESTIMATE_SQL, {"rel": rel})
+                            est[key] = int(cur.fetchone()[0] or 0)
+                        # índices parciais idx_jobs_queued / idx_jobs_running_heartbeat
+                        cur.execute(
+                            """
+                            SELECT status, COUNT(*)::bigint,
+                                   COALESCE(EXTRACT(EPOCH FROM NOW() - MIN(created_at)), 0)::float8
+                            FROM jobs
+                            WHERE status IN ('queued', 'running')
+                            GROUP BY status
+                            """
+                        )
+                        jobs = {"queued": (0, 0.0), "running": (0, 0.0)}
+                        for status, n, age in cur.fetchall():
+                            jobs[status] = (int(n), float(age))
+            finally:
+                conn.close()
+        except Exception:
+            _log_exception("falha ao ler métricas do banco")
+            return None
+        _METRICS_DB.update(at=time.monotonic(), data={"leads": est, "jobs": jobs})
+        return _METRICS_DB["data"]
+
+
+def _prom_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+
+    def esc(v: Any) -> str:
+        return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}"
+
+
+def _prometheus_text() -> str:
+    with _METRICS_LOCK:
+        counters = dict(_COUNTERS)
+        histograms = {k: [list(v[0]), v[1], v[2]] for k, v in _HISTOGRAMS.items()}
+
+    lines: List[str] = []
+    seen = set()
+
+    def family(name: str, kind: str, help_text: str) -> None:
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    def sample(name: str, kind: str, help_text: str, value: Any, labels: tuple = ()) -> None:
+        family(name, kind, help_text)
+        lines.append(f"{name}{_prom_labels(labels)} {value}")
+
+    for (name, labels), value in sorted(counters.items()):
+        kind, help_text = _METRIC_HELP[name]
+        sample(name, kind, help_text, value, labels)
+
+    for (name, labels), (buckets, total_s, n) in sorted(histograms.items()):
+        kind, help_text = _METRIC_HELP[name]
+        family(name, kind, help_text)
+        acc = 0
+        for le, c in zip(list(_LATENCY_BUCKETS) + ["+Inf"], buckets):
+            acc += c
+            lines.append(f"{name}_bucket{_prom_labels(labels + (('le', le),))} {acc}")
+        lines.append(f"{name}_sum{_prom_labels(labels)} {total_s}")
+        lines.append(f"{name}_count{_prom_labels(labels)} {n}")
+
+    pool = _pool_stats()
+    if pool.get("open"):
+        sample("leadrank_db_pool_size", "gauge", "Conexões abertas no pool.", pool.get("pool_size", 0))
+        sample("leadrank_db_pool_available", "gauge", "Conexões ociosas no pool.", pool.get("pool_available", 0))
+        sample("leadrank_db_pool_max", "gauge", "Tamanho máximo do pool.", pool.get("max_size", 0))
+        sample("leadrank_db_pool_waiting", "gauge", "Requests esperando conexão agora.", pool.get("requests_waiting", 0))
+        sample("leadrank_db_pool_requests_total", "counter", "Empréstimos de conexão.", pool.get("requests_num", 0))
+        sample("leadrank_db_pool_wait_seconds_total", "counter", "Tempo total esperando conexão.",
+               int(pool.get("requests_wait_ms") or 0) / 1000.0)
+        sample("leadrank_db_pool_errors_total", "counter", "Empréstimos que falharam (timeout/erro).",
+               pool.get("requests_errors", 0))
+
+    caches = [(name, cache.stats()) for name, cache in
+              (("workspace", _WS_CACHE), ("model", _MODEL_CACHE), ("rate_limit_deny", _RL_DENY_CACHE))]
+    # text format: amostras de uma mesma família ficam juntas
+    for metric, key, kind, help_text in (
+        ("leadrank_cache_hits_total", "hits", "counter", "Acertos dos caches em memória."),
+        ("leadrank_cache_misses_total", "misses", "counter", "Faltas dos caches em memória."),
+        ("leadrank_cache_hit_ratio", "hit_ratio", "gauge", "Acertos / consultas desde o boot."),
+        ("leadrank_cache_entries", "size", "gauge", "Entradas em cache."),
+    ):
+        for cache_name, st in caches:
+            sample(metric, kind, help_text, st[key], (("cache", cache_name),))
+
+    sample("leadrank_ml_loaded", "gauge", "numpy/sklearn carregados neste processo.", int(bool(_ML_STATE.get("loaded"))))
+
+    snap = _metrics_db_snapshot()
+    sample("leadrank_metrics_db_up", "gauge", "Leitura das métricas do banco funcionou.", int(snap is not None))
+    if snap is not None:
+        jobs = sorted(snap["jobs"].items())
+        for status, (n, _) in jobs:
+            sample("leadrank_jobs", "gauge", "Jobs na fila por status.", n, (("status", status),))
+        for status, (_, age) in jobs:
+            sample("leadrank_jobs_oldest_age_seconds", "gauge", "Idade do job mais antigo por status.",
+                   round(age, 3), (("status", status),))
+        for status, n in sorted(snap["leads"].items()):
+            sample("leadrank_leads_estimate", "gauge", "Leads (estimativa do catálogo, todas as contas).",
+                   n, (("status", status),))
+
+    return "\n".join(lines) + "\n"
+
+
+@app.get("/metrics")
+def metrics():
+    """
+    Métricas no formato texto do Prometheus (por processo/worker).
+    ?format=json -> formato antigo (totais de leads, agora estimados pelo catálogo).
+    """
+    if (request.args.get("format") or "").strip().lower() == "json":
+        if not DATABASE_URL:
+            return _json_ok({"db": False, "reason": "DATABASE_URL ausente", "ts": _iso(_now_utc())})
+        snap = _metrics_db_snapshot()
+        if snap is None:
+            return _json_err("Falha ao ler métricas do banco", 503)
+        est = snap["leads"]
+        return _json_ok({"db": True, "estimate": True, "total_leads": est["total"], "labeled": est["labeled"],
+                         "pending": est["pending"], "ts": _iso(_now_utc())})
+    return Response(_prometheus_text(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def _recalc_pending_run(client_id: str, limit: int, progress=None) -> Dict[str, Any]:
+    """Treina/reaproveita o modelo e recalcula os `limit` pendentes mais recentes."""
     labeled = _get_labeled_rows(client_id)
     can, reason, classes = _can_train(labeled)
     if not can:
-        return _json_ok({"client_id": client_id, "can_train": False, "classes_rotuladas": classes, "labeled_count": len(labeled), "reason": reason, "updated": 0})
+        return {"client_id": client_id, "can_train": False, "classes_rotuladas": classes, "labeled_count": len(labeled), "reason": reason, "updated": 0}
 
-    X = np.vstack([_features_from_row(r) for r in labeled])
-    y = np.array([1 if float(r["virou_cliente"]) == 1.0 else 0 for r in labeled], dtype=int)
-    pipe = _train_pipeline(X, y)
+    pipe, model_info = _fit_or_load_model(client_id, labeled, classes)
+    if progress:
+        progress(0.5)
 
     _ensure_schema_once()
     conn = _db()
     try:
         with conn:
             with conn.cursor(row_factory=dict_row) as cur:
-                cur.execute(
-                    """
-                    SELECT id, tempo_site, paginas_visitadas, clicou_preco
-                    FROM leads
-                    WHERE client_id=%s AND virou_cliente IS NULL
-                    ORDER BY created_at DESC
-                    LIMIT %s
-                    """,
-                    (client_id, int(limit)),
-                )
+                cur.execute(_PENDING_FEATURES_SQL, (client_id, int(limit)))
                 pending = [dict(r) for r in (cur.fetchall() or [])]
     finally:
         conn.close()
@@ -1297,37 +2987,42 @@ def recalc_pending():
     probs = _predict_for_rows(pipe, pending)
     updated = _update_probabilities(client_id, ids, probs)
 
-    return _json_ok({
+    return {
         "client_id": client_id,
         "can_train": True,
         "classes_rotuladas": classes,
         "labeled_count": len(labeled),
+        "model_version": model_info["model_version"],
+        "refit": model_info["refit"],
         "updated": updated,
         "min_prob": float(min(probs)) if probs else None,
         "max_prob": float(max(probs)) if probs else None,
         "sample": [{"id": ids[i], "prob": float(probs[i])} for i in range(min(5, len(ids)))]
-    })
-
-
-@app.post("/auto_threshold")
-def auto_threshold():
-    """Calcula e salva threshold que maximiza F1 (requer numpy/sklearn)."""
-    if not _HAS_ML:
-        return _json_err("Dependências ML ausentes (numpy/scikit-learn).", 501, code="ml_missing")
-
-    data = request.get_json(silent=True) or {}
-    client_id = (data.get("client_id") or "").strip()
-    if not client_id:
-        return _json_err("client_id obrigatório", 400)
-
-    ok_auth, _, msg = _require_client_auth(client_id)
-    if not ok_auth:
-        return _json_err(msg, 403, code="auth_required")
+    }
 
+def _threshold_params(data: Dict[str, Any]) -> Tuple[Dict[str, Any], str]:
+    """Valida objective/beta/k/min_recall do /auto_threshold. Retorna (params, erro)."""
+    objective = (data.get("objective") or "f1").strip().lower()
+    if objective not in THRESHOLD_OBJECTIVES:
+        return {}, "objective inválido"
+    beta = _safe_float(data.get("beta"), 1.0)
+    k = _safe_int(data.get("k"), 0)
+    min_recall = _safe_float(data.get("min_recall"), None)
+    if objective == "fbeta" and not (beta and beta > 0):
+        return {}, "beta deve ser > 0"
+    if objective == "precision_at_k" and k < 1:
+        return {}, "k deve ser >= 1"
+    if objective == "min_recall" and (min_recall is None or not 0.0 <= min_recall <= 1.0):
+        return {}, "min_recall deve estar entre 0 e 1"
+    return {"objective": objective, "beta": beta, "k": k, "min_recall": min_recall, "curve": bool(data.get("curve"))}, ""
+
+def _auto_threshold_run(client_id: str, params: Dict[str, Any], progress=None) -> Dict[str, Any]:
+    """Calcula e salva o threshold ótimo do workspace (params validados por _threshold_params)."""
+    _require_ml()
     labeled = _get_labeled_rows(client_id)
     can, reason, classes = _can_train(labeled)
     if not can:
-        return _json_ok({
+        return {
             "client_id": client_id,
             "can_train": False,
             "classes_rotuladas": classes,
@@ -1337,31 +3032,433 @@ def auto_threshold():
             "precision": 0.0,
             "recall": 0.0,
             "f1": 0.0
-        })
+        }
 
     missing = [r for r in labeled if r.get("probabilidade") is None]
     if missing:
-        X = np.vstack([_features_from_row(r) for r in labeled])
-        y = np.array([1 if float(r["virou_cliente"]) == 1.0 else 0 for r in labeled], dtype=int)
-        pipe = _train_pipeline(X, y)
+        pipe, _ = _fit_or_load_model(client_id, labeled, classes)
         ids = [int(r["id"]) for r in missing]
         probs = _predict_for_rows(pipe, missing)
         _update_probabilities(client_id, ids, probs)
-        labeled = _get_labeled_rows(client_id)
-
-    best_t = _best_threshold(labeled)
+        for r, p in zip(missing, probs):
+            r["probabilidade"] = float(p)
+    if progress:
+        progress(0.5)
+
+    objective = params.get("objective") or "f1"
+    m = _optimize_threshold(labeled, objective=objective, beta=params.get("beta") or 1.0,
+                            k=params.get("k"), min_recall=params.get("min_recall"))
+    best_t = m["threshold"]
     _set_threshold(client_id, best_t)
 
-    m = _compute_precision_recall(labeled, best_t)
-    return _json_ok({"client_id": client_id, "threshold": float(best_t), "precision": float(m["precision"]), "recall": float(m["recall"]), "f1": float(m["f1"])})
+    out = {
+        "client_id": client_id,
+        "threshold": float(best_t),
+        "precision": float(m["precision"]),
+        "recall": float(m["recall"]),
+        "f1": float(m["f1"]),
+        "objective": objective,
+        "objective_value": float(m["objective_value"]),
+        "labeled_count": len(labeled),
+    }
+    curve = m.get("curve")
+    if params.get("curve") and curve is not None:
+        out["curve"] = {
+            "threshold": [float(x) for x in curve["thresholds"]],
+            "precision": [float(x) for x in curve["precision"]],
+            "recall": [float(x) for x in curve["recall"]],
+        }
+    return out
+
+def _rescore_all_run(client_id: str, params: Dict[str, Any], progress=None) -> Dict[str, Any]:
+    """Recalcula TODOS os pendentes do workspace em lotes (keyset em (created_at, id))."""
+    labeled = _get_labeled_rows(client_id)
+    can, reason, classes = _can_train(labeled)
+    if not can:
+        return {"client_id": client_id, "can_train": False, "classes_rotuladas": classes, "labeled_count": len(labeled), "reason": reason, "updated": 0}
 
+    pipe, model_info = _fit_or_load_model(client_id, labeled, classes)
+    batch = max(100, min(_safe_int(params.get("batch"), 5000), 20000))
+
+    conn = _db()
+    try:
+        with conn:
+            with conn.cursor(row_factory=dict_row) as cur:
+                cur.execute(
+                    "SELECT COALESCE(SUM(n), 0)::bigint AS n FROM leads_daily_stats_live WHERE client_id=%s AND status = -1",
+                    (client_id,),
+                )
+                total = int((cur.fetchone() or {}).get("n") or 0)
+    finally:
+        conn.close()
+
+    seen = updated = 0
+    after = None
+    while True:
+        sql, args = _recent_leads_query(client_id, batch, filters={"status": "pending"}, after=after)
+        rows = _run_queries([(sql, args)])[0]
+        if not rows:
+            break
+        probs = _predict_for_rows(pipe, rows)
+        updated += _update_probabilities(client_id, [int(r["id"]) for r in rows], probs)
+        seen += len(rows)
+        after = (rows[-1]["created_at"], rows[-1]["id"])
+        if progress and total:
+            progress(min(0.99, seen / total))
+        if len(rows) < batch:
+            break
+
+    return {
+        "client_id": client_id,
+        "can_train": True,
+        "labeled_count": len(labeled),
+        "model_version": model_info["model_version"],
+        "refit": model_info["refit"],
+        "pending_seen": seen,
+        "updated": updated,
+    }
+
+
+@app.get("/recalc_pending")
+def recalc_pending():
+    """
+    Recalcula probabilidade para pendentes com base nos rotulados (requer numpy/sklearn).
+    ?async=1 -> enfileira um job (ver /jobs/<id>) e responde 202.
+    """
+    if not _ml_available():
+        return _ml_unavailable()
+
+    client_id = (request.args.get("client_id") or "").strip()
+    limit = _safe_int(request.args.get("limit"), 500)
+    limit = max(10, min(limit, 5000))
+    if not client_id:
+        return _json_err("client_id obrigatório", 400)
+
+    ok_auth, _, msg = _require_client_auth(client_id)
+    if not ok_auth:
+        return _json_err(msg, 403, code="auth_required")
+
+    if (request.args.get("async") or "").strip().lower() in ("1", "true", "yes"):
+        return _job_accepted(*_enqueue_job(client_id, "recalc", {"limit": limit}))
+
+    return _json_ok(_recalc_pending_run(client_id, limit))
+
+
+@app.post("/auto_threshold")
+def auto_threshold():
+    """
+    Calcula e salva o threshold ótimo sobre a curva exata (requer numpy/sklearn).
+    Body opcional:
+      "objective": "f1" (padrão) | "fbeta" | "precision_at_k" | "min_recall"
+      "beta": 0.5, "k": 50, "min_recall": 0.8
+      "curve": true  -> inclui a curva precision/recall completa
+      "async": true  -> enfileira um job (ver /jobs/<id>) e responde 202
+    """
+    if not _ml_available():
+        return _ml_unavailable()
+
+    data = request.get_json(silent=True) or {}
+    client_id = (data.get("client_id") or "").strip()
+    if not client_id:
+        return _json_err("client_id obrigatório", 400)
+
+    params, err = _threshold_params(data)
+    if err:
+        return _json_err(err, 400, allowed=list(THRESHOLD_OBJECTIVES))
+
+    ok_auth, _, msg = _require_client_auth(client_id)
+    if not ok_auth:
+        return _json_err(msg, 403, code="auth_required")
+
+    if data.get("async"):
+        return _job_accepted(*_enqueue_job(client_id, "auto_threshold", params))
+
+    return _json_ok(_auto_threshold_run(client_id, params))
+
+
+# =========================
+# Jobs (fila em Postgres + pool de threads por processo)
+# =========================
+# O processo run-jobs (ou, no modo in-process, cada worker web com JOB_WORKERS > 0) roda
+# threads que pegam jobs com FOR UPDATE SKIP LOCKED. Enquanto o job roda, uma thread de heartbeat o renova a cada
+# JOB_STALE_SECONDS/3 (independente de progress(), que não é chamado durante um fit).
+# Um job "running" sem heartbeat por JOB_STALE_SECONDS (worker morto/reiniciado) volta
+# para a fila até JOB_MAX_ATTEMPTS tentativas; toda escrita do worker exige que o job
+# ainda seja dele (locked_by + running), então um worker que perdeu o job não o fecha.
+# Dedupe: no máximo um job ativo (queued/running) por (client_id, kind).
+_JOB_HANDLERS = {
+    "recalc": lambda client_id, params, progress: _recalc_pending_run(
+        client_id, max(10, min(_safe_int(params.get("limit"), 500), 5000)), progress),
+    "auto_threshold": lambda client_id, params, progress: _auto_threshold_run(client_id, params, progress),
+    "rescore": lambda client_id, params, progress: _rescore_all_run(client_id, params, progress),
+}
+_JOB_PUBLIC_FIELDS = ("id", "client_id", "kind", "status", "params", "progress", "result", "error",
+                      "attempts", "created_at", "started_at", "finished_at")
+_JOB_THREADS: List[threading.Thread] = []
+_JOB_THREADS_PID = 0
+_JOB_STOP = threading.Event()
+_JOB_LOCK = threading.Lock()
+
+def _job_public(job: Dict[str, Any]) -> Dict[str, Any]:
+    out = {k: job.get(k) for k in _JOB_PUBLIC_FIELDS}
+    for k in ("created_at", "started_at", "finished_at"):
+        out[k] = _iso(out.get(k))
+    return out
+
+def _enqueue_job(client_id: str, kind: str, params: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+    """Enfileira (ou devolve o job ativo equivalente). Retorna (job, criado)."""
+    _ensure_schema_once()
+    _ensure_job_workers()
+    conn = _db()
+    try:
+        with conn:
+            with conn.cursor(row_factory=dict_row) as cur:
+                cur.execute(
+                    """
+                    INSERT INTO jobs (client_id, kind, params)
+                    VALUES (%s, %s, %s::jsonb)
+                    ON CONFLICT (client_id, kind) WHERE status IN ('queued', 'running') DO NOTHING
+                    RETURNING *
+                    """,
+                    (client_id, kind, json.dumps(params)),
+                )
+                job = cur.fetchone()
+                if job:
+                    return dict(job), True
+                cur.execute(
+                    "SELECT * FROM jobs WHERE client_id=%s AND kind=%s AND status IN ('queued', 'running') ORDER BY id DESC LIMIT 1",
+                    (client_id, kind),
+                )
+                return dict(cur.fetchone() or {}), False
+    finally:
+        conn.close()
+
+def _job_accepted(job: Dict[str, Any], created: bool):
+    return _json_ok({"job": _job_public(job), "deduplicated": not created, "poll": f"/jobs/{job.get('id')}"}, 202)
+
+class _JobLost(RuntimeError):
+    """O job foi reenfileirado/pego por outro worker (heartbeat expirou)."""
+
+
+def _job_update(job_id: int, worker_id: str, sql_set: str = "", params: tuple = ()) -> bool:
+    """Atualiza o job (e o heartbeat) só se ainda for deste worker. False = job perdido."""
+    sets = f"{sql_set}, heartbeat_at=NOW()" if sql_set else "heartbeat_at=NOW()"
+    conn = _db()
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"UPDATE jobs SET {sets} WHERE id=%s AND locked_by=%s AND status='running'",
+                    (*params, job_id, worker_id),
+                )
+                return cur.rowcount > 0
+    finally:
+        conn.close()
+
+def _job_heartbeat(job_id: int, worker_id: str, stop: threading.Event) -> None:
+    interval = max(1.0, JOB_STALE_SECONDS / 3.0)
+    while not stop.wait(interval):
+        try:
+            if not _job_update(job_id, worker_id):
+                return
+        except Exception:
+            _log_exception(f"falha no heartbeat do job {job_id}")
+
+def _claim_job(worker_id: str) -> Optional[Dict[str, Any]]:
+    """Reenfileira jobs órfãos e pega o próximo job da fila (SKIP LOCKED)."""
+    conn = _db()
+    try:
+        with conn:
+            with conn.cursor(row_factory=dict_row) as cur:
+                cur.execute(
+                    """
+                    UPDATE jobs
+                    SET status = CASE WHEN attempts < %s THEN 'queued' ELSE 'failed' END,
+                        error = CASE WHEN attempts < %s THEN error ELSE 'worker perdido (timeout de heartbeat)' END,
+                        finished_at = CASE WHEN attempts < %s THEN NULL ELSE NOW() END,
+                        locked_by = NULL
+                    WHERE status = 'running' AND heartbeat_at < NOW() - (%s || ' seconds')::interval
+                    """,
+                    (JOB_MAX_ATTEMPTS, JOB_MAX_ATTEMPTS, JOB_MAX_ATTEMPTS, int(JOB_STALE_SECONDS)),
+                )
+                cur.execute(
+                    """
+                    UPDATE jobs
+                    SET status='running', attempts=attempts+1, locked_by=%s,
+                        started_at=NOW(), heartbeat_at=NOW(), progress=0
+                    WHERE id = (
+                        SELECT id FROM jobs WHERE status='queued'
+                        ORDER BY id
+                        FOR UPDATE SKIP LOCKED
+                        LIMIT 1
+                    )
+                    RETURNING *
+                    """,
+                    (worker_id,),
+                )
+                job = cur.fetchone()
+                return dict(job) if job else None
+    finally:
+        conn.close()
+
+def _execute_job(job: Dict[str, Any], worker_id: str) -> None:
+    job_id = int(job["id"])
+    handler = _JOB_HANDLERS.get(job["kind"])
+    if handler is None:
+        _job_update(job_id, worker_id, "status='failed', error=%s, finished_at=NOW()", (f"kind desconhecido: {job['kind']}",))
+        return
+
+    def progress(p: float) -> None:
+        if not _job_update(job_id, worker_id, "progress=%s", (float(p),)):
+            raise _JobLost(f"job {job_id} não é mais de {worker_id}")
+
+    stop = threading.Event()
+    beat = threading.Thread(target=_job_heartbeat, args=(job_id, worker_id, stop), name=f"job-heartbeat-{job_id}", daemon=True)
+    beat.start()
+    try:
+        result = handler(job["client_id"], job.get("params") or {}, progress)
+    except _JobLost:
+        logging.warning("job %s (%s) perdido pelo worker %s; resultado descartado", job_id, job["kind"], worker_id)
+        return
+    except Exception as e:
+        _log_exception(f"job {job_id} ({job['kind']}) falhou")
+        _job_update(job_id, worker_id, "status='failed', error=%s, finished_at=NOW()", (repr(e)[:2000],))
+        return
+    finally:
+        stop.set()
+        beat.join()
+    if not _job_update(job_id, worker_id, "status='done', progress=1, result=%s::jsonb, error=NULL, finished_at=NOW()",
+                       (json.dumps(result),)):
+        logging.warning("job %s (%s) perdido pelo worker %s; resultado descartado", job_id, job["kind"], worker_id)
+
+def _job_worker_loop(worker_id: str) -> None:
+    while not _JOB_STOP.is_set():
+        try:
+            job = _claim_job(worker_id)
+        except Exception:
+            _log_exception("falha ao buscar job")
+            job = None
+        if job is None:
+            _JOB_STOP.wait(JOB_POLL_SECONDS)
+            continue
+        _execute_job(job, worker_id)
+
+def _ensure_job_workers(n: Optional[int] = None) -> None:
+    """Sobe as threads de job deste processo (uma vez por pid; seguro após fork do gunicorn)."""
+    global _JOB_THREADS, _JOB_THREADS_PID
+    n = JOB_WORKERS if n is None else n
+    if n <= 0 or not DATABASE_URL or not _ml_available():
+        return
+    pid = os.getpid()
+    if _JOB_THREADS_PID == pid:
+        return
+    with _JOB_LOCK:
+        if _JOB_THREADS_PID == pid:
+            return
+        _JOB_THREADS = []
+        # locked_by único entre hosts/reinícios (pids se repetem entre containers)
+        tag = uuid.uuid4().hex[:8]
+        for i in range(n):
+            t = threading.Thread(target=_job_worker_loop, args=(f"{pid}-{tag}-{i}",), name=f"job-worker-{i}", daemon=True)
+            t.start()
+            _JOB_THREADS.append(t)
+        _JOB_THREADS_PID = pid
+
+
+@app.before_request
+def _start_job_workers():
+    # só no modo in-process (JOB_WORKERS > 0); no padrão é um no-op
+    if JOB_WORKERS > 0:
+        _ensure_job_workers()
+
+
+@app.post("/jobs")
+def jobs_create():
+    """
+    Enfileira um job longo.
+    Body: {"client_id": "...", "kind": "recalc" | "auto_threshold" | "rescore", "params": {...}}
+    """
+    if not _ml_available():
+        return _ml_unavailable()
+
+    data = request.get_json(silent=True) or {}
+    client_id = (data.get("client_id") or "").strip()
+    kind = (data.get("kind") or "").strip().lower()
+    params = data.get("params") or {}
+    if not client_id:
+        return _json_err("client_id obrigatório", 400)
+    if kind not in _JOB_HANDLERS:
+        return _json_err("kind inválido", 400, allowed=list(_JOB_HANDLERS.keys()))
+    if not isinstance(params, dict):
+        return _json_err("params deve ser um objeto", 400)
+    if kind == "auto_threshold":
+        params, err = _threshold_params(params)
+        if err:
+            return _json_err(err, 400)
+
+    ok_auth, _, msg = _require_client_auth(client_id)
+    if not ok_auth:
+        return _json_err(msg, 403, code="auth_required")
+
+    return _job_accepted(*_enqueue_job(client_id, kind, params))
+
+
+@app.get("/jobs/<int:job_id>")
+def jobs_status(job_id: int):
+    """Status/progresso/resultado de um job do workspace."""
+    client_id = (request.args.get("client_id") or "").strip()
+    if not client_id:
+        return _json_err("client_id obrigatório", 400)
+
+    ok_auth, _, msg = _require_client_auth(client_id)
+    if not ok_auth:
+        return _json_err(msg, 403, code="auth_required")
+
+    _ensure_schema_once()
+    conn = _db()
+    try:
+        with conn:
+            with conn.cursor(row_factory=dict_row) as cur:
+                cur.execute("SELECT * FROM jobs WHERE id=%s AND client_id=%s", (job_id, client_id))
+                job = cur.fetchone()
+    finally:
+        conn.close()
+    if not job:
+        return _json_err("Job não encontrado", 404)
+    return _json_ok({"job": _job_public(dict(job))})
+
+
+@app.cli.command("run-jobs")
+def run_jobs_cmd():
+    """flask --app app run-jobs  -> processo dedicado só para jobs (JOB_RUNNER_THREADS threads)."""
+    _ensure_job_workers(max(1, JOB_RUNNER_THREADS))
+    try:
+        while any(t.is_alive() for t in _JOB_THREADS):
+            # jobs também escrevem em leads: compacta o rollup mesmo sem tráfego web
+            _maybe_compact_daily_stats()
+            time.sleep(1)
+    except KeyboardInterrupt:
+        _JOB_STOP.set()
+
+
+_INSIGHT_BANDS = [
+    ("0-0.2", 0.0, 0.2),
+    ("0.2-0.4", 0.2, 0.4),
+    ("0.4-0.6", 0.4, 0.6),
+    ("0.6-0.8", 0.6, 0.8),
+    ("0.8-1.0", 0.8, 1.01),
+]
+
+# bucket do rollup (ver migrations.STATS_BREAKS) -> índice da faixa em _INSIGHT_BANDS
+_BUCKET_TO_BAND = (0, 1, 1, 2, 3, 3, 4)
 
 @app.get("/insights")
+@_etag_cached
 def insights():
-    """Insights para dashboard (conversão por faixa e série diária)."""
+    """Insights para dashboard (conversão por faixa e série diária em America/Sao_Paulo, via rollup)."""
     client_id = (request.args.get("client_id") or "").strip()
     days = _safe_int(request.args.get("days"), 14)
-    days = max(7, min(days, 90))
+    days = max(7, min(days, INSIGHTS_MAX_DAYS))
     if not client_id:
         return _json_err("client_id obrigatório", 400)
 
@@ -1370,7 +3467,7 @@ def insights():
         return _json_err(msg, 403, code="auth_required")
 
     threshold = _get_threshold(client_id)
-    since = _now_utc() - timedelta(days=days)
+    since_day = _sp_today() - timedelta(days=days - 1)
 
     _ensure_schema_once()
     conn = _db()
@@ -1379,140 +3476,309 @@ def insights():
             with conn.cursor(row_factory=dict_row) as cur:
                 cur.execute(
                     """
-                    SELECT probabilidade, virou_cliente, created_at
-                    FROM leads
-                    WHERE client_id=%s AND created_at >= %s
-                    ORDER BY created_at ASC
+                    SELECT day, bucket, status, SUM(n)::bigint AS n
+                    FROM leads_daily_stats_live
+                    WHERE client_id=%s AND day >= %s
+                    GROUP BY day, bucket, status
+                    HAVING SUM(n) <> 0
                     """,
-                    (client_id, since),
+                    (client_id, since_day),
                 )
-                rows = [dict(r) for r in (cur.fetchall() or [])]
+                agg = cur.fetchall() or []
     finally:
         conn.close()
 
-    bands_def = [
-        ("0-0.2", 0.0, 0.2),
-        ("0.2-0.4", 0.2, 0.4),
-        ("0.4-0.6", 0.4, 0.6),
-        ("0.6-0.8", 0.6, 0.8),
-        ("0.8-1.0", 0.8, 1.01),
-    ]
+    band_lab = [0] * len(_INSIGHT_BANDS)
+    band_conv = [0] * len(_INSIGHT_BANDS)
+    by_day: Dict[str, Dict[str, Any]] = {}
+    total_all = conv_all = den_all = labeled_all = 0
+    for r in agg:
+        n = int(r["n"])
+        bucket, status = int(r["bucket"]), int(r["status"])
+        day = r["day"].isoformat()
+        d = by_day.setdefault(day, {"day": day, "total": 0, "converted": 0, "denied": 0, "pending": 0})
+        d["total"] += n
+        total_all += n
+        if status == -1:
+            d["pending"] += n
+            continue
+        labeled_all += n
+        if status == 1:
+            d["converted"] += n
+            conv_all += n
+        else:
+            d["denied"] += n
+            if status == 0:
+                den_all += n
+        if 0 <= bucket < len(_BUCKET_TO_BAND):
+            b = _BUCKET_TO_BAND[bucket]
+            band_lab[b] += n
+            if status == 1:
+                band_conv[b] += n
 
     bands = []
-    for name, lo, hi in bands_def:
-        subset = [r for r in rows if r.get("probabilidade") is not None and lo <= float(r["probabilidade"]) < hi]
-        labeled = [r for r in subset if r.get("virou_cliente") is not None]
-        conv = sum(1 for r in labeled if float(r["virou_cliente"]) == 1.0)
-        total = len(labeled)
+    for i, (name, _, _) in enumerate(_INSIGHT_BANDS):
+        total, conv = band_lab[i], band_conv[i]
         rate = (conv / total) if total else 0.0
         bands.append({"band": name, "labeled": total, "converted": conv, "conversion_rate": round(float(rate), 4)})
 
-    by_day: Dict[str, Dict[str, Any]] = {}
-    for r in rows:
-        dt = r.get("created_at")
-        if not dt:
-            continue
-        day = dt.date().isoformat()
-        by_day.setdefault(day, {"day": day, "total": 0, "converted": 0, "denied": 0, "pending": 0})
-        by_day[day]["total"] += 1
-        vc = r.get("virou_cliente")
-        if vc is None:
-            by_day[day]["pending"] += 1
-        elif float(vc) == 1.0:
-            by_day[day]["converted"] += 1
-        else:
-            by_day[day]["denied"] += 1
-
     series = [by_day[k] for k in sorted(by_day.keys())]
-
-    labeled_all = [r for r in rows if r.get("virou_cliente") is not None]
-    conv_all = sum(1 for r in labeled_all if float(r["virou_cliente"]) == 1.0)
-    den_all = sum(1 for r in labeled_all if float(r["virou_cliente"]) == 0.0)
-    overall_rate = (conv_all / len(labeled_all)) if labeled_all else 0.0
+    overall_rate = (conv_all / labeled_all) if labeled_all else 0.0
 
     return _json_ok({
         "client_id": client_id,
         "threshold": float(threshold),
         "overall": {
-            "window_total": len(rows),
-            "labeled": len(labeled_all),
+            "window_total": total_all,
+            "labeled": labeled_all,
             "converted": conv_all,
             "denied": den_all,
             "conversion_rate": round(float(overall_rate), 4),
         },
         "bands": bands,
         "series": series,
+        "series_tz": "America/Sao_Paulo",
         "window_days": days,
     })
 
 
+def _parse_date_param(v: str, end: bool = False) -> Optional[datetime]:
+    """
+    Aceita ISO datetime ou data (YYYY-MM-DD, dia em America/Sao_Paulo).
+    Com end=True, uma data pura vira o início do dia seguinte (limite exclusivo).
+    """
+    v = (v or "").strip()
+    if not v:
+        return None
+    try:
+        if len(v) == 10:
+            d = datetime.strptime(v, "%Y-%m-%d").replace(tzinfo=_SP_TZ)
+            return d + timedelta(days=1) if end else d
+        dt = datetime.fromisoformat(v.replace("Z", "+00:00"))
+        return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+    except ValueError:
+        raise ValueError(f"data inválida: {v}")
+
+_STATUS_FILTERS = {
+    "converted": "virou_cliente = 1",
+    "denied": "virou_cliente = 0",
+    "pending": "virou_cliente IS NULL",
+    "labeled": "virou_cliente IS NOT NULL",
+}
+
 @app.get("/leads_export.csv")
 def leads_export_csv():
-    """Export CSV server-side. Útil para CRM / planilha."""
+    """
+    Export CSV server-side (streaming, sem limite fixo). Útil para CRM / planilha.
+    Query opcional:
+      since / until: ISO ou YYYY-MM-DD (until inclusivo para datas puras)
+      status: converted | denied | pending | labeled
+      limit: corta em N rows (padrão: sem limite)
+      gzip=1: responde .csv.gz
+    """
     client_id = (request.args.get("client_id") or "").strip()
-    limit = _safe_int(request.args.get("limit"), 5000)
-    limit = max(10, min(limit, 20000))
+    limit = _safe_int(request.args.get("limit"), 0)
+    status = (request.args.get("status") or "").strip().lower()
+    use_gzip = (request.args.get("gzip") or "").strip().lower() in ("1", "true", "yes")
     if not client_id:
         return Response("client_id obrigatório", status=400, mimetype="text/plain")
+    if status and status not in _STATUS_FILTERS:
+        return Response("status inválido", status=400, mimetype="text/plain")
+    try:
+        since = _parse_date_param(request.args.get("since") or "")
+        until = _parse_date_param(request.args.get("until") or "", end=True)
+    except ValueError as e:
+        return Response(str(e), status=400, mimetype="text/plain")
 
     ok_auth, _, msg = _require_client_auth(client_id)
     if not ok_auth:
         return Response("auth_required", status=403, mimetype="text/plain")
 
+    headers = ["id","nome","email_lead","telefone","probabilidade","virou_cliente","tempo_site","paginas_visitadas","clicou_preco","created_at"]
+    where = ["client_id=%s"]
+    params: List[Any] = [client_id]
+    if since:
+        where.append("created_at >= %s"); params.append(since)
+    if until:
+        where.append("created_at < %s"); params.append(until)
+    if status:
+        where.append(_STATUS_FILTERS[status])
+    sql = f"SELECT {', '.join(headers)} FROM leads WHERE {' AND '.join(where)} ORDER BY created_at DESC, id DESC"
+    if limit > 0:
+        sql += " LIMIT %s"
+        params.append(int(limit))
+
+    _ensure_schema_once()
+    created_idx = headers.index("created_at")
+
+    def rows_csv():
+        buf = io.StringIO()
+        w = csv.writer(buf, quoting=csv.QUOTE_ALL, lineterminator="\n")
+        buf.write(",".join(headers) + "\n")
+        conn = _db()
+        try:
+            with conn:
+                # cursor server-side: memória constante independente do nº de rows
+                with conn.cursor(name=f"export_{secrets.token_hex(4)}", row_factory=tuple_row) as cur:
+                    cur.itersize = EXPORT_FETCH_SIZE
+                    cur.execute(sql, params)
+                    for r in cur:
+                        r = list(r)
+                        if isinstance(r[created_idx], datetime):
+                            r[created_idx] = _iso(r[created_idx])
+                        w.writerow(r)
+                        if buf.tell() >= EXPORT_CHUNK_BYTES:
+                            yield buf.getvalue()
+                            buf.seek(0)
+                            buf.truncate()
+        finally:
+            conn.close()
+        if buf.tell():
+            yield buf.getvalue()
+
+    def gzipped(chunks):
+        z = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> container gzip
+        for c in chunks:
+            out = z.compress(c.encode("utf-8"))
+            if out:
+                yield out
+        yield z.flush()
+
+    filename = f"leadrank_{client_id}.csv"
+    if use_gzip:
+        return Response(
+            gzipped(rows_csv()),
+            status=200,
+            mimetype="application/gzip",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.gz"'},
+        )
+    return Response(
+        rows_csv(),
+        status=200,
+        mimetype="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+# -------------------------
+# Rate limit (token bucket em Postgres) + leads demo
+# -------------------------
+_RL_DENY_CACHE = _TTLCache(4096, RL_DENY_CACHE_TTL)
+
+
+def _rate_limit_take(bucket: str, capacity: float, window_seconds: float) -> Tuple[bool, float]:
+    """
+    Consome 1 token do bucket (token bucket: capacidade `capacity`, recarga de
+    `capacity` tokens a cada `window_seconds`). Estado numa row de rate_limits,
+    atualizado atomicamente -> o limite vale para todos os workers/instâncias.
+    Retorna (permitido, segundos até o próximo token).
+    Buckets cheios equivalem a ausentes e são removidos aos poucos (memória limitada).
+    """
+    denied_until = _RL_DENY_CACHE.get(bucket)
+    if denied_until is not None and denied_until > time.monotonic():
+        return False, denied_until - time.monotonic()
+
+    capacity = max(1.0, float(capacity))
+    rate = capacity / max(1.0, float(window_seconds))
+    refill = "LEAST(%(cap)s, r.tokens + EXTRACT(EPOCH FROM NOW() - r.updated_at)::double precision * %(rate)s)"
+    params = {"bucket": bucket, "cap": capacity, "rate": rate}
     _ensure_schema_once()
     conn = _db()
     try:
         with conn:
             with conn.cursor(row_factory=dict_row) as cur:
                 cur.execute(
-                    """
-                    SELECT id, nome, email_lead, telefone, probabilidade, virou_cliente,
-                           tempo_site, paginas_visitadas, clicou_preco, created_at
-                    FROM leads
-                    WHERE client_id=%s
-                    ORDER BY created_at DESC
-                    LIMIT %s
+                    f"""
+                    INSERT INTO rate_limits AS r (bucket, tokens, updated_at)
+                    VALUES (%(bucket)s, %(cap)s - 1, NOW())
+                    ON CONFLICT (bucket) DO UPDATE
+                    SET tokens = {refill} - 1, updated_at = NOW()
+                    WHERE {refill} >= 1
+                    RETURNING tokens
                     """,
-                    (client_id, int(limit)),
+                    params,
                 )
-                rows = [dict(r) for r in (cur.fetchall() or [])]
+                allowed = cur.fetchone() is not None
+                retry_after = 0.0
+                if not allowed:
+                    cur.execute(f"SELECT {refill} AS tokens FROM rate_limits r WHERE bucket=%(bucket)s", params)
+                    row = cur.fetchone()
+                    tokens = float(row["tokens"]) if row else capacity
+                    retry_after = max(0.0, (1.0 - tokens) / rate)
+                if random.random() < RL_GC_PROBABILITY:
+                    prefix = bucket.split(":", 1)[0] + ":"
+                    cur.execute(
+                        "DELETE FROM rate_limits WHERE bucket LIKE %s AND updated_at < NOW() - make_interval(secs => %s)",
+                        (prefix + "%", float(window_seconds)),
+                    )
     finally:
         conn.close()
 
-    headers = ["id","nome","email_lead","telefone","probabilidade","virou_cliente","tempo_site","paginas_visitadas","clicou_preco","created_at"]
-    lines = [",".join(headers)]
-    for r in rows:
-        def esc(v):
-            s = "" if v is None else str(v)
-            s = s.replace('"', '""')
-            return f'"{s}"'
-        row = []
-        for h in headers:
-            v = r.get(h)
-            if h == "created_at" and isinstance(v, datetime):
-                v = _iso(v)
-            row.append(esc(v))
-        lines.append(",".join(row))
-    csv = "\n".join(lines)
+    if not allowed:
+        _RL_DENY_CACHE.set(bucket, time.monotonic() + min(retry_after, RL_DENY_CACHE_TTL))
+    return allowed, retry_after
+
+
+def _demo_rows(n: int) -> List[Dict[str, Any]]:
+    """Leads sintéticos (features + prob coerente + rótulo aleatório) para demos."""
+    rows = []
+    for _ in range(n):
+        tempo_site = random.randint(15, 420)
+        paginas = random.randint(1, 10)
+        clicou_preco = random.choice([0, 1])
+
+        base = 0.08
+        base += min(tempo_site / 450, 0.25)
+        base += min(paginas / 12, 0.25)
+        base += 0.22 if clicou_preco else 0.0
+        prob = max(0.03, min(0.97, base + random.uniform(-0.05, 0.05)))
+
+        label_vc = random.choices([None, 1.0, 0.0], weights=[0.45, 0.30, 0.25])[0]
+        nome = "Demo " + "".join(random.choice(string.ascii_uppercase) for _ in range(4))
+        email = "demo@leadrank.local"
+        telefone = "11999990000"
+        payload = {"nome": nome, "email": email, "telefone": telefone, "tempo_site": tempo_site, "paginas_visitadas": paginas, "clicou_preco": clicou_preco}
+        rows.append({
+            "nome": nome, "email_lead": email, "telefone": telefone, "tempo_site": tempo_site,
+            "paginas_visitadas": paginas, "clicou_preco": clicou_preco, "payload": payload,
+            "probabilidade": float(prob), "virou_cliente": label_vc,
+        })
+    return rows
 
-    return Response(
-        csv,
-        status=200,
-        mimetype="text/csv",
-        headers={"Content-Disposition": f'attachment; filename="leadrank_{client_id}.csv"'},
-    )
+
+def _insert_demo_leads(client_id: str, rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Grava os leads demo via COPY (uma ida ao banco) e devolve o resumo da resposta."""
+    conn = _db()
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                with cur.copy(
+                    "COPY leads (client_id, nome, email_lead, telefone, tempo_site, paginas_visitadas, "
+                    "clicou_preco, payload, probabilidade, virou_cliente) FROM STDIN"
+                ) as cp:
+                    for r in rows:
+                        cp.write_row((
+                            client_id, r["nome"], r["email_lead"], r["telefone"], r["tempo_site"],
+                            r["paginas_visitadas"], r["clicou_preco"], json.dumps(r["payload"]),
+                            r["probabilidade"], r["virou_cliente"],
+                        ))
+    finally:
+        conn.close()
+
+    conv = sum(1 for r in rows if r["virou_cliente"] == 1.0)
+    neg = sum(1 for r in rows if r["virou_cliente"] == 0.0)
+    return {"client_id": client_id, "inserted": len(rows), "converted": conv, "denied": neg, "pending": len(rows) - conv - neg}
 
 
 @app.post("/demo_public")
 def demo_public():
-    """Demo pública controlada (SEM DEMO_KEY) com rate-limit por IP/mês."""
-    mk = _month_key()
-    ip = _client_ip()
-    key = f"{ip}:{mk}"
-    if _DEMO_RL.get(key, 0) >= _DEMO_RL_MAX:
-        return _json_err("Limite de demos atingido para este IP neste mês.", 429, code="rate_limit")
-
-    _DEMO_RL[key] = _DEMO_RL.get(key, 0) + 1
+    """Demo pública controlada (SEM DEMO_KEY) com rate-limit por IP (compartilhado entre workers)."""
+    allowed, retry_after = _rate_limit_take(f"demo:{_client_ip()}", _DEMO_RL_MAX, DEMO_RL_WINDOW_SECONDS)
+    if not allowed:
+        resp = _json_err("Limite de demos atingido para este IP.", 429, code="rate_limit",
+                         retry_after=int(retry_after) + 1)
+        resp[0].headers["Retry-After"] = str(int(retry_after) + 1)
+        return resp
 
     data = request.get_json(silent=True) or {}
     n = max(10, min(_safe_int(data.get("n"), 30), 30))
@@ -1520,51 +3786,7 @@ def demo_public():
     suffix = "".join(random.choice(string.ascii_lowercase + string.digits) for _ in range(4))
     client_id = f"demo_{suffix}"
     _ensure_client_row(client_id, plan="demo")
-
-    inserted = 0
-    conv = 0
-    neg = 0
-
-    conn = _db()
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                for _ in range(n):
-                    tempo_site = random.randint(15, 420)
-                    paginas = random.randint(1, 10)
-                    clicou_preco = random.choice([0, 1])
-
-                    base = 0.08
-                    base += min(tempo_site / 450, 0.25)
-                    base += min(paginas / 12, 0.25)
-                    base += 0.22 if clicou_preco else 0.0
-                    prob = max(0.03, min(0.97, base + random.uniform(-0.05, 0.05)))
-
-                    label_vc = random.choices([None, 1.0, 0.0], weights=[0.45, 0.30, 0.25])[0]
-                    if label_vc == 1.0:
-                        conv += 1
-                    elif label_vc == 0.0:
-                        neg += 1
-
-                    nome = "Demo " + "".join(random.choice(string.ascii_uppercase) for _ in range(4))
-                    email = "demo@leadrank.local"
-                    telefone = "11999990000"
-                    payload = {"nome": nome, "email": email, "telefone": telefone, "tempo_site": tempo_site, "paginas_visitadas": paginas, "clicou_preco": clicou_preco}
-
-                    cur.execute(
-                        """
-                        INSERT INTO leads
-                          (client_id, nome, email_lead, telefone, tempo_site, paginas_visitadas, clicou_preco,
-                           payload, probabilidade, virou_cliente, created_at, updated_at)
-                        VALUES
-                          (%s,%s,%s,%s,%s,%s,%s,%s::jsonb,%s,%s,NOW(),NOW())
-                        """,
-                        (client_id, nome, email, telefone, tempo_site, paginas, clicou_preco, json.dumps(payload), float(prob), label_vc),
-                    )
-                    inserted += 1
-        return _json_ok({"client_id": client_id, "inserted": inserted, "converted": conv, "denied": neg, "pending": inserted - conv - neg})
-    finally:
-        conn.close()
+    return _json_ok(_insert_demo_leads(client_id, _demo_rows(n)))
 
 
 @app.post("/seed_demo")
@@ -1583,48 +3805,7 @@ def seed_demo():
         client_id = f"demo_{suffix}"
 
     _ensure_client_row(client_id, plan="demo")
-
-    inserted = 0
-    conv = 0
-    neg = 0
-    conn = _db()
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                for _ in range(n):
-                    tempo_site = random.randint(15, 420)
-                    paginas = random.randint(1, 10)
-                    clicou_preco = random.choice([0, 1])
-
-                    base = 0.08
-                    base += min(tempo_site / 450, 0.25)
-                    base += min(paginas / 12, 0.25)
-                    base += 0.22 if clicou_preco else 0.0
-                    prob = max(0.03, min(0.97, base + random.uniform(-0.05, 0.05)))
-
-                    label_vc = random.choices([None, 1.0, 0.0], weights=[0.45, 0.30, 0.25])[0]
-                    if label_vc == 1.0: conv += 1
-                    elif label_vc == 0.0: neg += 1
-
-                    nome = "Demo " + "".join(random.choice(string.ascii_uppercase) for _ in range(4))
-                    email = "demo@leadrank.local"
-                    telefone = "11999990000"
-                    payload = {"nome": nome, "email": email, "telefone": telefone, "tempo_site": tempo_site, "paginas_visitadas": paginas, "clicou_preco": clicou_preco}
-
-                    cur.execute(
-                        """
-                        INSERT INTO leads
-                          (client_id, nome, email_lead, telefone, tempo_site, paginas_visitadas, clicou_preco,
-                           payload, probabilidade, virou_cliente, created_at, updated_at)
-                        VALUES
-                          (%s,%s,%s,%s,%s,%s,%s,%s::jsonb,%s,%s,NOW(),NOW())
-                        """,
-                        (client_id, nome, email, telefone, tempo_site, paginas, clicou_preco, json.dumps(payload), float(prob), label_vc),
-                    )
-                    inserted += 1
-        return _json_ok({"client_id": client_id, "inserted": inserted, "converted": conv, "denied": neg, "pending": inserted - conv - neg})
-    finally:
-        conn.close()
+    return _json_ok(_insert_demo_leads(client_id, _demo_rows(n)))
 
 
 @app.post("/seed_test_leads")
@@ -1642,20 +3823,6 @@ def seed_test_leads():
         return _json_err(msg, 403, code="auth_required")
 
     plan = (client_row.get("plan") or "trial").lower()
-    cat = PLAN_CATALOG.get(plan, PLAN_CATALOG["trial"])
-    used = int(client_row.get("leads_used_month") or 0)
-    limit = int(cat.get("lead_limit_month") or 0)
-    if limit > 0 and used + n > limit:
-        return _json_err(
-            "Limite mensal atingido. Faça upgrade para continuar.",
-            402,
-            code="plan_limit",
-            plan=plan,
-            used=used,
-            limit=limit,
-            price_brl_month=cat.get("price_brl_month"),
-            setup_fee_brl=cat.get("setup_fee_brl", 0),
-        )
 
     inserted = 0
     conv = 0
@@ -1664,6 +3831,10 @@ def seed_test_leads():
     try:
         with conn:
             with conn.cursor() as cur:
+                # tudo ou nada: reserva parcial sai por exceção e o rollback devolve
+                granted, quota = _quota_take(cur, client_id, n)
+                if granted < n:
+                    raise _QuotaExceeded(dict(quota, used=quota.get("used", 0) - granted))
                 for _ in range(n):
                     tempo_site = random.randint(15, 420)
                     paginas = random.randint(1, 10)
@@ -1705,12 +3876,6 @@ def seed_test_leads():
                     )
                     inserted += 1
 
-            with conn.cursor() as cur:
-                cur.execute(
-                    "UPDATE clients SET leads_used_month = leads_used_month + %s, updated_at=NOW() WHERE client_id=%s",
-                    (inserted, client_id),
-                )
-
         return _json_ok({
             "client_id": client_id,
             "inserted": inserted,
@@ -1718,6 +3883,8 @@ def seed_test_leads():
             "denied": neg,
             "pending": inserted - conv - neg,
         })
+    except _QuotaExceeded as e:
+        return _plan_limit_error(e.info.get("plan") or plan, e.info.get("used", 0), e.info.get("limit", 0))
     finally:
         conn.close()
 
@@ -1770,6 +3937,8 @@ def _upsert_subscription(client_id: str, plan: str, status: str, provider: str =
                 elif status in ("past_due", "canceled", "inactive"):
                     # por padrão, desativa. Se quiser "grace period", ajuste aqui.
                     cur.execute("UPDATE clients SET status='inactive', updated_at=NOW() WHERE client_id=%s", (client_id,))
+                _bump_workspace_version(cur, client_id)
+        _invalidate_workspace(client_id)
     finally:
         conn.close()
 
@@ -1795,11 +3964,327 @@ def admin_reset_month():
                 """, (mk, mk))
                 cur.execute("SELECT COUNT(*) AS n FROM clients")
                 n = int((cur.fetchone() or {}).get("n") or 0)
+                cur.execute("UPDATE workspace_versions SET version = version + 1, updated_at=NOW()")
+        _invalidate_workspace()
         return _json_ok({"usage_month": mk, "clients_total": n})
     finally:
         conn.close()
 
 
+@app.post("/admin/quota_reconcile")
+def admin_quota_reconcile():
+    """
+    Admin: recalcula a cota usada a partir de leads.
+    Body: {"client_id": "..."} (omitido = todos com uso no mês), {"month": "YYYY-MM"} (padrão: atual)
+    """
+    if not _admin_required():
+        return _json_err("Unauthorized (DEMO_KEY)", 403)
+    data = request.get_json(silent=True) or {}
+    client_id = (data.get("client_id") or "").strip()
+    month = (data.get("month") or "").strip() or _month_key()
+    if not re.fullmatch(r"\d{4}-(0[1-9]|1[0-2])", month):
+        return _json_err("month deve ser YYYY-MM", 400)
+    results = [_quota_reconcile(client_id, month)] if client_id else _quota_reconcile_all(month)
+    return _json_ok({
+        "month": month,
+        "reconciled": len(results),
+        "drift_total": sum(r["drift"] for r in results),
+        "results": [r for r in results if r["drift"]] if not client_id else results,
+    })
+
+
+def _rebuild_daily_stats(client_id: Optional[str] = None) -> int:
+    _ensure_schema_once()
+    conn = _db()
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                return migrations.rebuild_daily_stats(cur, client_id)
+    finally:
+        conn.close()
+
+
+@app.post("/admin/rebuild_daily_stats")
+def admin_rebuild_daily_stats():
+    """Admin: recalcula leads_daily_stats a partir de leads (client_id opcional; vazio = todos)."""
+    if not _admin_required():
+        return _json_err("Unauthorized (DEMO_KEY)", 403)
+
+    data = request.get_json(silent=True) or {}
+    client_id = (data.get("client_id") or "").strip() or None
+    t0 = time.perf_counter()
+    rows = _rebuild_daily_stats(client_id)
+    return _json_ok({"client_id": client_id, "rollup_rows": rows, "elapsed_ms": round((time.perf_counter() - t0) * 1000, 1)})
+
+
+# -------------------------
+# Compactação do rollup (leads_daily_stats_delta -> leads_daily_stats)
+# -------------------------
+_STATS_COMPACT_AT = 0.0
+_STATS_COMPACT_BUSY = threading.Lock()
+
+
+def _compact_daily_stats(max_batches: int = 20) -> Dict[str, int]:
+    """Compacta os deltas pendentes, um lote de STATS_COMPACT_BATCH por transação."""
+    _ensure_schema_once()
+    total = {"deltas": 0, "workspaces": 0, "batches": 0}
+    for _ in range(max(1, max_batches)):
+        conn = _db()
+        try:
+            with conn:
+                with conn.cursor(row_factory=dict_row) as cur:
+                    res = migrations.compact_daily_stats(cur, STATS_COMPACT_BATCH)
+        finally:
+            conn.close()
+        if res is None:  # outro processo compactando
+            break
+        total["deltas"] += res["deltas"]
+        total["workspaces"] += res["workspaces"]
+        total["batches"] += 1
+        if res["deltas"] < STATS_COMPACT_BATCH:
+            break
+    return total
+
+
+def _compact_daily_stats_bg() -> None:
+    try:
+        _compact_daily_stats()
+    except Exception:
+        _log_exception("falha ao compactar deltas do rollup")
+    finally:
+        _STATS_COMPACT_BUSY.release()
+
+
+def _maybe_compact_daily_stats() -> None:
+    """No máx. 1x por STATS_COMPACT_SECONDS por processo, numa thread (não segura a request)."""
+    global _STATS_COMPACT_AT
+    now = time.monotonic()
+    if not DATABASE_URL or STATS_COMPACT_SECONDS <= 0 or now - _STATS_COMPACT_AT < STATS_COMPACT_SECONDS:
+        return
+    if not _SCHEMA_READY or not _STATS_COMPACT_BUSY.acquire(blocking=False):
+        return
+    _STATS_COMPACT_AT = now
+    threading.Thread(target=_compact_daily_stats_bg, name="stats-compact", daemon=True).start()
+
+
+@app.before_request
+def _stats_compact_tick():
+    _maybe_compact_daily_stats()
+
+
+# -------------------------
+# Partições mensais de leads
+# -------------------------
+_PARTITIONS_CHECKED_AT = 0.0
+_PARTITIONS_BUSY = threading.Lock()
+
+
+def _maintain_lead_partitions(force: bool = False) -> List[str]:
+    """Cria as partições mensais de leads que faltam (no máx. 1x por PARTITION_CHECK_SECONDS por processo)."""
+    global _PARTITIONS_CHECKED_AT
+    now = time.monotonic()
+    if not DATABASE_URL or (not force and now - _PARTITIONS_CHECKED_AT < PARTITION_CHECK_SECONDS):
+        return []
+    _PARTITIONS_CHECKED_AT = now
+    ok, _ = _ensure_schema_once()
+    if not ok:
+        return []
+    try:
+        conn = _db()
+        try:
+            with conn:
+                with conn.cursor(row_factory=dict_row) as cur:
+                    created = migrations.ensure_lead_partitions(cur)
+        finally:
+            conn.close()
+    except Exception:
+        _log_exception("falha ao criar partições de leads")
+        return []
+    if created:
+        logging.info("partições de leads criadas: %s", created)
+    return created
+
+
+def _maintain_lead_partitions_bg() -> None:
+    try:
+        _maintain_lead_partitions(force=True)
+    finally:
+        _PARTITIONS_BUSY.release()
+
+
+@app.before_request
+def _lead_partitions_tick():
+    # a DDL pode esperar até 2s pelo lock em leads: roda numa thread, nunca dentro da request
+    if not DATABASE_URL or time.monotonic() - _PARTITIONS_CHECKED_AT < PARTITION_CHECK_SECONDS:
+        return
+    if not _PARTITIONS_BUSY.acquire(blocking=False):
+        return
+    threading.Thread(target=_maintain_lead_partitions_bg, name="lead-partitions", daemon=True).start()
+
+
+@app.get("/admin/sql_stats")
+def admin_sql_stats():
+    """
+    Admin: top-N statements deste worker por tempo total (ou ?order=mean|max|calls).
+    ?top=20  ?reset=1 zera depois de ler (comparar antes/depois de um deploy).
+    """
+    if not _admin_required():
+        return _json_err("Unauthorized (DEMO_KEY)", 403)
+    top = max(1, min(_safe_int(request.args.get("top"), 20), 200))
+    order = (request.args.get("order") or "total").strip().lower()
+    out = _stmt_stats_top(top, order)
+    with _STMT_LOCK:
+        distinct = len(_STMT_STATS)
+        if (request.args.get("reset") or "").strip() in ("1", "true", "yes"):
+            _STMT_STATS.clear()
+    return _json_ok({
+        "pid": os.getpid(),
+        "order": order if order in ("total", "mean", "max", "calls") else "total",
+        "distinct_statements": distinct,
+        "slow_query_ms": SLOW_QUERY_MS,
+        "statements": out,
+    })
+
+
+@app.get("/admin/profiles/<pid>")
+def admin_profile(pid: str):
+    """Admin: relatório de uma request perfilada (header X-Profile; id em X-Profile-Id)."""
+    if not _admin_required():
+        return _json_err("Unauthorized (DEMO_KEY)", 403)
+    report = _PROFILES.get(pid)
+    if report is None:
+        return _json_err("Profile não encontrado (expirado ou de outro worker).", 404)
+    return _json_ok({"profile": report})
+
+
+@app.get("/admin/leads_partitions")
+def admin_leads_partitions():
+    """Admin: partições de leads (nome, mês, limites, linhas estimadas)."""
+    if not _admin_required():
+        return _json_err("Unauthorized (DEMO_KEY)", 403)
+    created = _maintain_lead_partitions(force=True)
+    conn = _db()
+    try:
+        with conn:
+            with conn.cursor(row_factory=dict_row) as cur:
+                parts = migrations.lead_partitions(cur)
+    finally:
+        conn.close()
+    return _json_ok({"partitions": parts, "created": created})
+
+
+@app.post("/admin/leads_retention")
+def admin_leads_retention():
+    """
+    Admin: retenção por mês inteiro, em tempo constante.
+    Body: {"before": "YYYY-MM", "drop": false}
+      desanexa (drop=false; a tabela fica para arquivo) ou apaga as partições
+      mensais anteriores a `before`; o rollup desses meses sai junto.
+    """
+    if not _admin_required():
+        return _json_err("Unauthorized (DEMO_KEY)", 403)
+
+    data = request.get_json(silent=True) or {}
+    try:
+        before = datetime.strptime((data.get("before") or "").strip(), "%Y-%m").date()
+    except ValueError:
+        return _json_err("before inválido (use YYYY-MM)", 400)
+    if before > _sp_today().replace(day=1):
+        return _json_err("before não pode passar do mês corrente", 400)
+    drop = bool(data.get("drop"))
+
+    conn = _db()
+    try:
+        with conn:
+            with conn.cursor(row_factory=dict_row) as cur:
+                retired = migrations.retire_lead_partitions(cur, before, drop=drop)
+    finally:
+        conn.close()
+    _invalidate_workspace()
+    return _json_ok({"before": before.isoformat()[:7], "dropped" if drop else "detached": retired})
+
+
+@app.cli.command("migrate")
+def migrate_cmd():
+    """flask --app app migrate  (aplica migrações pendentes; equivale a python migrations.py)"""
+    conn = migrations.connect(DATABASE_URL)
+    try:
+        applied = migrations.migrate(conn)
+        print(f"schema_version={migrations.current_version(conn)} aplicadas={applied}")
+    finally:
+        conn.close()
+
+
+@app.cli.command("import-report")
+def import_report_cmd():
+    """
+    flask --app app import-report  (WITH_ML=1 inclui o import do numpy/sklearn)
+    Importa o app num subprocesso com `python -X importtime` e imprime JSON com o
+    relatório de boot e os módulos mais caros (tempo cumulativo).
+    """
+    import subprocess
+    code = "import json, app\n"
+    if (os.environ.get("WITH_ML") or "").strip().lower() in ("1", "true", "yes"):
+        code += "app._load_ml()\n"
+    code += "print(json.dumps(app._boot_report()))"
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    mods = []
+    for line in proc.stderr.splitlines():
+        # "import time: <self us> | <cumulative us> | <módulo indentado pela profundidade>"
+        if not line.startswith("import time:"):
+            continue
+        parts = line.split(":", 1)[1].split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue
+        mods.append({
+            "module": parts[2].strip(),
+            "top_level": not parts[2].startswith("  "),
+            "self_ms": round(int(parts[0]) / 1000, 2),
+            "cumulative_ms": round(int(parts[1]) / 1000, 2),
+        })
+    boot = {}
+    try:
+        boot = json.loads(proc.stdout.strip().splitlines()[-1])
+    except Exception:
+        pass
+    top = sorted((m for m in mods if m["top_level"]), key=lambda m: -m["cumulative_ms"])[:25]
+    print(json.dumps({
+        "boot": boot,
+        "imports_total_ms": round(sum(m["cumulative_ms"] for m in mods if m["top_level"]), 1),
+        "top_level_imports": top,
+    }, indent=2))
+
+
+@app.cli.command("quota-reconcile")
+def quota_reconcile_cmd():
+    """flask --app app quota-reconcile  (CLIENT_ID=... para um workspace só; MONTH=YYYY-MM)"""
+    client_id = (os.environ.get("CLIENT_ID") or "").strip()
+    month = (os.environ.get("MONTH") or "").strip() or None
+    results = [_quota_reconcile(client_id, month)] if client_id else _quota_reconcile_all(month)
+    for r in results:
+        if r["drift"] or client_id:
+            print(json.dumps(r, ensure_ascii=False))
+    print(f"✅ {len(results)} workspace(s) reconciliado(s).")
+
+
+@app.cli.command("compact-daily-stats")
+def compact_daily_stats_cmd():
+    """flask --app app compact-daily-stats  -> dobra todos os deltas pendentes no rollup"""
+    total = _compact_daily_stats(max_batches=1_000_000)
+    print(f"leads_daily_stats_delta: {total['deltas']} deltas em {total['batches']} lote(s), {total['workspaces']} versões")
+
+
+@app.cli.command("rebuild-daily-stats")
+def rebuild_daily_stats_cmd():
+    """flask --app app rebuild-daily-stats  (CLIENT_ID=... para um workspace só)"""
+    client_id = (os.environ.get("CLIENT_ID") or "").strip() or None
+    rows = _rebuild_daily_stats(client_id)
+    print(f"leads_daily_stats: {rows} rows ({client_id or 'todos os workspaces'})")
+
+
 @app.get("/billing_status")
 def billing_status():
     client_id = (request.args.get("client_id") or "").strip()
@@ -1816,6 +4301,7 @@ def billing_status():
             with conn.cursor(row_factory=dict_row) as cur:
                 cur.execute("SELECT * FROM subscriptions WHERE client_id=%s", (client_id,))
                 sub = cur.fetchone()
+                used = _quota_used(client_id, cur=cur)
         enabled = bool(STRIPE_SECRET_KEY and STRIPE_PRICE_IDS_JSON)
         return _json_ok({
             "client_id": client_id,
@@ -1825,7 +4311,7 @@ def billing_status():
                 "plan": client_row.get("plan"),
                 "status": client_row.get("status"),
                 "usage_month": client_row.get("usage_month"),
-                "leads_used_month": int(client_row.get("leads_used_month") or 0),
+                "leads_used_month": used,
             }
         })
     finally:
@@ -2063,6 +4549,7 @@ def kiwify_webhook():
 # Opção C: Recursos Premium (métricas + explicação)
 # =========================
 @app.get("/funnels")
+@_etag_cached
 def funnels():
     client_id = (request.args.get("client_id") or "").strip()
     if not client_id:
@@ -2077,15 +4564,16 @@ def funnels():
         with conn:
             with conn.cursor(row_factory=dict_row) as cur:
                 cur.execute("""
+                    -- rollup: buckets 5-6 = >=0.70, 2-4 = [0.35, 0.70), 0-1 = <0.35
                     SELECT
-                      COUNT(*) AS total,
-                      SUM(CASE WHEN probabilidade >= 0.70 THEN 1 ELSE 0 END) AS hot,
-                      SUM(CASE WHEN probabilidade >= 0.35 AND probabilidade < 0.70 THEN 1 ELSE 0 END) AS warm,
-                      SUM(CASE WHEN probabilidade < 0.35 THEN 1 ELSE 0 END) AS cold,
-                      SUM(CASE WHEN virou_cliente = 1 THEN 1 ELSE 0 END) AS convertidos,
-                      SUM(CASE WHEN virou_cliente = 0 THEN 1 ELSE 0 END) AS negados,
-                      SUM(CASE WHEN virou_cliente IS NULL THEN 1 ELSE 0 END) AS pendentes
-                    FROM leads WHERE client_id=%s
+                      SUM(n) AS total,
+                      SUM(n) FILTER (WHERE bucket >= 5) AS hot,
+                      SUM(n) FILTER (WHERE bucket BETWEEN 2 AND 4) AS warm,
+                      SUM(n) FILTER (WHERE bucket IN (0, 1)) AS cold,
+                      SUM(n) FILTER (WHERE status = 1) AS convertidos,
+                      SUM(n) FILTER (WHERE status = 0) AS negados,
+                      SUM(n) FILTER (WHERE status = -1) AS pendentes
+                    FROM leads_daily_stats_live WHERE client_id=%s
                 """, (client_id,))
                 row = cur.fetchone() or {}
 
@@ -2162,6 +4650,10 @@ def lead_explain():
         })
     finally:
         conn.close()
+_BOOT["app_import_ms"] = round((time.perf_counter() - _BOOT_T0) * 1000, 1)
+logging.info("boot: app importado em %.1f ms (perfil=%s)", _BOOT["app_import_ms"], APP_PROFILE)
+
+
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "10000"))
     app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,703 @@
+# bench.py
+# --------
+# Benchmark HTTP reprodutível: sobe o app contra um Postgres LOCAL/descartável,
+# semeia milhões de leads em muitos workspaces e dispara um mix realista de
+# /prever, /dashboard_data, /insights, /funnels, /confirmar_venda e /recalc_pending
+# com concorrência configurável. Gera um relatório JSON com throughput,
+# p50/p95/p99 por rota, round-trips ao banco por request e RSS dos workers.
+#
+# Uso:
+#   export BENCH_DATABASE_URL="postgres://localhost/leadrank_bench"   # NUNCA o banco de produção
+#   export BENCH_TENANTS="500"                 # workspaces semeados (padrão 500)
+#   export BENCH_LEADS_PER_TENANT="4000"       # leads por workspace (padrão 4000 -> 2M)
+#   export BENCH_CONCURRENCY="16"              # clientes simultâneos
+#   export BENCH_DURATION="60"                 # segundos de carga medida (após BENCH_WARMUP)
+#   export BENCH_MIX="prever=45,dashboard_data=20,insights=10,funnels=10,confirmar_venda=10,recalc_pending=5"
+#   export BENCH_SERVER="gunicorn"             # gunicorn (padrão) | flask (python app.py)
+#   export BENCH_WORKERS="2" BENCH_THREADS="8" # só gunicorn
+#   export BENCH_OUT="bench_report.json"       # relatório
+#   export BENCH_BASELINE="bench_antes.json"   # opcional: imprime a diferença contra um relatório anterior
+#   export BENCH_INGEST_SCALING="1,2,4,8,16,32" # opcional: varredura de ingest num workspace só (ver abaixo)
+#   python bench.py
+#
+# Escala do ingest por workspace (BENCH_INGEST_SCALING): depois do mix, para cada nível
+# de concorrência roda só /prever por BENCH_SCALING_DURATION s, primeiro todos no mesmo
+# workspace ("hot"), depois espalhado entre workspaces ("spread"). Se alguma row por
+# tenant estiver na transação do INSERT, "hot" para de escalar e hot_vs_spread cai;
+# lock_waits_max/mean amostram backends esperando lock (pg_stat_activity) durante cada fase.
+#
+# Fluxo de comparação: rode no commit antigo com BENCH_OUT=antes.json, troque de
+# commit e rode de novo com BENCH_BASELINE=antes.json (mesmo seed, mesma config).
+#
+# O seed só roda na primeira vez (workspaces "bench_*"); a cada execução a cota
+# do mês dos workspaces é zerada para o /prever não esbarrar no plano.
+# Round-trips por rota vêm de pg_stat_statements (chamadas por request numa fase
+# sequencial de calibração). Sem a extensão, cai para transações (pg_stat_database).
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import signal
+import threading
+import subprocess
+from datetime import datetime, timezone
+
+BENCH_DATABASE_URL = (os.environ.get("BENCH_DATABASE_URL") or "").strip()
+BENCH_TENANTS = int(os.environ.get("BENCH_TENANTS", "500"))
+BENCH_LEADS_PER_TENANT = int(os.environ.get("BENCH_LEADS_PER_TENANT", "4000"))
+BENCH_SEED_CHUNK = int(os.environ.get("BENCH_SEED_CHUNK", "50"))  # workspaces por INSERT no seed
+BENCH_CONCURRENCY = int(os.environ.get("BENCH_CONCURRENCY", "16"))
+BENCH_DURATION = float(os.environ.get("BENCH_DURATION", "60"))
+BENCH_WARMUP = float(os.environ.get("BENCH_WARMUP", "5"))
+BENCH_CALIBRATE = int(os.environ.get("BENCH_CALIBRATE", "20"))  # requests sequenciais por rota (round-trips)
+BENCH_MIX = (os.environ.get("BENCH_MIX") or
+             "prever=45,dashboard_data=20,insights=10,funnels=10,confirmar_venda=10,recalc_pending=5").strip()
+BENCH_CONDITIONAL = os.environ.get("BENCH_CONDITIONAL", "1") == "1"  # reenvia ETag como o dashboard faz
+BENCH_SERVER = (os.environ.get("BENCH_SERVER") or "gunicorn").strip().lower()
+BENCH_WORKERS = int(os.environ.get("BENCH_WORKERS", "2"))
+BENCH_THREADS = int(os.environ.get("BENCH_THREADS", "8"))
+BENCH_PORT = int(os.environ.get("BENCH_PORT", "18080"))
+BENCH_OUT = (os.environ.get("BENCH_OUT") or "bench_report.json").strip()
+BENCH_BASELINE = (os.environ.get("BENCH_BASELINE") or "").strip()
+BENCH_SEED = int(os.environ.get("BENCH_SEED", "42"))
+BENCH_TIMEOUT = float(os.environ.get("BENCH_TIMEOUT", "30"))
+BENCH_INGEST_SCALING = (os.environ.get("BENCH_INGEST_SCALING") or "").strip()
+BENCH_SCALING_DURATION = float(os.environ.get("BENCH_SCALING_DURATION", "10"))
+
+if not BENCH_DATABASE_URL:
+    raise SystemExit("BENCH_DATABASE_URL ausente. Aponte para um Postgres local/descartável (o script insere dados).")
+
+try:
+    import psycopg
+    from psycopg.rows import dict_row
+except Exception as e:
+    raise SystemExit(
+        "ERRO: instale psycopg[binary]. Ex.: pip install 'psycopg[binary]'\n" + repr(e)
+    )
+
+try:
+    import requests
+except Exception as e:
+    raise SystemExit("ERRO: instale requests. Ex.: pip install requests\n" + repr(e))
+
+import migrations
+
+ROUTES = ("prever", "dashboard_data", "insights", "funnels", "confirmar_venda", "recalc_pending")
+PREFIX = "bench_"
+ORIGENS = ("google", "instagram", "whatsapp", "indicacao", "desconhecida")
+SAMPLE_IDS_PER_TENANT = 20
+
+
+def tenant_id(n: int) -> str:
+    return PREFIX + str(n).zfill(5)
+
+
+def tenant_key(n: int) -> str:
+    return f"bench-key-{n}"
+
+
+# =========================
+# Seed
+# =========================
+def seed(conn):
+    with conn.cursor(row_factory=dict_row) as cur:
+        cur.execute("SELECT COUNT(*) AS n FROM clients WHERE client_id LIKE %s", (PREFIX + "%",))
+        have = int(cur.fetchone()["n"])
+        if have >= BENCH_TENANTS:
+            print(f"ℹ️ Seed já existe ({have} workspaces {PREFIX}*).")
+            return {"seeded": False}
+
+        t0 = time.perf_counter()
+        print(f"⏳ Semeando {BENCH_TENANTS} workspaces x {BENCH_LEADS_PER_TENANT} leads ...")
+        cur.execute(
+            """
+            INSERT INTO clients (client_id, api_key, plan, status, usage_month, email, created_at, updated_at)
+            SELECT %s || lpad(g::text, 5, '0'), 'bench-key-' || g, 'vip', 'active', to_char(NOW(), 'YYYY-MM'),
+                   'bench' || g || '@leadrank.local', NOW(), NOW()
+            FROM generate_series(%s, %s) g
+            ON CONFLICT (client_id) DO NOTHING
+            """,
+            (PREFIX, have + 1, BENCH_TENANTS),
+        )
+        # 18 meses de histórico; ~55% pendentes; conversão correlacionada com as
+        # features para o /recalc_pending treinar algo que faça sentido
+        for lo in range(have + 1, BENCH_TENANTS + 1, BENCH_SEED_CHUNK):
+            hi = min(lo + BENCH_SEED_CHUNK - 1, BENCH_TENANTS)
+            cur.execute(
+                """
+                INSERT INTO leads (client_id, nome, email_lead, telefone, origem, tempo_site, paginas_visitadas,
+                                   clicou_preco, payload, probabilidade, score, virou_cliente, created_at, updated_at)
+                SELECT %s || lpad(t::text, 5, '0'),
+                       'Lead ' || t || '-' || g, 'l' || g || '@bench.local', '11999990000',
+                       (ARRAY['google','instagram','whatsapp','indicacao','desconhecida'])[1 + (g %% 5)],
+                       tempo, paginas, clicou, '{}'::jsonb, p, (p * 100)::int,
+                       CASE WHEN r < 0.55 THEN NULL
+                            WHEN random() < 0.15 + 0.5 * p THEN 1 ELSE 0 END,
+                       ts, ts
+                FROM (
+                    SELECT t, g, tempo, paginas, clicou,
+                           LEAST(0.99, tempo / 1000.0 + paginas / 30.0 + clicou * 0.3) AS p,
+                           r, ts
+                    FROM (
+                        SELECT t, g, (random() * 500)::int AS tempo, 1 + (random() * 11)::int AS paginas,
+                               (random() < 0.4)::int AS clicou, random() AS r,
+                               NOW() - random() * interval '540 days' AS ts
+                        FROM generate_series(%s, %s) t, generate_series(1, %s) g
+                    ) a
+                ) x
+                """,
+                (PREFIX, lo, hi, BENCH_LEADS_PER_TENANT),
+            )
+            print(f"   … workspaces {lo}-{hi}")
+        # o seed entra pelos triggers como deltas: dobra tudo no rollup antes de medir
+        while True:
+            with conn.transaction():
+                res = migrations.compact_daily_stats(cur)
+            if not res or not res["deltas"]:
+                break
+        cur.execute("VACUUM (ANALYZE) leads")
+        cur.execute("ANALYZE clients")
+        cur.execute("ANALYZE leads_daily_stats")
+        secs = round(time.perf_counter() - t0, 1)
+        print(f"✅ Seed concluído em {secs}s.")
+        return {"seeded": True, "seconds": secs}
+
+
+def prepare(conn):
+    """Zera a cota do mês e carrega alguns lead ids por workspace (para /confirmar_venda)."""
+    with conn.cursor() as cur:
+        cur.execute(
+            "UPDATE clients SET leads_used_month=0, usage_month=to_char(NOW(), 'YYYY-MM') WHERE client_id LIKE %s",
+            (PREFIX + "%",),
+        )
+        cur.execute("DELETE FROM quota_usage WHERE client_id LIKE %s", (PREFIX + "%",))
+        cur.execute(
+            """
+            SELECT c.client_id, l.id
+            FROM clients c
+            CROSS JOIN LATERAL (
+                SELECT id FROM leads WHERE client_id = c.client_id
+                ORDER BY created_at DESC, id DESC LIMIT %s
+            ) l
+            WHERE c.client_id LIKE %s
+            """,
+            (SAMPLE_IDS_PER_TENANT, PREFIX + "%"),
+        )
+        ids = {}
+        for client_id, lead_id in cur.fetchall():
+            ids.setdefault(client_id, []).append(int(lead_id))
+        cur.execute("SELECT reltuples::bigint FROM pg_class WHERE relname='leads'")
+        row = cur.fetchone()
+        leads_est = int(row[0]) if row else None
+    return ids, leads_est
+
+
+# =========================
+# Servidor
+# =========================
+def start_server():
+    env = dict(os.environ)
+    env["DATABASE_URL"] = BENCH_DATABASE_URL
+    env["JOB_WORKERS"] = "0"  # jobs fora do processo web: round-trips medidos são só das rotas
+    env["PORT"] = str(BENCH_PORT)
+    here = os.path.dirname(os.path.abspath(__file__))
+    if BENCH_SERVER == "gunicorn":
+        cmd = [sys.executable, "-m", "gunicorn", "-w", str(BENCH_WORKERS), "--threads", str(BENCH_THREADS),
+               "-b", f"127.0.0.1:{BENCH_PORT}", "--log-level", "warning", "app:app"]
+    else:
+        cmd = [sys.executable, os.path.join(here, "app.py")]
+    proc = subprocess.Popen(cmd, cwd=here, env=env)
+    base = f"http://127.0.0.1:{BENCH_PORT}"
+    deadline = time.time() + 90
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"❌ Servidor saiu na subida (exit {proc.returncode}). Comando: {' '.join(cmd)}")
+        try:
+            if requests.get(base + "/health", timeout=2).status_code == 200:
+                return proc, base, cmd
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    proc.terminate()
+    raise SystemExit("❌ Servidor não respondeu /health em 90s.")
+
+
+def stop_server(proc):
+    if proc.poll() is None:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def _proc_tree(pid: int):
+    out = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            for c in f.read().split():
+                out.extend(_proc_tree(int(c)))
+    except OSError:
+        pass
+    return out
+
+
+def _rss_kb(pid: int):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+class RssSampler(threading.Thread):
+    """Amostra VmRSS do master e dos workers (Linux /proc) enquanto a carga roda."""
+
+    def __init__(self, root_pid: int, interval: float = 0.5):
+        super().__init__(daemon=True)
+        self.root_pid = root_pid
+        self.interval = interval
+        self.samples = {}
+        self.stop = threading.Event()
+
+    def run(self):
+        while not self.stop.is_set():
+            for pid in _proc_tree(self.root_pid):
+                kb = _rss_kb(pid)
+                if kb is not None:
+                    self.samples.setdefault(pid, []).append(kb)
+            self.stop.wait(self.interval)
+
+    def report(self):
+        procs = {}
+        for pid, vals in self.samples.items():
+            role = "master" if pid == self.root_pid and BENCH_SERVER == "gunicorn" else "worker"
+            procs[str(pid)] = {"role": role, "max_kb": max(vals), "last_kb": vals[-1]}
+        workers = [p for p in procs.values() if p["role"] == "worker"]
+        return {
+            "processes": procs,
+            "worker_max_kb": max((p["max_kb"] for p in workers), default=None),
+            "total_last_kb": sum(p["last_kb"] for p in procs.values()) or None,
+        }
+
+
+# =========================
+# Round-trips (pg_stat_statements / pg_stat_database)
+# =========================
+class RoundTrips:
+    def __init__(self, conn):
+        self.conn = conn
+        self.source = "pg_stat_database.xact"
+        with conn.cursor() as cur:
+            try:
+                cur.execute("SELECT 1 FROM pg_stat_statements LIMIT 1")
+                self.source = "pg_stat_statements.calls"
+            except psycopg.Error:
+                pass
+
+    def snapshot(self) -> int:
+        with self.conn.cursor() as cur:
+            if self.source == "pg_stat_statements.calls":
+                cur.execute(
+                    "SELECT COALESCE(SUM(calls), 0)::bigint FROM pg_stat_statements "
+                    "WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())"
+                )
+            else:
+                cur.execute("SELECT pg_stat_clear_snapshot()")
+                cur.execute(
+                    "SELECT xact_commit + xact_rollback FROM pg_stat_database WHERE datname = current_database()"
+                )
+            return int(cur.fetchone()[0])
+
+    def delta(self, before: int, after: int) -> int:
+        # o próprio snapshot "before" entra na contagem do "after"
+        return max(0, after - before - 1)
+
+
+# =========================
+# Carga
+# =========================
+def parse_mix(spec: str):
+    mix = []
+    for part in spec.split(","):
+        if not part.strip():
+            continue
+        name, _, w = part.partition("=")
+        name = name.strip().lstrip("/")
+        if name not in ROUTES:
+            raise SystemExit(f"BENCH_MIX: rota desconhecida '{name}' (válidas: {', '.join(ROUTES)})")
+        mix.append((name, float(w or 1)))
+    if not mix:
+        raise SystemExit("BENCH_MIX vazio.")
+    return mix
+
+
+class Client:
+    """Um 'usuário' do benchmark: sessão HTTP própria, escolhe workspace e rota a cada request."""
+
+    def __init__(self, base: str, lead_ids, rnd: random.Random, tenant=None):
+        self.base = base
+        self.lead_ids = lead_ids
+        self.rnd = rnd
+        self.tenant = tenant  # fixo = todo request no mesmo workspace
+        self.http = requests.Session()
+        self.conditional = BENCH_CONDITIONAL
+        self.etags = {}
+
+    def call(self, route: str):
+        n = self.tenant or self.rnd.randint(1, BENCH_TENANTS)
+        cid = tenant_id(n)
+        headers = {"X-API-KEY": tenant_key(n)}
+        r = self.rnd
+        if route == "prever":
+            body = {
+                "client_id": cid,
+                "nome": f"Bench {r.randint(1, 10**9)}",
+                "email_lead": f"b{r.randint(1, 10**9)}@bench.local",
+                "telefone": "11999990000",
+                "origem": r.choice(ORIGENS),
+                "tempo_site": r.randint(0, 500),
+                "paginas_visitadas": r.randint(1, 12),
+                "clicou_preco": int(r.random() < 0.4),
+            }
+            return self.http.post(self.base + "/prever", json=body, headers=headers, timeout=BENCH_TIMEOUT)
+        if route == "confirmar_venda":
+            ids = self.lead_ids.get(cid) or [1]
+            body = {"client_id": cid, "lead_id": r.choice(ids)}
+            return self.http.post(self.base + "/confirmar_venda", json=body, headers=headers, timeout=BENCH_TIMEOUT)
+        if route == "recalc_pending":
+            return self.http.get(self.base + "/recalc_pending", params={"client_id": cid, "limit": 200},
+                                 headers=headers, timeout=BENCH_TIMEOUT)
+        params = {"client_id": cid}
+        if route == "insights":
+            params["days"] = r.choice((7, 14, 30))
+        key = (route, cid, params.get("days"))
+        if self.conditional and key in self.etags:
+            headers["If-None-Match"] = self.etags[key]
+        resp = self.http.get(self.base + "/" + route, params=params, headers=headers, timeout=BENCH_TIMEOUT)
+        if self.conditional and resp.headers.get("ETag"):
+            self.etags[key] = resp.headers["ETag"]
+        return resp
+
+
+def timed(client: Client, route: str):
+    t0 = time.perf_counter()
+    try:
+        resp = client.call(route)
+        status = resp.status_code
+    except requests.RequestException:
+        status = 0
+    return status, (time.perf_counter() - t0) * 1000.0
+
+
+def calibrate(base, lead_ids, rt: RoundTrips, mix):
+    """Round-trips por request: cada rota isolada, sequencial, com delta do contador do Postgres."""
+    out = {}
+    client = Client(base, lead_ids, random.Random(BENCH_SEED))
+    client.conditional = False  # sem ETag: mede o caminho completo
+    for route, _ in mix:
+        timed(client, route)  # aquece caches/modelo da rota fora da medição
+        before = rt.snapshot()
+        ok = 0
+        for _ in range(BENCH_CALIBRATE):
+            status, _ms = timed(client, route)
+            ok += 200 <= status < 400
+        after = rt.snapshot()
+        out[route] = {
+            "per_request": round(rt.delta(before, after) / max(1, BENCH_CALIBRATE), 2),
+            "ok": ok,
+            "n": BENCH_CALIBRATE,
+        }
+    return out
+
+
+def run_load(base, lead_ids, mix):
+    routes = [m[0] for m in mix]
+    weights = [m[1] for m in mix]
+    results = []  # (route, status, ms, t) — list.append é atômico no CPython
+    stop_at = time.perf_counter() + BENCH_WARMUP + BENCH_DURATION
+    measure_from = time.perf_counter() + BENCH_WARMUP
+
+    def worker(i):
+        rnd = random.Random(BENCH_SEED + i)
+        client = Client(base, lead_ids, rnd)
+        while True:
+            now = time.perf_counter()
+            if now >= stop_at:
+                return
+            route = rnd.choices(routes, weights)[0]
+            status, ms = timed(client, route)
+            if now >= measure_from:
+                results.append((route, status, ms))
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(BENCH_CONCURRENCY)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+class LockWaitSampler(threading.Thread):
+    """Backends do banco esperando lock (pg_stat_activity.wait_event_type = 'Lock'), amostrados."""
+
+    def __init__(self, url: str, interval: float = 0.2):
+        super().__init__(daemon=True)
+        self.url = url
+        self.interval = interval
+        self.samples = []
+        self.stop = threading.Event()
+
+    def run(self):
+        with psycopg.connect(self.url, autocommit=True) as conn:
+            with conn.cursor() as cur:
+                while not self.stop.is_set():
+                    cur.execute(
+                        "SELECT COUNT(*) FROM pg_stat_activity "
+                        "WHERE datname = current_database() AND wait_event_type = 'Lock'"
+                    )
+                    self.samples.append(int(cur.fetchone()[0]))
+                    self.stop.wait(self.interval)
+
+    def report(self):
+        if not self.samples:
+            return {"lock_waits_max": None, "lock_waits_mean": None}
+        return {
+            "lock_waits_max": max(self.samples),
+            "lock_waits_mean": round(sum(self.samples) / len(self.samples), 2),
+        }
+
+
+def _reset_quota(conn):
+    with conn.cursor() as cur:
+        cur.execute("UPDATE clients SET leads_used_month=0 WHERE client_id LIKE %s", (PREFIX + "%",))
+        cur.execute("DELETE FROM quota_usage WHERE client_id LIKE %s", (PREFIX + "%",))
+
+
+def _ingest_phase(base, level: int, tenant):
+    """Só /prever, `level` clientes, BENCH_SCALING_DURATION s (1s de aquecimento antes)."""
+    results = []
+    warm_until = time.perf_counter() + 1.0
+    stop_at = warm_until + BENCH_SCALING_DURATION
+
+    def worker(i):
+        rnd = random.Random(BENCH_SEED + 1000 + i)
+        client = Client(base, {}, rnd, tenant=tenant)
+        while True:
+            now = time.perf_counter()
+            if now >= stop_at:
+                return
+            status, ms = timed(client, "prever")
+            if now >= warm_until:
+                results.append(("prever", status, ms))
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(level)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def ingest_scaling(base, conn, levels):
+    """Varredura hot (1 workspace) x spread (todos) por nível de concorrência."""
+    out = []
+    hot_rps1 = None
+    for level in levels:
+        row = {"concurrency": level}
+        for name, tenant in (("hot", 1), ("spread", None)):
+            _reset_quota(conn)  # cada fase começa com a cota do mês livre
+            sampler = LockWaitSampler(BENCH_DATABASE_URL)
+            sampler.start()
+            res = _ingest_phase(base, level, tenant)
+            sampler.stop.set()
+            sampler.join()
+            summary = _summary(res, BENCH_SCALING_DURATION)
+            row[name] = {k: summary[k] for k in ("rps", "p50_ms", "p95_ms", "p99_ms", "errors")}
+            row[name].update(sampler.report())
+        hot_rps = row["hot"]["rps"] or 0
+        if hot_rps1 is None:
+            hot_rps1 = hot_rps
+        row["hot_speedup"] = round(hot_rps / hot_rps1, 2) if hot_rps1 else None
+        row["hot_efficiency"] = round(hot_rps / (hot_rps1 * level), 2) if hot_rps1 else None
+        row["hot_vs_spread"] = round(hot_rps / row["spread"]["rps"], 2) if row["spread"]["rps"] else None
+        print(json.dumps({"ingest_concurrency": level, "hot_rps": row["hot"]["rps"], "hot_p95_ms": row["hot"]["p95_ms"],
+                          "spread_rps": row["spread"]["rps"], "hot_vs_spread": row["hot_vs_spread"],
+                          "hot_lock_waits_max": row["hot"]["lock_waits_max"]}, ensure_ascii=False))
+        out.append(row)
+    return out
+
+
+def _pct(sorted_ms, p):
+    if not sorted_ms:
+        return None
+    k = max(0, min(len(sorted_ms) - 1, math.ceil(p / 100.0 * len(sorted_ms)) - 1))  # nearest-rank
+    return round(sorted_ms[k], 2)
+
+
+def _summary(rows, seconds):
+    ms = sorted(r[2] for r in rows)
+    statuses = {}
+    for r in rows:
+        statuses[str(r[1])] = statuses.get(str(r[1]), 0) + 1
+    errors = sum(1 for r in rows if not (200 <= r[1] < 400))
+    return {
+        "requests": len(rows),
+        "errors": errors,
+        "status": statuses,
+        "rps": round(len(rows) / seconds, 2) if seconds else None,
+        "mean_ms": round(sum(ms) / len(ms), 2) if ms else None,
+        "p50_ms": _pct(ms, 50),
+        "p95_ms": _pct(ms, 95),
+        "p99_ms": _pct(ms, 99),
+        "max_ms": round(ms[-1], 2) if ms else None,
+    }
+
+
+def compare(report, baseline_path):
+    """Imprime a diferença de rps/p95/p99/round-trips contra um relatório anterior."""
+    try:
+        with open(baseline_path, encoding="utf-8") as f:
+            old = json.load(f)
+    except Exception as e:
+        print(f"⚠️ Não consegui ler BENCH_BASELINE ({baseline_path}): {e!r}")
+        return
+
+    def pct(new, prev):
+        if new is None or not prev:
+            return None
+        return round((new - prev) / prev * 100.0, 1)
+
+    print(f"📊 Comparação com {baseline_path}:")
+    for name in ["overall"] + sorted(report["routes"]):
+        new = report["overall"] if name == "overall" else report["routes"].get(name, {})
+        prev = old.get("overall") if name == "overall" else (old.get("routes") or {}).get(name)
+        if not prev:
+            continue
+        row = {
+            "route": name,
+            "rps_%": pct(new.get("rps"), prev.get("rps")),
+            "p95_%": pct(new.get("p95_ms"), prev.get("p95_ms")),
+            "p99_%": pct(new.get("p99_ms"), prev.get("p99_ms")),
+        }
+        if name != "overall":
+            row["db_roundtrips"] = [prev.get("db_roundtrips_per_request"), new.get("db_roundtrips_per_request")]
+        print(json.dumps(row, ensure_ascii=False))
+
+    old_scaling = {r["concurrency"]: r for r in old.get("ingest_scaling") or []}
+    for r in report.get("ingest_scaling") or []:
+        prev = old_scaling.get(r["concurrency"])
+        if not prev:
+            continue
+        print(json.dumps({
+            "ingest_concurrency": r["concurrency"],
+            "hot_rps_%": pct(r["hot"]["rps"], prev["hot"]["rps"]),
+            "hot_p95_%": pct(r["hot"]["p95_ms"], prev["hot"]["p95_ms"]),
+            "hot_vs_spread": [prev.get("hot_vs_spread"), r.get("hot_vs_spread")],
+        }, ensure_ascii=False))
+
+
+def main():
+    mix = parse_mix(BENCH_MIX)
+    try:
+        levels = [int(x) for x in BENCH_INGEST_SCALING.split(",") if x.strip()]
+    except ValueError:
+        raise SystemExit("BENCH_INGEST_SCALING: lista de inteiros, ex.: 1,2,4,8,16")
+
+    mconn = migrations.connect(BENCH_DATABASE_URL)
+    try:
+        migrations.ensure_schema(mconn)
+    finally:
+        mconn.close()
+
+    conn = psycopg.connect(BENCH_DATABASE_URL, autocommit=True)
+    proc = None
+    try:
+        seed_info = seed(conn)
+        lead_ids, leads_est = prepare(conn)
+        rt = RoundTrips(conn)
+
+        proc, base, cmd = start_server()
+        print(f"🚀 Servidor no ar ({BENCH_SERVER}, pid {proc.pid}).")
+        boot = {}
+        try:
+            boot = (requests.get(base + "/health_db", timeout=10).json() or {}).get("boot") or {}
+        except Exception:
+            pass
+
+        print(f"⏳ Calibrando round-trips ({BENCH_CALIBRATE} req/rota, fonte {rt.source}) ...")
+        roundtrips = calibrate(base, lead_ids, rt, mix)
+
+        print(f"⏳ Carga: {BENCH_CONCURRENCY} clientes, {BENCH_WARMUP:g}s aquecimento + {BENCH_DURATION:g}s medidos ...")
+        sampler = RssSampler(proc.pid)
+        sampler.start()
+        results = run_load(base, lead_ids, mix)
+        sampler.stop.set()
+        sampler.join()
+
+        scaling = None
+        if levels:
+            print(f"⏳ Escala do ingest por workspace: níveis {levels}, {BENCH_SCALING_DURATION:g}s por fase ...")
+            scaling = ingest_scaling(base, conn, levels)
+    finally:
+        if proc is not None:
+            stop_server(proc)
+        conn.close()
+
+    routes = {}
+    for route, _ in mix:
+        rows = [r for r in results if r[0] == route]
+        routes[route] = _summary(rows, BENCH_DURATION)
+        routes[route]["db_roundtrips_per_request"] = roundtrips[route]["per_request"]
+
+    report = {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            "tenants": BENCH_TENANTS,
+            "leads_per_tenant": BENCH_LEADS_PER_TENANT,
+            "leads_estimate": leads_est,
+            "concurrency": BENCH_CONCURRENCY,
+            "duration_s": BENCH_DURATION,
+            "warmup_s": BENCH_WARMUP,
+            "mix": dict(mix),
+            "conditional_get": BENCH_CONDITIONAL,
+            "server": BENCH_SERVER,
+            "server_cmd": cmd,
+            "workers": BENCH_WORKERS if BENCH_SERVER == "gunicorn" else 1,
+            "threads": BENCH_THREADS if BENCH_SERVER == "gunicorn" else None,
+            "app_profile": os.environ.get("APP_PROFILE") or "full",
+            "seed": BENCH_SEED,
+        },
+        "seed": seed_info,
+        "boot": boot,
+        "db_roundtrips_source": rt.source,
+        "overall": _summary(results, BENCH_DURATION),
+        "routes": routes,
+        "rss": sampler.report(),
+    }
+    if scaling is not None:
+        report["config"]["ingest_scaling_levels"] = levels
+        report["config"]["scaling_duration_s"] = BENCH_SCALING_DURATION
+        report["ingest_scaling"] = scaling
+
+    with open(BENCH_OUT, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps({"overall": report["overall"], "worker_max_kb": report["rss"]["worker_max_kb"]}, ensure_ascii=False))
+    for name, r in routes.items():
+        print(json.dumps({"route": name, "rps": r["rps"], "p50_ms": r["p50_ms"], "p95_ms": r["p95_ms"],
+                          "p99_ms": r["p99_ms"], "errors": r["errors"],
+                          "db_roundtrips": r["db_roundtrips_per_request"]}, ensure_ascii=False))
+    print(f"✅ Relatório em {BENCH_OUT}")
+
+    if BENCH_BASELINE:
+        compare(report, BENCH_BASELINE)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+# explain_check.py
+# ----------------
+# Regressão de planos: semeia um Postgres LOCAL/descartável com volume realista,
+# roda EXPLAIN nas queries das rotas do app.py e falha (exit 1) se algum plano
+# cair em Seq Scan numa tabela grande ou deixar de usar o índice esperado.
+#
+# Uso:
+#   export EXPLAIN_DATABASE_URL="postgres://localhost/leadrank_explain"   # NUNCA o banco de produção
+#   export EXPLAIN_TENANTS="200"               # workspaces semeados (padrão 200)
+#   export EXPLAIN_LEADS_PER_TENANT="1000"     # leads por workspace (padrão 1000)
+#   python explain_check.py
+#
+# O seed só roda na primeira vez (workspaces "xplain_*"); depois só o EXPLAIN.
+# As queries vêm do próprio app.py (builders e constantes SQL), então o check
+# acompanha o que as rotas realmente executam.
+
+import os
+import sys
+import json
+from datetime import datetime, timedelta, timezone
+
+EXPLAIN_DATABASE_URL = (os.environ.get("EXPLAIN_DATABASE_URL") or "").strip()
+EXPLAIN_TENANTS = int(os.environ.get("EXPLAIN_TENANTS", "200"))
+EXPLAIN_LEADS_PER_TENANT = int(os.environ.get("EXPLAIN_LEADS_PER_TENANT", "1000"))
+EXPLAIN_FILLER_CLIENTS = int(os.environ.get("EXPLAIN_FILLER_CLIENTS", "5000"))
+
+if not EXPLAIN_DATABASE_URL:
+    raise SystemExit("EXPLAIN_DATABASE_URL ausente. Aponte para um Postgres local/descartável (o script insere dados).")
+
+# o app lê a config no import: banco do check, sem ML e sem job workers
+os.environ["DATABASE_URL"] = EXPLAIN_DATABASE_URL
+os.environ.setdefault("APP_PROFILE", "ingest")
+os.environ["JOB_WORKERS"] = "0"
+
+try:
+    import psycopg
+    from psycopg.rows import dict_row
+except Exception as e:
+    raise SystemExit(
+        "ERRO: instale psycopg[binary]. Ex.: pip install 'psycopg[binary]'\n" + repr(e)
+    )
+
+import migrations
+import app
+
+TENANT = "xplain_0001"
+# tabelas em que Seq Scan é regressão (partições de leads incluídas pelo prefixo)
+BIG_TABLES = ("leads", "clients", "leads_daily_stats")
+
+
+def seed(conn):
+    with conn.cursor(row_factory=dict_row) as cur:
+        cur.execute("SELECT 1 FROM clients WHERE client_id=%s", (TENANT,))
+        if cur.fetchone():
+            print(f"ℹ️ Seed já existe ({TENANT}).")
+            return
+        print(f"⏳ Semeando {EXPLAIN_TENANTS} workspaces x {EXPLAIN_LEADS_PER_TENANT} leads ...")
+        cur.execute(
+            """
+            INSERT INTO clients (client_id, api_key, plan, status, usage_month, email, created_at, updated_at)
+            SELECT 'xplain_' || lpad(g::text, 4, '0'), '', 'pro', 'active', to_char(NOW(), 'YYYY-MM'),
+                   'xplain' || g || '@leadrank.local', NOW(), NOW()
+            FROM generate_series(1, %s) g
+            UNION ALL
+            SELECT 'xfill_' || g, '', 'trial', 'active', to_char(NOW(), 'YYYY-MM'),
+                   'xfill' || g || '@leadrank.local', NOW(), NOW()
+            FROM generate_series(1, %s) g
+            """,
+            (EXPLAIN_TENANTS, EXPLAIN_FILLER_CLIENTS),
+        )
+        # 18 meses de histórico; ~55% pendentes, probabilidades espalhadas
+        cur.execute(
+            """
+            INSERT INTO leads (client_id, nome, email_lead, telefone, origem, tempo_site, paginas_visitadas,
+                               clicou_preco, payload, probabilidade, score, virou_cliente, created_at, updated_at)
+            SELECT 'xplain_' || lpad(t::text, 4, '0'),
+                   'Lead ' || t || '-' || g, 'l' || g || '@x.local', '11999990000',
+                   (ARRAY['google','instagram','whatsapp','indicacao','desconhecida'])[1 + (g % 5)],
+                   (random() * 500)::int, 1 + (random() * 11)::int, (random() < 0.4)::int,
+                   '{}'::jsonb, p, (p * 100)::int,
+                   CASE WHEN r < 0.55 THEN NULL WHEN r < 0.8 THEN 1 ELSE 0 END,
+                   ts, ts
+            FROM (
+                SELECT t, g, random() AS p, random() AS r, NOW() - random() * interval '540 days' AS ts
+                FROM generate_series(1, %s) t, generate_series(1, %s) g
+            ) x
+            """,
+            (EXPLAIN_TENANTS, EXPLAIN_LEADS_PER_TENANT),
+        )
+        cur.execute("ANALYZE leads")
+        cur.execute("ANALYZE clients")
+        # o seed entra pelos triggers como deltas: dobra tudo no rollup antes de medir
+        while True:
+            with conn.transaction():
+                res = migrations.compact_daily_stats(cur)
+            if not res or not res["deltas"]:
+                break
+        cur.execute("ANALYZE leads_daily_stats")
+        print("✅ Seed concluído.")
+
+
+def cases():
+    """(nome, sql, params, índices aceitos ou None) — uma entrada por query de rota."""
+    now = datetime.now(timezone.utc)
+    since = now - timedelta(days=30)
+    out = []
+    q, p = app._recent_leads_query(TENANT, 200)
+    out.append(("dashboard_data: recentes", q, p, {"idx_leads_client_created_id"}))
+    q, p = app._recent_leads_query(TENANT, 200, after=(now - timedelta(days=10), 10**9))
+    out.append(("dashboard_data: página seguinte (keyset)", q, p, {"idx_leads_client_created_id"}))
+    q, p = app._recent_leads_query(TENANT, 200, {"status": "pending"})
+    out.append(("dashboard_data: status=pending", q, p, {"idx_leads_pending_cover"}))
+    q, p = app._recent_leads_query(TENANT, 200, {"status": "converted"})
+    out.append(("dashboard_data: status=converted", q, p, {"idx_leads_labeled_cover"}))
+    q, p = app._recent_leads_query(TENANT, 200, {"origem": "google", "since": since})
+    out.append(("dashboard_data: origem+since", q, p, {"idx_leads_client_origem_created", "idx_leads_client_created_id"}))
+    q, p = app._hot_leads_today_query(TENANT, 20)
+    out.append(("dashboard_data: hot leads de hoje", q, p, {"idx_leads_client_hot_created", "idx_leads_client_created_id"}))
+    q, p = app._top_origens_query(TENANT, 30, 6)
+    out.append(("dashboard_data: top origens (rollup)", q, p, None))
+    out.append(("recalc_pending: pendentes", app._PENDING_FEATURES_SQL, (TENANT, 500), {"idx_leads_pending_cover"}))
+    out.append(("treino: rotulados", app._LABELED_ROWS_SQL, (TENANT,), {"idx_leads_labeled_cover"}))
+    out.append((
+        "leads_export.csv: since",
+        "SELECT id, nome, probabilidade, created_at FROM leads WHERE client_id=%s AND created_at >= %s "
+        "ORDER BY created_at DESC, id DESC",
+        (TENANT, since),
+        {"idx_leads_client_created_id"},
+    ))
+    out.append(("lead_explain / rótulo: lead por id", "SELECT * FROM leads WHERE client_id=%s AND id=%s", (TENANT, 12345), None))
+    out.append(("login: clients por email", app._LOGIN_SQL, ("xplain1@leadrank.local",), {"idx_clients_email_unique"}))
+    out.append(("auth: clients por client_id", "SELECT * FROM clients WHERE client_id=%s", (TENANT,), None))
+    out.append((
+        "insights: rollup",
+        "SELECT day, bucket, status, SUM(n)::bigint AS n FROM leads_daily_stats_live "
+        "WHERE client_id=%s AND day >= %s GROUP BY day, bucket, status",
+        (TENANT, (now - timedelta(days=90)).date()),
+        None,
+    ))
+    return out
+
+
+def _walk(node):
+    yield node
+    for child in node.get("Plans") or []:
+        yield from _walk(child)
+
+
+def _index_parents(conn):
+    """índice de partição -> índice particionado (nos planos aparecem os nomes das partições)."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT c.relname, p.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE c.relkind = 'i'
+            """
+        )
+        return dict(cur.fetchall())
+
+
+def check(conn) -> int:
+    failures = 0
+    parents = _index_parents(conn)
+    # ClientCursor: parâmetros interpolados -> mesmo plano "custom" das primeiras execuções
+    with psycopg.ClientCursor(conn) as cur:
+        for name, q, params, expect in cases():
+            cur.execute("EXPLAIN (FORMAT JSON) " + q, params)
+            plan = cur.fetchone()[0][0]["Plan"]
+            nodes = list(_walk(plan))
+            seq = sorted({n.get("Relation Name") for n in nodes
+                          if n.get("Node Type") == "Seq Scan" and (n.get("Relation Name") or "").startswith(BIG_TABLES)})
+            used = sorted({parents.get(n["Index Name"], n["Index Name"]) for n in nodes if n.get("Index Name")})
+            problems = []
+            if seq:
+                problems.append(f"Seq Scan em {', '.join(seq)}")
+            if expect and not (expect & set(used)):
+                problems.append(f"esperava {' ou '.join(sorted(expect))}")
+            failures += bool(problems)
+            print(json.dumps({
+                "case": name,
+                "ok": not problems,
+                "problems": problems,
+                "indexes": used,
+                "total_cost": plan.get("Total Cost"),
+            }, ensure_ascii=False))
+    return failures
+
+
+def main():
+    mconn = migrations.connect(EXPLAIN_DATABASE_URL)
+    try:
+        migrations.ensure_schema(mconn)
+    finally:
+        mconn.close()
+
+    conn = psycopg.connect(EXPLAIN_DATABASE_URL, autocommit=True)
+    try:
+        seed(conn)
+        failures = check(conn)
+    finally:
+        conn.close()
+
+    if failures:
+        print(f"❌ {failures} plano(s) regrediram.")
+        sys.exit(1)
+    print("✅ Todos os planos usam índice.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1041 @@
+# migrations.py
+# -------------
+# Migrações versionadas do schema no Postgres, compartilhadas por app.py,
+# init_users.py e popular_db.py.
+#
+# Uso:
+#   export DATABASE_URL="postgres://..."
+#   python migrations.py            # aplica as pendentes
+#   python migrations.py --status   # só mostra versão atual/alvo
+#
+# Cada migração é (versão, nome, função(cur)) e roda em uma transação própria,
+# registrada em schema_version. Um advisory lock garante que só um processo
+# migra por vez; os demais esperam e reconferem a versão. Com o banco em dia,
+# a checagem custa um único SELECT (nenhum DDL, nenhum lock em leads).
+#
+# Regra: migrações já publicadas não mudam; mudanças de schema entram como
+# uma migração nova no fim de MIGRATIONS.
+
+import os
+import re
+import sys
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+try:
+    import psycopg
+    from psycopg import sql
+    from psycopg.rows import dict_row
+except Exception as e:
+    raise SystemExit(
+        "ERRO: instale psycopg[binary]. Ex.: pip install 'psycopg[binary]'\n" + repr(e)
+    )
+
+# chave do pg_advisory_lock das migrações (qualquer bigint fixo e único no banco)
+MIGRATION_LOCK_KEY = 740_316_002
+# evita que um ALTER em leads fique enfileirado atrás de tráfego (e bloqueie todo mundo atrás dele)
+MIGRATION_LOCK_TIMEOUT = (os.environ.get("MIGRATION_LOCK_TIMEOUT") or "30s").strip()
+# partições mensais de leads criadas com antecedência (meses à frente do atual)
+LEADS_PARTITION_MONTHS_AHEAD = int(os.environ.get("LEADS_PARTITION_MONTHS_AHEAD", "3"))
+
+_SP_TZ = ZoneInfo("America/Sao_Paulo")
+
+
+class SchemaOutdated(RuntimeError):
+    """Banco atrás da versão esperada pelo código (e a migração automática está desligada)."""
+
+
+def _month_key(dt=None):
+    dt = dt or datetime.now(timezone.utc)
+    return dt.strftime("%Y-%m")
+
+
+# =========================
+# Rollup diário (leads_daily_stats)
+# =========================
+# Contagem de leads por (client_id, dia em America/Sao_Paulo, origem, bucket de probabilidade, status do rótulo).
+# Buckets = width_bucket(probabilidade, STATS_BREAKS): 0:<0.2 1:<0.35 2:<0.4 3:<0.6 4:<0.7 5:<0.8 6:>=0.8
+# (-1 = sem probabilidade). Os cortes cobrem tanto as faixas do /insights quanto hot/warm/cold do /funnels.
+# Status: 1 convertido, 0 negado, -1 pendente, 2 outro valor.
+STATS_BREAKS = (0.2, 0.35, 0.4, 0.6, 0.7, 0.8)
+STATS_KEY_SQL = f"""
+    client_id,
+    (created_at AT TIME ZONE 'America/Sao_Paulo')::date,
+    COALESCE(NULLIF(TRIM(origem), ''), 'desconhecida'),
+    COALESCE(width_bucket(probabilidade, ARRAY{list(STATS_BREAKS)}::double precision[]), -1)::smallint,
+    (CASE WHEN virou_cliente IS NULL THEN -1
+          WHEN virou_cliente = 1 THEN 1
+          WHEN virou_cliente = 0 THEN 0
+          ELSE 2 END)::smallint
+"""
+_STATS_UPSERT_SQL = """
+    ON CONFLICT (client_id, day, origem, bucket, status)
+    DO UPDATE SET n = leads_daily_stats.n + EXCLUDED.n
+"""
+_VERSION_BUMP_SQL = """
+    INSERT INTO workspace_versions (client_id, version, updated_at)
+    SELECT DISTINCT client_id, 1, NOW() FROM {rows}
+    ON CONFLICT (client_id)
+    DO UPDATE SET version = workspace_versions.version + 1, updated_at = NOW()
+"""
+# versão original (m002): upsert no rollup e na versão do workspace dentro da transação
+# de quem escreve em leads. Serializava o ingest de cada tenant na row de
+# workspace_versions e na row do dia; substituída em m011 pelo log de deltas abaixo.
+_STATS_TRIGGER_FN_V1_SQL = f"""
+    CREATE OR REPLACE FUNCTION leads_daily_stats_apply() RETURNS trigger
+    LANGUAGE plpgsql AS $fn$
+    BEGIN
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            {_VERSION_BUMP_SQL.format(rows="new_rows")};
+        ELSE
+            {_VERSION_BUMP_SQL.format(rows="old_rows")};
+        END IF;
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO leads_daily_stats (client_id, day, origem, bucket, status, n)
+            SELECT {STATS_KEY_SQL}, COUNT(*) FROM new_rows GROUP BY 1, 2, 3, 4, 5
+            {_STATS_UPSERT_SQL};
+        ELSIF TG_OP = 'DELETE' THEN
+            INSERT INTO leads_daily_stats (client_id, day, origem, bucket, status, n)
+            SELECT {STATS_KEY_SQL}, -COUNT(*) FROM old_rows GROUP BY 1, 2, 3, 4, 5
+            {_STATS_UPSERT_SQL};
+        ELSE
+            INSERT INTO leads_daily_stats (client_id, day, origem, bucket, status, n)
+            SELECT client_id, day, origem, bucket, status, SUM(n) FROM (
+                SELECT {STATS_KEY_SQL}, 1 FROM new_rows
+                UNION ALL
+                SELECT {STATS_KEY_SQL}, -1 FROM old_rows
+            ) AS d(client_id, day, origem, bucket, status, n)
+            GROUP BY 1, 2, 3, 4, 5
+            HAVING SUM(n) <> 0
+            {_STATS_UPSERT_SQL};
+        END IF;
+        RETURN NULL;
+    END
+    $fn$;
+"""
+# trigger por statement (transition tables): cada INSERT/COPY/UPDATE/DELETE em leads só
+# acrescenta linhas em leads_daily_stats_delta (INSERT puro, sem ON CONFLICT -> nenhuma row
+# travada na transação de quem escreve, nem por tenant nem por dia). compact_daily_stats
+# dobra os deltas em leads_daily_stats e sobe workspace_versions fora do caminho de escrita.
+# UPDATE que não muda a chave gera delta zero de propósito: marca a mudança para o ETag
+# (probabilidade/rótulo dentro do mesmo bucket também mudam o que as rotas mostram).
+_STATS_TRIGGER_FN_SQL = f"""
+    CREATE OR REPLACE FUNCTION leads_daily_stats_apply() RETURNS trigger
+    LANGUAGE plpgsql AS $fn$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO leads_daily_stats_delta (client_id, day, origem, bucket, status, n)
+            SELECT {STATS_KEY_SQL}, COUNT(*) FROM new_rows GROUP BY 1, 2, 3, 4, 5;
+        ELSIF TG_OP = 'DELETE' THEN
+            INSERT INTO leads_daily_stats_delta (client_id, day, origem, bucket, status, n)
+            SELECT {STATS_KEY_SQL}, -COUNT(*) FROM old_rows GROUP BY 1, 2, 3, 4, 5;
+        ELSE
+            INSERT INTO leads_daily_stats_delta (client_id, day, origem, bucket, status, n)
+            SELECT client_id, day, origem, bucket, status, SUM(n) FROM (
+                SELECT {STATS_KEY_SQL}, 1 FROM new_rows
+                UNION ALL
+                SELECT {STATS_KEY_SQL}, -1 FROM old_rows
+            ) AS d(client_id, day, origem, bucket, status, n)
+            GROUP BY 1, 2, 3, 4, 5;
+        END IF;
+        RETURN NULL;
+    END
+    $fn$;
+"""
+# leitura do rollup: parte consolidada + deltas ainda não compactados (as rotas já somam n)
+_STATS_LIVE_VIEW_SQL = """
+    CREATE OR REPLACE VIEW leads_daily_stats_live AS
+    SELECT client_id, day, origem, bucket, status, n FROM leads_daily_stats
+    UNION ALL
+    SELECT client_id, day, origem, bucket, status, n FROM leads_daily_stats_delta
+"""
+# chave do advisory lock da compactação (um compactador por vez no banco)
+STATS_COMPACT_LOCK_KEY = 740_316_011
+_STATS_COMPACT_SQL = f"""
+    WITH moved AS (
+        DELETE FROM leads_daily_stats_delta
+        WHERE id IN (SELECT id FROM leads_daily_stats_delta ORDER BY id LIMIT %(batch)s)
+        RETURNING client_id, day, origem, bucket, status, n
+    ), folded AS (
+        INSERT INTO leads_daily_stats (client_id, day, origem, bucket, status, n)
+        SELECT client_id, day, origem, bucket, status, SUM(n) FROM moved
+        GROUP BY 1, 2, 3, 4, 5
+        HAVING SUM(n) <> 0
+        ORDER BY 1, 2, 3, 4, 5
+        {_STATS_UPSERT_SQL}
+        RETURNING 1
+    ), bumped AS (
+        INSERT INTO workspace_versions (client_id, version, updated_at)
+        SELECT DISTINCT client_id, 1, NOW() FROM moved ORDER BY client_id
+        ON CONFLICT (client_id)
+        DO UPDATE SET version = workspace_versions.version + 1, updated_at = NOW()
+        RETURNING 1
+    )
+    SELECT (SELECT COUNT(*) FROM moved) AS deltas, (SELECT COUNT(*) FROM bumped) AS workspaces
+"""
+_STATS_TRIGGERS = {
+    "trg_leads_daily_stats_ins": "AFTER INSERT ON leads REFERENCING NEW TABLE AS new_rows",
+    "trg_leads_daily_stats_upd": (
+        # (Postgres não aceita "UPDATE OF <colunas>" com transition tables; updates que não mudam
+        # a chave viram delta zero, descartado na compactação)
+        "AFTER UPDATE ON leads REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows"
+    ),
+    "trg_leads_daily_stats_del": "AFTER DELETE ON leads REFERENCING OLD TABLE AS old_rows",
+}
+
+
+def rebuild_daily_stats(cur, client_id: Optional[str]) -> int:
+    """Recalcula o rollup a partir de leads (um client ou todos). Bloqueia escrita em leads durante a operação."""
+    cur.execute("LOCK TABLE leads IN SHARE MODE")
+    cur.execute("SELECT to_regclass('leads_daily_stats_delta') IS NOT NULL AS present")
+    deltas = bool(cur.fetchone()["present"])
+    if deltas:
+        # compactação em curso somaria os deltas dela por cima do rollup recalculado
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (STATS_COMPACT_LOCK_KEY,))
+    if client_id:
+        if deltas:
+            cur.execute("DELETE FROM leads_daily_stats_delta WHERE client_id=%s", (client_id,))
+            cur.execute(
+                """
+                INSERT INTO workspace_versions (client_id, version, updated_at) VALUES (%s, 1, NOW())
+                ON CONFLICT (client_id) DO UPDATE SET version = workspace_versions.version + 1, updated_at = NOW()
+                """,
+                (client_id,),
+            )
+        cur.execute("DELETE FROM leads_daily_stats WHERE client_id=%s", (client_id,))
+        cur.execute(
+            f"""
+            INSERT INTO leads_daily_stats (client_id, day, origem, bucket, status, n)
+            SELECT {STATS_KEY_SQL}, COUNT(*) FROM leads WHERE client_id=%s GROUP BY 1, 2, 3, 4, 5
+            """,
+            (client_id,),
+        )
+    else:
+        if deltas:
+            cur.execute("DELETE FROM leads_daily_stats_delta")
+            cur.execute("UPDATE workspace_versions SET version = version + 1, updated_at = NOW()")
+        cur.execute("DELETE FROM leads_daily_stats")
+        cur.execute(
+            f"""
+            INSERT INTO leads_daily_stats (client_id, day, origem, bucket, status, n)
+            SELECT {STATS_KEY_SQL}, COUNT(*) FROM leads GROUP BY 1, 2, 3, 4, 5
+            """
+        )
+    return max(0, cur.rowcount)
+
+
+def compact_daily_stats(cur, batch: int = 50000) -> Optional[Dict[str, int]]:
+    """
+    Dobra até `batch` deltas (os mais antigos) em leads_daily_stats e sobe a versão dos
+    workspaces afetados, numa transação: leitores de leads_daily_stats_live veem o antes
+    ou o depois, nunca os dois. Só um compactador por vez (advisory lock sem espera);
+    None = outro processo está compactando.
+    """
+    cur.execute("SELECT pg_try_advisory_xact_lock(%s) AS ok", (STATS_COMPACT_LOCK_KEY,))
+    if not cur.fetchone()["ok"]:
+        return None
+    cur.execute(_STATS_COMPACT_SQL, {"batch": max(1, int(batch))})
+    row = cur.fetchone()
+    return {"deltas": int(row["deltas"]), "workspaces": int(row["workspaces"])}
+
+
+# =========================
+# Partições mensais de leads
+# =========================
+# leads é particionada por RANGE (created_at) em meses de America/Sao_Paulo (mesmo
+# fuso dos dias do rollup), uma partição leads_pYYYYMM por mês. leads_history é a
+# tabela anterior ao particionamento, anexada como partição de tudo antes do corte.
+_PARTITION_RE = re.compile(r"^leads_p(\d{4})(\d{2})$")
+
+# índices de leads (criados na tabela particionada; cada partição herda)
+_LEADS_INDEXES = {
+    "idx_leads_client_created": "(client_id, created_at DESC)",
+    "idx_leads_client_label": "(client_id, virou_cliente)",
+    "idx_leads_client_created_id": "(client_id, created_at DESC, id DESC)",
+    "idx_leads_client_pending_created": "(client_id, created_at DESC, id DESC) WHERE virou_cliente IS NULL",
+    "idx_leads_client_labeled_created": "(client_id, created_at DESC, id DESC) WHERE virou_cliente IS NOT NULL",
+    "idx_leads_client_origem_created": "(client_id, origem, created_at DESC, id DESC)",
+}
+
+
+def _add_months(d: date, n: int) -> date:
+    y, m = divmod(d.month - 1 + n, 12)
+    return date(d.year + y, m + 1, 1)
+
+
+def _month_bound(d: date) -> datetime:
+    return datetime(d.year, d.month, 1, tzinfo=_SP_TZ)
+
+
+def lead_partition_name(d: date) -> str:
+    return f"leads_p{d.year:04d}{d.month:02d}"
+
+
+def lead_partitions(cur) -> List[Dict[str, Any]]:
+    """Partições de leads (nome, mês, limites, linhas estimadas pelo catálogo), em ordem."""
+    cur.execute(
+        """
+        SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bounds,
+               GREATEST(c.reltuples, 0)::bigint AS rows_estimate
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'leads'::regclass
+        ORDER BY c.relname
+        """
+    )
+    out = []
+    for r in cur.fetchall():
+        m = _PARTITION_RE.match(r["name"])
+        out.append({
+            "name": r["name"],
+            "month": f"{m.group(1)}-{m.group(2)}" if m else None,
+            "bounds": r["bounds"],
+            "rows_estimate": int(r["rows_estimate"]),
+        })
+    return out
+
+
+_BOUND_TO_RE = re.compile(r"TO \('([^']+)'\)")
+
+
+def _history_upper_bound(parts: List[Dict[str, Any]]) -> Optional[datetime]:
+    """Fim do intervalo de leads_history (o corte do m008), lido dos bounds de lead_partitions()."""
+    for p in parts:
+        if p["name"] != "leads_history":
+            continue
+        m = _BOUND_TO_RE.search(p["bounds"] or "")
+        if m:
+            # saída do Postgres: "2026-12-01 03:00:00+00" (offset sem minutos)
+            return datetime.fromisoformat(re.sub(r"([+-]\d\d)$", r"\1:00", m.group(1)))
+    return None
+
+
+def ensure_lead_partitions(cur, months_ahead: Optional[int] = None) -> List[str]:
+    """
+    Cria as partições mensais que faltam, do mês corrente até `months_ahead` meses à
+    frente. Idempotente; meses que começam antes do fim de leads_history são pulados
+    sem DDL (nenhum pedido de lock em leads no mês do corte). Cada criação roda num
+    savepoint com lock_timeout curto (se o lock em leads não vier, fica para a
+    próxima passada). Retorna as partições criadas.
+    """
+    months_ahead = LEADS_PARTITION_MONTHS_AHEAD if months_ahead is None else int(months_ahead)
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('leads')")
+    row = cur.fetchone()
+    if not row or row["relkind"] != "p":
+        return []
+    parts = lead_partitions(cur)
+    existing = {p["name"] for p in parts}
+    history_end = _history_upper_bound(parts)
+    first = datetime.now(_SP_TZ).date().replace(day=1)
+    created = []
+    for i in range(max(0, months_ahead) + 1):
+        month = _add_months(first, i)
+        name = lead_partition_name(month)
+        if name in existing or (history_end is not None and _month_bound(month) < history_end):
+            continue
+        try:
+            with cur.connection.transaction():
+                cur.execute("SELECT set_config('lock_timeout', '2s', true)")
+                cur.execute(
+                    sql.SQL("CREATE TABLE {} PARTITION OF leads FOR VALUES FROM ({}) TO ({})").format(
+                        sql.Identifier(name),
+                        sql.Literal(_month_bound(month)),
+                        sql.Literal(_month_bound(_add_months(month, 1))),
+                    )
+                )
+            created.append(name)
+        except (psycopg.errors.InvalidObjectDefinition, psycopg.errors.DuplicateTable):
+            # outro processo criou antes (ou overlap que os bounds lidos não mostraram)
+            continue
+        except psycopg.errors.LockNotAvailable:
+            break
+    return created
+
+
+def retire_lead_partitions(cur, before: date, drop: bool = False) -> List[str]:
+    """
+    Retenção em tempo constante: desanexa (drop=False, a tabela fica para arquivo) ou
+    apaga as partições mensais inteiramente anteriores a `before` (1º dia do mês).
+    DETACH/DROP não disparam os triggers do rollup, então as linhas de
+    leads_daily_stats (e deltas pendentes) desses meses saem junto e as versões dos
+    workspaces sobem.
+    leads_history não é tocada (use DELETE para podar o histórico pré-particionamento).
+    """
+    retired = []
+    # a compactação não pode devolver ao rollup deltas dos meses que saem
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (STATS_COMPACT_LOCK_KEY,))
+    for p in lead_partitions(cur):
+        m = _PARTITION_RE.match(p["name"])
+        if not m:
+            continue
+        month = date(int(m.group(1)), int(m.group(2)), 1)
+        if _add_months(month, 1) > before:
+            continue
+        cur.execute(sql.SQL("ALTER TABLE leads DETACH PARTITION {}").format(sql.Identifier(p["name"])))
+        if drop:
+            cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(p["name"])))
+        cur.execute(
+            "DELETE FROM leads_daily_stats WHERE day >= %s AND day < %s",
+            (month, _add_months(month, 1)),
+        )
+        cur.execute(
+            "DELETE FROM leads_daily_stats_delta WHERE day >= %s AND day < %s",
+            (month, _add_months(month, 1)),
+        )
+        retired.append(p["name"])
+    if retired:
+        cur.execute("UPDATE workspace_versions SET version = version + 1, updated_at = NOW()")
+    return retired
+
+
+# =========================
+# Migrações
+# =========================
+def _m001_baseline(cur) -> None:
+    """
+    Schema base, compatível com:
+    - versões antigas com leads em colunas "nome/email/telefone/..."
+    - versões novas com payload JSONB, score/label/updated_at
+    - clients antigos com api_key NOT NULL (corrigimos)
+    """
+    # -------------------------
+    # LEADS
+    # -------------------------
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS leads (
+            id BIGSERIAL PRIMARY KEY,
+            client_id TEXT NOT NULL,
+            -- colunas "clássicas" (dashboard atual)
+            nome TEXT,
+            email_lead TEXT,
+            telefone TEXT,
+            origem TEXT,
+            tempo_site INTEGER,
+            paginas_visitadas INTEGER,
+            clicou_preco INTEGER,
+            probabilidade DOUBLE PRECISION,
+            virou_cliente DOUBLE PRECISION,
+            -- colunas "SaaS" (futuro)
+            payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+            score INTEGER,
+            label INTEGER,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_leads_client_created ON leads(client_id, created_at DESC);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_leads_client_label ON leads(client_id, virou_cliente);")
+
+    # bancos anteriores ao schema atual
+    cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS client_id TEXT;")
+    cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS nome TEXT;")
+    cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS email_lead TEXT;")
+    cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS telefone TEXT;")
+    cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS origem TEXT;")
+    cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS tempo_site INTEGER;")
+    cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS paginas_visitadas INTEGER;")
+    cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS clicou_preco INTEGER;")
+    cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS probabilidade DOUBLE PRECISION;")
+    cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS virou_cliente DOUBLE PRECISION;")
+    cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS payload JSONB NOT NULL DEFAULT '{}'::jsonb;")
+    cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS score INTEGER;")
+    cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS label INTEGER;")
+    cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT NOW();")
+    cur.execute("ALTER TABLE leads ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW();")
+
+    # -------------------------
+    # CLIENTS
+    # -------------------------
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS clients (
+            client_id TEXT PRIMARY KEY,
+            -- perfil (opcional, usado no /signup)
+            nome TEXT,
+            email TEXT,
+            empresa TEXT,
+            telefone TEXT,
+            valid_until TIMESTAMPTZ,
+            password_hash TEXT,
+            last_login_at TIMESTAMPTZ,
+            -- auth / plan
+            api_key TEXT,
+            plan TEXT NOT NULL DEFAULT 'trial',
+            status TEXT NOT NULL DEFAULT 'active',
+            -- uso mensal
+            usage_month TEXT NOT NULL DEFAULT '',
+            leads_used_month INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+    """)
+
+    cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS api_key TEXT;")
+    cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS nome TEXT;")
+    cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS email TEXT;")
+    cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS empresa TEXT;")
+    cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS telefone TEXT;")
+    cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS valid_until TIMESTAMPTZ;")
+    cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS password_hash TEXT;")
+    cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS last_login_at TIMESTAMPTZ;")
+
+    # bancos antigos podem ter api_key NOT NULL -> drop (no-op se já é nullable)
+    cur.execute("ALTER TABLE clients ALTER COLUMN api_key DROP NOT NULL;")
+
+    cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS plan TEXT NOT NULL DEFAULT 'trial';")
+    cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS status TEXT NOT NULL DEFAULT 'active';")
+    cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS usage_month TEXT;")
+    cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS leads_used_month INTEGER NOT NULL DEFAULT 0;")
+    cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT NOW();")
+    cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW();")
+
+    # normaliza NULLs antigos
+    cur.execute("UPDATE clients SET usage_month=%s WHERE usage_month IS NULL OR usage_month='';", (_month_key(),))
+    cur.execute("UPDATE clients SET api_key='' WHERE api_key IS NULL;")
+    cur.execute("UPDATE clients SET updated_at=NOW() WHERE updated_at IS NULL;")
+
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_clients_api_key ON clients(api_key) WHERE api_key <> '';")
+    try:
+        # savepoint: e-mails duplicados em bancos antigos não abortam a migração inteira
+        with cur.connection.transaction():
+            cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_clients_email_unique ON clients(email) WHERE email IS NOT NULL AND email<>'';")
+    except psycopg.Error:
+        pass
+
+    # -------------------------
+    # THRESHOLDS / MODEL_META (para insights/treino)
+    # -------------------------
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS thresholds (
+            client_id TEXT PRIMARY KEY,
+            threshold DOUBLE PRECISION NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS model_meta (
+            client_id TEXT PRIMARY KEY,
+            can_train BOOLEAN NOT NULL DEFAULT FALSE,
+            labeled_count INTEGER NOT NULL DEFAULT 0,
+            classes_rotuladas TEXT NOT NULL DEFAULT '[]',
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+    """)
+
+    # -------------------------
+    # SUBSCRIPTIONS / BILLING EVENTS (Premium/Billing)
+    # -------------------------
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            client_id TEXT PRIMARY KEY,
+            provider TEXT NOT NULL DEFAULT 'manual',
+            status TEXT NOT NULL DEFAULT 'inactive',
+            plan TEXT NOT NULL DEFAULT 'trial',
+            current_period_start TIMESTAMPTZ,
+            current_period_end TIMESTAMPTZ,
+            cancel_at_period_end BOOLEAN NOT NULL DEFAULT FALSE,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS billing_events (
+            id BIGSERIAL PRIMARY KEY,
+            provider TEXT NOT NULL DEFAULT 'manual',
+            event_type TEXT NOT NULL,
+            client_id TEXT,
+            payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_billing_events_client_created ON billing_events(client_id, created_at DESC);")
+
+
+def _m002_daily_stats(cur) -> None:
+    """Rollup leads_daily_stats + triggers + workspace_versions; na criação, faz o backfill a partir de leads."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS workspace_versions (
+            client_id TEXT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+    """)
+    cur.execute("SELECT to_regclass('leads_daily_stats') IS NOT NULL AS present")
+    present = bool((cur.fetchone() or {}).get("present"))
+    if not present:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS leads_daily_stats (
+                client_id TEXT NOT NULL,
+                day DATE NOT NULL,
+                origem TEXT NOT NULL,
+                bucket SMALLINT NOT NULL,
+                status SMALLINT NOT NULL,
+                n BIGINT NOT NULL DEFAULT 0,
+                PRIMARY KEY (client_id, day, origem, bucket, status)
+            );
+        """)
+    cur.execute(_STATS_TRIGGER_FN_V1_SQL)
+    cur.execute("SELECT tgname FROM pg_trigger WHERE tgrelid = 'leads'::regclass AND NOT tgisinternal")
+    existing = {r["tgname"] for r in (cur.fetchall() or [])}
+    for name, spec in _STATS_TRIGGERS.items():
+        if name not in existing:
+            cur.execute(f"CREATE TRIGGER {name} {spec} FOR EACH STATEMENT EXECUTE FUNCTION leads_daily_stats_apply()")
+    if not present:
+        rebuild_daily_stats(cur, None)
+
+
+def _m003_leads_keyset_indexes(cur) -> None:
+    """Paginação keyset do /dashboard_data: (created_at, id) DESC, com variantes por status/origem."""
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_leads_client_created_id ON leads(client_id, created_at DESC, id DESC);")
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_leads_client_pending_created ON leads(client_id, created_at DESC, id DESC) "
+        "WHERE virou_cliente IS NULL;"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_leads_client_labeled_created ON leads(client_id, created_at DESC, id DESC) "
+        "WHERE virou_cliente IS NOT NULL;"
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_leads_client_origem_created ON leads(client_id, origem, created_at DESC, id DESC);")
+
+
+def _m004_model_store(cur) -> None:
+    """Modelos treinados persistidos por workspace (versão + fingerprint do conjunto rotulado)."""
+    cur.execute("ALTER TABLE model_meta ADD COLUMN IF NOT EXISTS model_version INTEGER NOT NULL DEFAULT 0;")
+    cur.execute("ALTER TABLE model_meta ADD COLUMN IF NOT EXISTS fingerprint TEXT;")
+    cur.execute("ALTER TABLE model_meta ADD COLUMN IF NOT EXISTS trained_at TIMESTAMPTZ;")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS models (
+            client_id TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            fingerprint TEXT NOT NULL,
+            labeled_count INTEGER NOT NULL DEFAULT 0,
+            sklearn_version TEXT NOT NULL DEFAULT '',
+            model BYTEA NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (client_id, version)
+        );
+    """)
+
+
+def _m005_jobs(cur) -> None:
+    """Fila de jobs em background (/jobs, ?async=1)."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id BIGSERIAL PRIMARY KEY,
+            client_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            params JSONB NOT NULL DEFAULT '{}'::jsonb,
+            progress DOUBLE PRECISION NOT NULL DEFAULT 0,
+            result JSONB,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            locked_by TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            started_at TIMESTAMPTZ,
+            finished_at TIMESTAMPTZ,
+            heartbeat_at TIMESTAMPTZ
+        );
+    """)
+    cur.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_active_dedupe ON jobs(client_id, kind) "
+        "WHERE status IN ('queued', 'running');"
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_queued ON jobs(id) WHERE status = 'queued';")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_running_heartbeat ON jobs(heartbeat_at) WHERE status = 'running';")
+
+
+def _m006_online_models(cur) -> None:
+    """Modelos online (SGD + partial_fit) ao lado dos batch."""
+    cur.execute("ALTER TABLE models ADD COLUMN IF NOT EXISTS kind TEXT NOT NULL DEFAULT 'batch';")
+    cur.execute("ALTER TABLE models ADD COLUMN IF NOT EXISTS online_updates INTEGER NOT NULL DEFAULT 0;")
+    cur.execute("ALTER TABLE models ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ;")
+
+
+def _m007_rate_limits(cur) -> None:
+    """Token buckets compartilhados entre workers (rate-limit da /demo_public)."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            bucket TEXT PRIMARY KEY,
+            tokens DOUBLE PRECISION NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_rate_limits_updated ON rate_limits(updated_at);")
+
+
+# CHECK que antecipa o limite de partição de leads_history (validado sem bloquear escrita)
+_HISTORY_BOUND_CHECK = "leads_history_bound"
+# índice único (id, created_at) feito em CONCURRENTLY; no ATTACH vira o da PK particionada
+_HISTORY_PK_INDEX = "leads_id_created_uq"
+
+
+def _create_index_concurrently(cur, name: str, table: str, spec: str, unique: bool = False) -> None:
+    """CREATE INDEX CONCURRENTLY (autocommit); um build interrompido deixa índice inválido, que é refeito."""
+    cur.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (name,))
+    idx = cur.fetchone()
+    if idx and idx["indisvalid"]:
+        return
+    if idx:
+        cur.execute(sql.SQL("DROP INDEX CONCURRENTLY {}").format(sql.Identifier(name)))
+    cur.execute(sql.SQL("CREATE {} INDEX CONCURRENTLY {} ON {} ").format(
+        sql.SQL("UNIQUE" if unique else ""), sql.Identifier(name), sql.Identifier(table)) + sql.SQL(spec))
+
+
+def _m008_needs_window(cur) -> bool:
+    """m008 só roda no boot (auto_migrate) com leads vazia; com dados, exige `python migrations.py`."""
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('leads')")
+    row = cur.fetchone()
+    if not row or row["relkind"] == "p":
+        return False
+    cur.execute("SELECT EXISTS (SELECT 1 FROM leads) AS has_rows")
+    return bool(cur.fetchone()["has_rows"])
+
+
+def _m008_prepare(cur) -> None:
+    """
+    Passos de m008 fora da transação (autocommit), antes do ACCESS EXCLUSIVE. Leitura e
+    escrita em leads seguem durante as varreduras:
+    - CHECK (created_at < corte) NOT VALID + VALIDATE: o ATTACH usa o CHECK como prova
+      do limite da partição e não varre o histórico;
+    - CREATE UNIQUE INDEX CONCURRENTLY (id, created_at): o ATTACH o adota para a PK da
+      tabela particionada em vez de construir um índice sob o lock.
+    O corte é o mês seguinte ao de amanhã, para que inserts entre o VALIDATE e o lock
+    não violem o CHECK na virada do mês.
+    """
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('leads')")
+    row = cur.fetchone()
+    if not row or row["relkind"] == "p":
+        return
+    cur.execute("SELECT set_config('lock_timeout', %s, false)", (MIGRATION_LOCK_TIMEOUT,))
+    try:
+        cur.execute(
+            "SELECT 1 FROM pg_constraint WHERE conrelid = 'leads'::regclass AND conname = %s",
+            (_HISTORY_BOUND_CHECK,),
+        )
+        if not cur.fetchone():
+            tomorrow = (datetime.now(_SP_TZ) + timedelta(days=1)).date()
+            cutover = _add_months(tomorrow.replace(day=1), 1)
+            cur.execute(sql.SQL("ALTER TABLE leads ADD CONSTRAINT {} CHECK (created_at < {}) NOT VALID").format(
+                sql.Identifier(_HISTORY_BOUND_CHECK), sql.Literal(_month_bound(cutover))))
+        cur.execute(sql.SQL("ALTER TABLE leads VALIDATE CONSTRAINT {}").format(sql.Identifier(_HISTORY_BOUND_CHECK)))
+
+        _create_index_concurrently(cur, _HISTORY_PK_INDEX, "leads", "(id, created_at)", unique=True)
+    finally:
+        cur.execute("SELECT set_config('lock_timeout', '0', false)")
+
+
+def _m008_leads_partitioned(cur) -> None:
+    """
+    Converte leads em tabela particionada por mês sem copiar dados: a tabela atual
+    vira leads_history e é anexada como partição de tudo antes do corte (fixado pelo
+    CHECK de _m008_prepare); dali em diante cada mês tem a sua partição
+    (ensure_lead_partitions). A sequência de ids, os índices e os triggers do rollup
+    passam para a tabela nova.
+    """
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = 'leads'::regclass")
+    if cur.fetchone()["relkind"] != "p":
+        cur.execute(
+            "SELECT pg_get_constraintdef(oid) AS def FROM pg_constraint "
+            "WHERE conrelid = 'leads'::regclass AND conname = %s AND convalidated",
+            (_HISTORY_BOUND_CHECK,),
+        )
+        row = cur.fetchone()
+        m = re.search(r"'([^']+)'", row["def"]) if row else None
+        if not m:
+            raise RuntimeError(f"m008 requer o CHECK {_HISTORY_BOUND_CHECK} validado (rode: python migrations.py)")
+        cutover = m.group(1)
+        cur.execute("LOCK TABLE leads IN ACCESS EXCLUSIVE MODE")
+        cur.execute("SELECT pg_get_serial_sequence('leads', 'id') AS seq")
+        seq = cur.fetchone()["seq"]
+        for name in _STATS_TRIGGERS:
+            cur.execute(sql.SQL("DROP TRIGGER IF EXISTS {} ON leads").format(sql.Identifier(name)))
+        cur.execute("ALTER TABLE leads RENAME TO leads_history")
+        # os índices antigos ganham sufixo; os nomes originais passam aos índices particionados.
+        # No ATTACH, os índices equivalentes de leads_history (inclusive o de _m008_prepare,
+        # para a PK) são anexados em vez de reconstruídos; um índice de _LEADS_INDEXES que
+        # faltar em leads_history seria construído aqui, sob o lock.
+        cur.execute(
+            "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE i.indrelid = 'leads_history'::regclass"
+        )
+        for r in cur.fetchall():
+            cur.execute(sql.SQL("ALTER INDEX {} RENAME TO {}").format(
+                sql.Identifier(r["relname"]), sql.Identifier((r["relname"] + "_hist")[:63])))
+
+        cur.execute("CREATE TABLE leads (LIKE leads_history INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)")
+        # PK de tabela particionada precisa conter a chave de partição
+        cur.execute("ALTER TABLE leads ADD PRIMARY KEY (id, created_at)")
+        if seq:
+            cur.execute(sql.SQL("ALTER SEQUENCE {} OWNED BY leads.id").format(sql.SQL(seq)))
+        for name, spec in _LEADS_INDEXES.items():
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON leads {spec}")
+
+        # o CHECK validado implica o limite da partição: ATTACH sem varrer leads_history
+        cur.execute(sql.SQL("ALTER TABLE leads ATTACH PARTITION leads_history FOR VALUES FROM (MINVALUE) TO ({})").format(
+            sql.Literal(cutover)))
+        cur.execute(sql.SQL("ALTER TABLE leads_history DROP CONSTRAINT {}").format(sql.Identifier(_HISTORY_BOUND_CHECK)))
+        for name, spec in _STATS_TRIGGERS.items():
+            cur.execute(f"CREATE TRIGGER {name} {spec} FOR EACH STATEMENT EXECUTE FUNCTION leads_daily_stats_apply()")
+    ensure_lead_partitions(cur)
+
+
+# índices de m009 (nome -> definição depois de "ON <tabela>")
+_M009_INDEXES = {
+    "idx_leads_pending_cover": (
+        "(client_id, created_at DESC, id DESC) "
+        "INCLUDE (tempo_site, paginas_visitadas, clicou_preco) WHERE virou_cliente IS NULL"
+    ),
+    "idx_leads_labeled_cover": (
+        "(client_id, created_at DESC, id DESC) "
+        "INCLUDE (tempo_site, paginas_visitadas, clicou_preco, probabilidade, virou_cliente) "
+        "WHERE virou_cliente IS NOT NULL"
+    ),
+    "idx_leads_client_hot_created": "(client_id, created_at DESC) WHERE probabilidade >= 0.70 OR score >= 70",
+    "idx_leads_created_brin": "USING brin (created_at)",
+}
+
+
+def _partition_index_name(partition: str, index: str) -> str:
+    return f"{partition}_{index[len('idx_'):]}"[:63]
+
+
+def _leads_is_partitioned(cur) -> bool:
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('leads')")
+    row = cur.fetchone()
+    return bool(row) and row["relkind"] == "p"
+
+
+def _m009_prepare(cur) -> None:
+    """
+    Passo de m009 fora da transação: constrói os índices em cada partição com
+    CREATE INDEX CONCURRENTLY (inserts em leads seguem durante o build, inclusive
+    em leads_history). A transação da versão só cria o índice ON ONLY leads e anexa.
+    """
+    if not _leads_is_partitioned(cur):
+        return
+    parts = [p["name"] for p in lead_partitions(cur)]
+    cur.execute("SELECT set_config('lock_timeout', %s, false)", (MIGRATION_LOCK_TIMEOUT,))
+    try:
+        for name, spec in _M009_INDEXES.items():
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL AS present", (name,))
+            if cur.fetchone()["present"]:
+                continue
+            for part in parts:
+                _create_index_concurrently(cur, _partition_index_name(part, name), part, spec)
+    finally:
+        cur.execute("SELECT set_config('lock_timeout', '0', false)")
+
+
+def _m009_query_indexes(cur) -> None:
+    """
+    Índices pelo formato das queries do app.py (conferidos por explain_check.py):
+    - pendentes/rotulados: parciais + INCLUDE das features -> index-only scan no
+      /recalc_pending, no treino e na paginação keyset por status
+    - hot leads do dia: parcial em prob/score altos
+    - BRIN em created_at: varreduras por período entre tenants (retenção, reconciliação)
+    Saem os redundantes: (client_id, created_at) é prefixo de (client_id, created_at, id),
+    (client_id, virou_cliente) foi coberto pelos parciais, e idx_clients_email duplica
+    idx_clients_email_unique.
+    Em leads particionada, os índices das partições vêm prontos de _m009_prepare: aqui
+    só entram o índice ON ONLY leads e os ATTACH PARTITION (nenhum build sob lock).
+    """
+    partitioned = _leads_is_partitioned(cur)
+    for name, spec in _M009_INDEXES.items():
+        if not partitioned:
+            cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON leads ").format(sql.Identifier(name)) + sql.SQL(spec))
+            continue
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL AS present", (name,))
+        if cur.fetchone()["present"]:
+            continue
+        cur.execute(sql.SQL("CREATE INDEX {} ON ONLY leads ").format(sql.Identifier(name)) + sql.SQL(spec))
+        for p in lead_partitions(cur):
+            pidx = _partition_index_name(p["name"], name)
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL AS present", (pidx,))
+            if not cur.fetchone()["present"]:
+                # partição criada depois do prepare (mês novo, ainda pequena): constrói aqui
+                cur.execute(sql.SQL("CREATE INDEX {} ON {} ").format(
+                    sql.Identifier(pidx), sql.Identifier(p["name"])) + sql.SQL(spec))
+            cur.execute(sql.SQL("ALTER INDEX {} ATTACH PARTITION {}").format(
+                sql.Identifier(name), sql.Identifier(pidx)))
+    cur.execute("DROP INDEX IF EXISTS idx_leads_client_pending_created;")
+    cur.execute("DROP INDEX IF EXISTS idx_leads_client_labeled_created;")
+    cur.execute("DROP INDEX IF EXISTS idx_leads_client_created;")
+    cur.execute("DROP INDEX IF EXISTS idx_leads_client_label;")
+    cur.execute("DROP INDEX IF EXISTS idx_clients_email;")
+    # em leads_history os equivalentes (sufixo _hist) saem em cascata quando estavam
+    # anexados aos índices particionados; os que não estavam saem aqui
+    for name in ("idx_leads_client_pending_created_hist", "idx_leads_client_labeled_created_hist",
+                 "idx_leads_client_created_hist", "idx_leads_client_label_hist"):
+        cur.execute(sql.SQL("DROP INDEX IF EXISTS {}").format(sql.Identifier(name)))
+
+
+def _m010_quota_usage(cur) -> None:
+    """
+    Cota mensal em contadores por shard: cada (client_id, mês) tem N linhas com
+    used/cap e a soma dos caps é o limite do plano (limit_total). O /prever reserva
+    numa shard livre (FOR UPDATE SKIP LOCKED) em vez de travar a row de clients;
+    o CHECK garante que nenhuma shard passa do próprio cap. fillfactor baixo:
+    used muda a cada ingest e nenhuma coluna indexada muda (updates HOT).
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS quota_usage (
+            client_id TEXT NOT NULL,
+            month TEXT NOT NULL,
+            shard SMALLINT NOT NULL,
+            used INTEGER NOT NULL DEFAULT 0,
+            cap INTEGER,
+            limit_total INTEGER NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (client_id, month, shard),
+            CONSTRAINT quota_usage_cap_chk CHECK (cap IS NULL OR used <= cap)
+        ) WITH (fillfactor = 70);
+    """)
+
+
+def _m011_stats_deltas(cur) -> None:
+    """
+    Rollup e versão do workspace fora da transação de quem escreve em leads: o trigger
+    passa a só acrescentar deltas (leads_daily_stats_delta); compact_daily_stats os dobra
+    em leads_daily_stats e sobe workspace_versions. Leitura por leads_daily_stats_live.
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS leads_daily_stats_delta (
+            id BIGSERIAL PRIMARY KEY,
+            client_id TEXT NOT NULL,
+            day DATE NOT NULL,
+            origem TEXT NOT NULL,
+            bucket SMALLINT NOT NULL,
+            status SMALLINT NOT NULL,
+            n BIGINT NOT NULL
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_stats_delta_client_day ON leads_daily_stats_delta(client_id, day);")
+    cur.execute(_STATS_LIVE_VIEW_SQL)
+    cur.execute(_STATS_TRIGGER_FN_SQL)
+
+
+# (versão, nome, função) em ordem crescente; todas idempotentes (bancos criados
+# antes do schema_version passam por todas uma vez, sem efeito no que já existe)
+MIGRATIONS: List[Tuple[int, str, Callable]] = [
+    (1, "baseline", _m001_baseline),
+    (2, "daily_stats", _m002_daily_stats),
+    (3, "leads_keyset_indexes", _m003_leads_keyset_indexes),
+    (4, "model_store", _m004_model_store),
+    (5, "jobs", _m005_jobs),
+    (6, "online_models", _m006_online_models),
+    (7, "rate_limits", _m007_rate_limits),
+    (8, "leads_partitioned", _m008_leads_partitioned),
+    (9, "query_indexes", _m009_query_indexes),
+    (10, "quota_usage", _m010_quota_usage),
+    (11, "stats_deltas", _m011_stats_deltas),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+# passos fora de transação (CONCURRENTLY, VALIDATE), rodados antes da transação da versão
+_PREPARE: Dict[int, Callable] = {8: _m008_prepare, 9: _m009_prepare}
+# versões que ensure_schema (boot) não aplica quando o predicado diz que exigem janela:
+# o app fica em SchemaOutdated até alguém rodar `python migrations.py`
+_MANUAL: Dict[int, Callable] = {8: _m008_needs_window}
+
+
+# =========================
+# Runner
+# =========================
+def connect(url: Optional[str] = None):
+    """Conexão dedicada (autocommit) para migrar; fora do pool do app."""
+    url = (url or os.environ.get("DATABASE_URL") or "").strip()
+    if not url:
+        raise SystemExit("DATABASE_URL ausente.")
+    return psycopg.connect(url, autocommit=True, row_factory=dict_row)
+
+
+def current_version(conn) -> int:
+    """Versão aplicada (0 = banco sem schema_version). Um único SELECT."""
+    try:
+        with conn.cursor(row_factory=dict_row) as cur:
+            cur.execute("SELECT COALESCE(MAX(version), 0) AS v FROM schema_version")
+            return int(cur.fetchone()["v"])
+    except psycopg.errors.UndefinedTable:
+        return 0
+
+
+def migrate(conn, target: Optional[int] = None, manual: bool = True) -> List[int]:
+    """
+    Aplica as migrações pendentes até `target` (padrão: a última), cada uma na sua
+    transação, sob advisory lock. Requer conexão em autocommit (ver connect()).
+    manual=False para antes de uma versão de _MANUAL que exige janela.
+    Retorna as versões aplicadas por este processo.
+    """
+    if not conn.autocommit:
+        raise ValueError("migrate() requer conexão em autocommit (use migrations.connect())")
+    target = LATEST_VERSION if target is None else int(target)
+    applied: List[int] = []
+    with conn.cursor(row_factory=dict_row) as cur:
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+        try:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    duration_ms INTEGER NOT NULL DEFAULT 0
+                );
+            """)
+            # outro processo pode ter migrado enquanto esperávamos o lock
+            done = current_version(conn)
+            for version, name, fn in MIGRATIONS:
+                if version <= done or version > target:
+                    continue
+                if not manual and version in _MANUAL and _MANUAL[version](cur):
+                    break
+                t0 = time.perf_counter()
+                if version in _PREPARE:
+                    _PREPARE[version](cur)
+                with conn.transaction():
+                    cur.execute("SELECT set_config('lock_timeout', %s, true)", (MIGRATION_LOCK_TIMEOUT,))
+                    fn(cur)
+                    cur.execute(
+                        "INSERT INTO schema_version (version, name, duration_ms) VALUES (%s, %s, %s)",
+                        (version, name, int((time.perf_counter() - t0) * 1000)),
+                    )
+                applied.append(version)
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+    return applied
+
+
+def ensure_schema(conn, auto_migrate: bool = True) -> int:
+    """
+    Checagem de subida: com o banco em dia é um SELECT só. Atrás da versão,
+    migra (auto_migrate) ou levanta SchemaOutdated; também levanta se parar antes de
+    uma migração de _MANUAL (ex.: m008 com dados). Retorna a versão final.
+    """
+    version = current_version(conn)
+    if version >= LATEST_VERSION:
+        return version
+    if auto_migrate:
+        migrate(conn, manual=False)
+        version = current_version(conn)
+    if version < LATEST_VERSION:
+        raise SchemaOutdated(f"schema na versão {version}, código espera {LATEST_VERSION} (rode: python migrations.py)")
+    return version
+
+
+def main():
+    conn = connect()
+    try:
+        version = current_version(conn)
+        if "--status" in sys.argv[1:]:
+            print(f"schema_version={version} latest={LATEST_VERSION}")
+            return
+        applied = migrate(conn)
+        if applied:
+            print(f"✅ Migrações aplicadas: {applied} (agora na versão {current_version(conn)})")
+        else:
+            print(f"ℹ️ Schema já está na versão {version}.")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -23,6 +23,8 @@ except Exception as e:
         "ERRO: instale psycopg[binary]. Ex.: pip install 'psycopg[binary]'\n" + repr(e)
     )
 
+import migrations
+
 DATABASE_URL = (os.environ.get("DATABASE_URL") or "").strip()
 SEED_CLIENT_ID = (os.environ.get("SEED_CLIENT_ID") or "demo_seed").strip()
 SEED_N = int((os.environ.get("SEED_N") or "30").strip())
@@ -46,55 +48,13 @@ def _gen_api_key(client_id: str) -> str:
     return "sk_live_" + _sha256(raw)[:32]
 
 
-def ensure_schema(conn):
-    with conn.cursor() as cur:
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS leads (
-                id BIGSERIAL PRIMARY KEY,
-                client_id TEXT NOT NULL,
-                nome TEXT,
-                email_lead TEXT,
-                telefone TEXT,
-                origem TEXT,
-                tempo_site INTEGER,
-                paginas_visitadas INTEGER,
-                clicou_preco INTEGER,
-                probabilidade DOUBLE PRECISION,
-                virou_cliente DOUBLE PRECISION,
-                payload JSONB NOT NULL DEFAULT '{}'::jsonb,
-                score INTEGER,
-                label INTEGER,
-                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-                updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-            );
-            """
-        )
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_leads_client_created ON leads(client_id, created_at DESC);")
-
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS clients (
-                client_id TEXT PRIMARY KEY,
-                api_key TEXT,
-                plan TEXT NOT NULL DEFAULT 'trial',
-                status TEXT NOT NULL DEFAULT 'active',
-                usage_month TEXT NOT NULL DEFAULT '',
-                leads_used_month INTEGER NOT NULL DEFAULT 0,
-                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-                updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-            );
-            """
-        )
-        cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS api_key TEXT;")
-        cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS plan TEXT NOT NULL DEFAULT 'trial';")
-        cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS status TEXT NOT NULL DEFAULT 'active';")
-        cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS usage_month TEXT;")
-        cur.execute("ALTER TABLE clients ADD COLUMN IF NOT EXISTS leads_used_month INTEGER NOT NULL DEFAULT 0;")
-
-        mk = _month_key()
-        cur.execute("UPDATE clients SET usage_month=%s WHERE usage_month IS NULL OR usage_month='';", (mk,))
-        cur.execute("UPDATE clients SET api_key='' WHERE api_key IS NULL;")
+def ensure_schema():
+    """Schema compartilhado com o app: aplica as migrações pendentes de migrations.py."""
+    conn = migrations.connect(DATABASE_URL)
+    try:
+        migrations.ensure_schema(conn)
+    finally:
+        conn.close()
 
 
 def heuristic_prob(tempo_site: int, paginas: int, clicou_preco: int, nome: str, telefone: str) -> float:
@@ -113,11 +73,10 @@ def main():
     if not DATABASE_URL:
         raise SystemExit("DATABASE_URL ausente. Configure DATABASE_URL para popular o Postgres.")
 
+    ensure_schema()
     conn = psycopg.connect(DATABASE_URL)
     try:
         with conn:
-            ensure_schema(conn)
-
             with conn.cursor() as cur:
                 cur.execute("SELECT client_id, api_key FROM clients WHERE client_id=%s", (SEED_CLIENT_ID,))
                 row = cur.fetchone()